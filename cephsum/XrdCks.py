@@ -1,6 +1,6 @@
 
 import struct,sys, logging
-import datetime
+import datetime, time
 
 # Checksum object; as specified in: https://github.com/xrootd/xrootd/blob/master/src/XrdCks/XrdCksData.hh 
 
@@ -96,6 +96,27 @@ class XrdCks :
         logging.debug(f"Time info: {fm_time}, {cks.fm_time}, {cs_time}, {cks.cs_time}, {end_time} ")
         return cks
 
+    @classmethod
+    def from_mtime(cls, alg_name, mtime, cks_value_as_hex):
+        """Create an object for a file with the given (stat) mtime, as time.struct_time, and checksum computed now.
+        """
+        fmtime = datetime.datetime(mtime.tm_year, mtime.tm_mon, mtime.tm_mday ,mtime.tm_hour ,mtime.tm_min ,mtime.tm_sec ) 
+        if mtime.tm_isdst:
+            fmtime = fmtime - datetime.timedelta(hours=1)
+
+        # get current time 
+        mnow  = time.localtime()
+        now = datetime.datetime(mnow.tm_year, mnow.tm_mon, mnow.tm_mday ,mnow.tm_hour ,mnow.tm_min ,mnow.tm_sec ) 
+        if mtime.tm_isdst:
+            now = now - datetime.timedelta(hours=1)
+
+        delta = now - fmtime
+
+        fmtime_asint = int(fmtime.timestamp())
+        cstime_asint = int(delta.total_seconds())
+
+        return cls(alg_name, fmtime_asint, cstime_asint, cks_value_as_hex)
+
     @classmethod
     def as_binary(cls,alg_name, fm_time, cs_time, cks_value_as_hex):
         cks = cls(alg_name, fm_time, cs_time, cks_value_as_hex )
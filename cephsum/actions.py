@@ -4,11 +4,12 @@ import sys, os,re
 from datetime import datetime
 import functools
 
-import rados
 import XrdCks
 import adler32
-import cephtools
 import lfn2pfn
+import backends
+
+# Each action takes either a librados ioctx, or a backends.Backend for other storage
 
 
 
@@ -16,14 +17,14 @@ import lfn2pfn
 def get_from_metatdata(ioctx, path, xattr_name = "XrdCks.adler32"):
     """Try to get checksum info from metadata only.
     """
-    xrdcks = cephtools.cks_from_metadata(ioctx,path,xattr_name)
+    xrdcks = backends.as_backend(ioctx).cks_from_metadata(path,xattr_name)
     logging.info(xrdcks)
     return xrdcks  # returns None if not existing
 
 def get_from_file(ioctx, path, readsize):
     """Try to get checksum info from file only.
     """
-    xrdcks = cephtools.cks_from_file(ioctx,path,readsize)
+    xrdcks = backends.as_backend(ioctx).cks_from_file(path,readsize)
     logging.info(xrdcks)
     return xrdcks  # returns None if not existing
 
@@ -41,23 +42,35 @@ def get_checksum(ioctx, path, readsize, xattr_name = "XrdCks.adler32"):
 
 
 
-def inget(ioctx, path, readsize, xattr_name = "XrdCks.adler32",rewriteto_littleendian=True):
+def inget(ioctx, path, readsize, xattr_name = "XrdCks.adler32",rewriteto_littleendian=True, defer=None):
     """Return a checksum; if in metadata, just return that. If no metadata, obtain from file and store metadata.
-    If rewriteto_littleendian and metadata was stored in big endian; write it back as little endian
+    If rewriteto_littleendian and metadata was stored in big endian; write it back as little endian.
+    If defer is given, the rewrite is not made here, but passed to defer(path, xattr_name, value, expected)
+    (e.g. repairs.RepairJournal.record for the pool), to be applied later if the xattr is still the value read here.
     """
+    backend = backends.as_backend(ioctx)
     source = 'metadata'
     xrdcks = get_from_metatdata(ioctx, path, xattr_name)
 
     if rewriteto_littleendian and xrdcks is not None and xrdcks.read_format == 'big':
-        logging.debug(f'Rewriting to little endian {path}')
         cks_binary = xrdcks.to_binary()
         logging.debug(cks_binary)
-        cephtools.cks_write_metadata(ioctx, path, xattr_name, cks_binary, force_overwrite=True)
+        if defer is not None:
+            logging.debug(f'Deferring rewrite to little endian {path}')
+            try:
+                # expected is the big endian value as read, so that no other read is needed
+                defer(path, xattr_name, cks_binary, bytes(xrdcks._input_bytes))
+            except Exception as e:
+                # the repair is not needed for the answer
+                logging.warning(f'Could not defer rewrite of {path}: {e}')
+        else:
+            logging.debug(f'Rewriting to little endian {path}')
+            backend.cks_write_metadata(path, xattr_name, cks_binary, force_overwrite=True)
 
 
     if xrdcks is None:
         source = 'file'
-        xrdcks = cephtools.cks_from_file(ioctx, path,readsize)
+        xrdcks = backend.cks_from_file(path,readsize)
         if xrdcks is None:
             logging.warning(f"No checksum possible for {path} from file")
             return None
@@ -65,7 +78,7 @@ def inget(ioctx, path, readsize, xattr_name = "XrdCks.adler32",rewriteto_littlee
 
         cks_binary = xrdcks.to_binary()
         logging.debug(cks_binary)
-        cephtools.cks_write_metadata(ioctx, path, xattr_name, cks_binary, force_overwrite=False)
+        backend.cks_write_metadata(path, xattr_name, cks_binary, force_overwrite=False)
 
     cks_hex = xrdcks.get_cksum_as_hex() if xrdcks is not None else "None"
     logging.info(f'Path:{path}; From:{source}; Checksum:{cks_hex}')
@@ -77,17 +90,14 @@ def verify(ioctx, path, readsize, xattr_name = "XrdCks.adler32", force_fileread=
     """compare the stored checksum against the file-computed value.
     If no stored metadata, still compute file (if requested), but compare as false.
     """
+    backend = backends.as_backend(ioctx)
 
-    xrdcks_stored = cephtools.cks_from_metadata(ioctx, path, xattr_name)
+    # the backend reads the metadata and the file data together where it can
+    xrdcks_stored, xrdcks_file = backend.cks_verify(path, readsize, xattr_name, force_fileread)
     if xrdcks_stored is None:
         logging.debug(f'{path} has no stored metadata')
 
-    if xrdcks_stored is None and not force_fileread:
-        xrdcks_file = None
-    else:
-        xrdcks_file = cephtools.cks_from_file(ioctx, path,readsize)
-
-    if xrdcks_stored is None:
+    if xrdcks_stored is None or xrdcks_file is None:
         matching = False
     else:
         matching = xrdcks_stored.get_cksum_as_binary() == xrdcks_file.get_cksum_as_binary()
@@ -97,6 +107,34 @@ def verify(ioctx, path, readsize, xattr_name = "XrdCks.adler32", force_fileread=
 
 
 
+def check_structure(ioctx, path):
+    """Check the stripe objects of the file against the striper metadata, without reading data.
+    Returns the list of problems found; empty if ok.
+    """
+    problems = backends.as_backend(ioctx).check_structure(path)
+    logging.info(f'Path:{path}; Structure:{"ok" if not problems else "broken"}; Problems:{problems}')
+    return problems
+
+
+def store_from_stream(ioctx, path, cks_hex, bytes_read, xattr_name = "XrdCks.adler32"):
+    """Store a checksum that was calculated while the file was written (e.g. by tpc.py).
+    The stream checksum describes the data just written, so any existing metadata is overwritten.
+    """
+    backend = backends.as_backend(ioctx)
+    xrdcks = backend.cks_from_stream(path, cks_hex, bytes_read)
+    if xrdcks is None:
+        logging.warning(f"No checksum stored for {path} from stream")
+        return None
+
+    cks_binary = xrdcks.to_binary()
+    logging.debug(cks_binary)
+    backend.cks_write_metadata(path, xattr_name, cks_binary, force_overwrite=True)
+
+    logging.info(f'Path:{path}; From:{xrdcks.source_type}; Checksum:{xrdcks.get_cksum_as_hex()}')
+    return xrdcks
+
+
+
 # def fullchain_test(ioctx, path):
 #     """More for testing; run through various set of ways of getting the checksum"""
 
@@ -0,0 +1,151 @@
+import logging
+import os, json, time
+import threading
+from contextlib import contextmanager
+
+import rados
+
+# Adaptive concurrency for bulk runs (bulk.py --adaptive): the number of files in flight follows the observed
+# read latency and errors, rather than a fixed number of workers that is too low on a quiet cluster,
+# and too high during recovery.
+
+
+class AimdController:
+    """Additive increase, multiplicative decrease of the number of files in flight (the setpoint),
+    between floor and ceiling.
+
+    Reads are observed with record (see ObservedReader). After each window of reads, the setpoint is multiplied
+    by decrease if any read failed, or if the median latency (per MiB, for reads of at least 1 MiB) exceeds
+    target_latency; otherwise it is increased by one. Without a target_latency, the target is tolerance times
+    the lowest window median seen, which is raised slowly so that the controller follows a lasting change of the cluster.
+    The setpoint is available as the setpoint attribute, and in export_file (json) if given, from the start and after each change.
+    """
+    def __init__(self, floor=1, ceiling=32, initial=None, target_latency=None, tolerance=2.0, window=16,
+                 decrease=0.7, export_file=None):
+        if not 1 <= floor <= ceiling:
+            raise ValueError(f'Expected 1 <= floor <= ceiling, got {floor} and {ceiling}')
+        self.floor = floor
+        self.ceiling = ceiling
+        self.setpoint = min(ceiling, max(floor, floor if initial is None else initial))
+        self.target_latency = target_latency
+        self.tolerance = tolerance
+        self.window = window
+        self.decrease = decrease
+        self.export_file = export_file
+        self.baseline = None
+        self.inflight = 0
+        self.increases = 0
+        self.decreases = 0
+        self._latencies = []
+        self._errors = 0
+        self._cond = threading.Condition()
+        if self.export_file is not None:
+            self._export()
+
+    @contextmanager
+    def slot(self):
+        """Wait until fewer than setpoint are in flight, and hold one of them for the duration of the context"""
+        with self._cond:
+            while self.inflight >= self.setpoint:
+                self._cond.wait()
+            self.inflight += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self.inflight -= 1
+                self._cond.notify_all()
+
+    def record(self, seconds, length, error=False):
+        """Observe a read of length bytes that took seconds, or failed"""
+        with self._cond:
+            if error:
+                self._errors += 1
+            else:
+                self._latencies.append(seconds / max(length, 1024*1024) * 1024*1024)
+            if len(self._latencies) + self._errors >= self.window:
+                self._adjust()
+
+    def _adjust(self):
+        latencies = sorted(self._latencies)
+        median = latencies[len(latencies) // 2] if latencies else None
+        if median is not None:
+            self.baseline = median if self.baseline is None else min(median, self.baseline * 1.05)
+        target = self.target_latency
+        if target is None and self.baseline is not None:
+            target = self.tolerance * self.baseline
+        previous = self.setpoint
+        if self._errors or (median is not None and target is not None and median > target):
+            self.setpoint = max(self.floor, int(self.setpoint * self.decrease))
+            self.decreases += 1
+        else:
+            self.setpoint = min(self.ceiling, self.setpoint + 1)
+            self.increases += 1
+        logging.debug(f'Setpoint {previous} -> {self.setpoint}; median latency per MiB {median}, target {target}, '
+                      f'errors {self._errors}')
+        self._latencies = []
+        self._errors = 0
+        self._cond.notify_all()
+        if self.export_file is not None and self.setpoint != previous:
+            self._export()
+
+    def stats(self):
+        """Dict of the setpoint, its limits, the files in flight, and the number of adjustments"""
+        return {'setpoint': self.setpoint, 'floor': self.floor, 'ceiling': self.ceiling, 'inflight': self.inflight,
+                'increases': self.increases, 'decreases': self.decreases,
+                'baseline_latency_per_mib_s': self.baseline, 'target_latency_per_mib_s': self.target_latency}
+
+    def _export(self):
+        tmp = f'{self.export_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(dict(self.stats(), updated=time.time()), f)
+            os.replace(tmp, self.export_file)
+        except OSError as e:
+            logging.warning(f'Could not export the setpoint to {self.export_file}: {e}')
+
+
+class ObservedReader:
+    """Reader (see cephtools.read_oid_bytes) reporting the latency of each read, and failed reads, to an AimdController.
+    Reads are made from ioctx, or through reader (e.g. an osdmap.OsdScheduler) if given.
+    If reader can submit reads ahead, so can this one; and if it limits the reads in flight (max_inflight), 
+    the limit follows the setpoint, at reads_per_file for each file in flight."""
+    def __init__(self, controller, ioctx, reader=None, reads_per_file=4):
+        self.controller = controller
+        self.ioctx = ioctx
+        self.reader = reader
+        self.reads_per_file = reads_per_file
+        if hasattr(reader, 'submit'):
+            self.submit = self._submit
+
+    def read(self, oid, length, offset=0):
+        start = time.monotonic()
+        try:
+            if self.reader is not None:
+                data = self.reader.read(oid, length, offset)
+            else:
+                data = self.ioctx.read(oid, length, offset)
+        except rados.ObjectNotFound:
+            # an answer about the file, not a sign of load
+            raise
+        except Exception:
+            self.controller.record(time.monotonic() - start, length, error=True)
+            raise
+        self.controller.record(time.monotonic() - start, len(data))
+        return data
+
+    def _submit(self, oid, length, offset=0):
+        if hasattr(self.reader, 'max_inflight'):
+            self.reader.max_inflight = max(1, self.controller.setpoint * self.reads_per_file)
+        start = time.monotonic()
+        future = self.reader.submit(oid, length, offset)
+        def oncomplete(f):
+            # the latency includes the time queued in reader
+            if f.cancelled() or isinstance(f.exception(), rados.ObjectNotFound):
+                return
+            if f.exception() is not None:
+                self.controller.record(time.monotonic() - start, length, error=True)
+            else:
+                self.controller.record(time.monotonic() - start, len(f.result()))
+        future.add_done_callback(oncomplete)
+        return future
@@ -4,6 +4,21 @@ import struct
 # 
 
 
+ADLER32_MOD = 65521
+
+
+class ZeroRun:
+    """A run of length zero bytes, passed in place of a buffer (e.g. for a hole in a sparse file), 
+    so that the zeros are neither read nor allocated"""
+    __slots__ = ('length',)
+
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
 class adler32():
     def __init__(self,name='adler32'):
         self.name = name
@@ -12,6 +27,46 @@ class adler32():
         self.number_buffers = None
         self.log_each_step = False 
 
+    def reset(self):
+        """Reset the running checksum used by update"""
+        self._running = 1 # initilising value
+        self.bytes_read = 0
+        self.number_buffers = 0
+        self.value = self.adler32_inttohex(self._running)
+        return self
+
+    def update(self,buf):
+        """Add a buffer to the running checksum; for data that does not arrive as a single iterable.
+
+    Parameters:
+        buf: input data in bytes
+
+    Returns:
+        Checksum: running adler32 value in lowercase hex 
+        """
+        if self.bytes_read is None:
+            self.reset()
+        self._running = self.adler32_update(self._running, buf)
+        self.bytes_read += len(buf)
+        self.number_buffers += 1
+        self.value = self.adler32_inttohex(self._running)
+        return self.value
+
+    @staticmethod
+    def adler32_zeros(a32_int, length):
+        """Return the adler32 value after length zero bytes, in O(1): the sum a is unchanged, 
+        and a is added to the sum b for each byte."""
+        a = a32_int & 0xffff
+        b = (a32_int >> 16) + (length % ADLER32_MOD) * a
+        return ((b % ADLER32_MOD) << 16) | a
+
+    @staticmethod
+    def adler32_update(a32_int, buf):
+        """Return the adler32 value after buf, which is either bytes or a ZeroRun"""
+        if isinstance(buf, ZeroRun):
+            return adler32.adler32_zeros(a32_int, len(buf))
+        return zlib.adler32(buf, a32_int)
+
     @staticmethod
     def adler32_inttohex(a32_int):
         """Convert the integer value of adler32 into a lowercase hex string.
@@ -36,7 +91,7 @@ class adler32():
         Final value is converted to hex string, stored internally and returned.
 
     Parameters:
-        buffer: itterable input of data chunks in bytes
+        buffer: itterable input of data chunks in bytes, or ZeroRun for runs of zeros
         
     Returns:
         Checksum: adler32 value in lowercase hex 
@@ -46,7 +101,7 @@ class adler32():
         counter = 0
         for buf in buffer:
             # need to consider intra-file chunks
-            value = zlib.adler32( buf, value)
+            value = self.adler32_update(value, buf)
             bytes_read += len(buf)
             counter += 1
             if self.log_each_step:
@@ -0,0 +1,292 @@
+import logging
+import asyncio
+import errno, math, zlib
+
+import rados
+import XrdCks
+import adler32
+import cephtools
+
+# asyncio versions of the actions, for use within an event loop.
+# librados aio completions are bridged onto the loop, so many metadata lookups and streaming checksums
+# can share one event loop, one cluster handle and one ioctx.
+
+chunk0=f'.{0:016x}' # Chunks are hex valued
+CMPXATTR_OP_EQ=1 # LIBRADOS_CMPXATTR_OP_EQ
+
+
+def _errno_to_exception(ret, message):
+    """Convert a negative return value from a completion into the matching rados exception"""
+    exceptions = {errno.ENOENT: rados.ObjectNotFound,
+                  errno.ENODATA: rados.NoData,
+                  errno.EEXIST: rados.ObjectExists,
+                  }
+    exc = exceptions.get(-ret, rados.Error)
+    return exc(f'{message}: {ret}', errno=-ret)
+
+
+class AsyncIoctx:
+    """Wrap a librados ioctx, to await the aio operations from an event loop.
+
+    At most max_metadata stat/xattr operations, and max_streams checksum calculations (each with up to
+    prefetch reads in flight) are running at the same time; further requests wait for a free slot.
+    Cancelling an awaiting task cancels the pending operation where the bindings allow it.
+    Create within the running event loop (the semaphores belong to the loop on older python versions).
+    """
+    def __init__(self, ioctx, max_metadata=1000, max_streams=32, prefetch=2):
+        self.ioctx = ioctx
+        self.prefetch = prefetch
+        self.metadata_slots = asyncio.Semaphore(max_metadata)
+        self.stream_slots = asyncio.Semaphore(max_streams)
+
+    async def _submit(self, name, start):
+        """Start an aio operation with start(oncomplete), and await the callback result values"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def resolve(completion, result):
+            if future.done():
+                return # cancelled while waiting
+            ret = completion.get_return_value()
+            if ret < 0:
+                future.set_exception(_errno_to_exception(ret, name))
+            else:
+                future.set_result(result)
+
+        def oncomplete(completion, *result):
+            # called from a librados thread; the loop may have gone away if the operation was cancelled
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(resolve, completion, result)
+
+        completion = start(oncomplete)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Completion.cancel is not available in all versions of the bindings
+            cancel = getattr(completion, 'cancel', None)
+            if cancel is not None:
+                cancel()
+            raise
+
+    async def stat(self, oid):
+        async with self.metadata_slots:
+            size, mtime = await self._submit(f'stat {oid}',
+                                lambda cb: self.ioctx.aio_stat(oid, cb))
+        return size, mtime
+
+    async def get_xattr(self, oid, xattr_name):
+        async with self.metadata_slots:
+            value, = await self._submit(f'getxattr {oid} {xattr_name}',
+                                lambda cb: self.ioctx.aio_getxattr(oid, xattr_name, cb))
+        return value
+
+    async def set_xattr(self, oid, xattr_name, xattr_value):
+        async with self.metadata_slots:
+            await self._submit(f'setxattr {oid} {xattr_name}',
+                                lambda cb: self.ioctx.aio_setxattr(oid, xattr_name, xattr_value, cb))
+        return True
+
+    async def write_xattr(self, oid, xattr_name, xattr_value, force=False):
+        """Set the xattr with a single write operation; unless force, guarded by an xattr compare so 
+        that it is only applied if not already set (rados.Error with ECANCELED otherwise).
+        With bindings without the compare, the xattr is checked and set in separate calls (not race free)."""
+        write_op = self.ioctx.create_write_op()
+        if not force and not hasattr(write_op, 'cmpxattr'):
+            self.ioctx.release_write_op(write_op)
+            logging.debug("No cmpxattr in write op; using separate check for %s", oid)
+            return await self._write_xattr_unguarded(oid, xattr_name, xattr_value)
+        if not force:
+            write_op.cmpxattr(xattr_name, CMPXATTR_OP_EQ, b'')
+        write_op.set_xattr(xattr_name, xattr_value)
+        try:
+            async with self.metadata_slots:
+                await self._submit(f'write_op {oid} {xattr_name}',
+                                lambda cb: self.ioctx.operate_aio_write_op(write_op, oid, cb))
+        except asyncio.CancelledError:
+            # the operation may still be in flight; the op cannot be released
+            raise
+        except Exception:
+            self.ioctx.release_write_op(write_op)
+            raise
+        self.ioctx.release_write_op(write_op)
+        return True
+
+    async def _write_xattr_unguarded(self, oid, xattr_name, xattr_value):
+        try:
+            await self.get_xattr(oid, xattr_name)
+        except rados.NoData:
+            return await self.set_xattr(oid, xattr_name, xattr_value)
+        raise rados.Error(f'write_op {oid} {xattr_name}: already set', errno=errno.ECANCELED)
+
+    async def read(self, oid, length, offset=0):
+        data, = await self._submit(f'read {oid}',
+                                lambda cb: self.ioctx.aio_read(oid, length, offset, cb))
+        return data
+
+
+async def retrieve_xattr(aioctx, path, xattr_name='XrdCks.adler32'):
+    """Retrieve, if set, the xattr on chunk0; else None"""
+    oid = path + chunk0
+    try:
+        return await aioctx.get_xattr(oid, xattr_name)
+    except rados.ObjectNotFound:
+        logging.debug("No chunk found: %s", oid)
+    except rados.NoData:
+        logging.debug("No metadata stored for %s %s",xattr_name, oid)
+    return None
+
+
+async def get_striper_xattrs(aioctx, path):
+    """Returns tuple of object size, total size, number of stripes and last stripe size; None values if not existing"""
+    object_size, total_size = await asyncio.gather(retrieve_xattr(aioctx, path, "striper.layout.object_size"),
+                                                   retrieve_xattr(aioctx, path, "striper.size"))
+    if object_size is None or total_size is None:
+        return None, None, None, None
+    object_size, total_size = int(object_size), int(total_size)
+    return object_size, total_size, math.ceil(total_size/object_size), total_size % object_size
+
+
+async def get_from_metadata(aioctx, path, xattr_name="XrdCks.adler32"):
+    """Get checksum from metadata only. Returns None or checksum object"""
+    val, striper = await asyncio.gather(retrieve_xattr(aioctx, path, xattr_name),
+                                        get_striper_xattrs(aioctx, path))
+    if val is None:
+        return None
+    cks = XrdCks.XrdCks.from_binary(val)
+    cks.source_type = 'metadata'
+    cks.total_size_bytes = striper[1]
+    logging.info(cks)
+    return cks
+
+
+async def stat_oids(aioctx, oids):
+    """Stat all the oids concurrently. Returns a dict of oid to size, with None for oids that do not exist."""
+    async def size(oid):
+        try:
+            return (await aioctx.stat(oid))[0]
+        except rados.ObjectNotFound:
+            return None
+    return dict(zip(oids, await asyncio.gather(*[size(oid) for oid in oids])))
+
+
+async def discover_stripes(aioctx, path, probes=8):
+    """Find the layout of a file written without the striper metadata, as cephtools.discover_stripes (with the same
+    probe sequence, cephtools.probe_stripes), the stats of each round awaited concurrently.
+    Returns tuple of object size (the size of chunk0), total size, number of stripes and the size of the last stripe;
+    None values if chunk0 does not exist."""
+    rounds = cephtools.probe_stripes(path, probes)
+    sizes = None
+    try:
+        while True:
+            sizes = await stat_oids(aioctx, rounds.send(sizes))
+    except StopIteration as e:
+        return e.value
+
+
+async def _read_stripe(aioctx, oid, object_size, readsize):
+    """Async generator of the buffers in a stripe of (at most) object_size bytes, keeping up to prefetch reads in flight"""
+    pending = []
+    offsets = iter(range(0, object_size, readsize))
+    try:
+        while True:
+            while len(pending) < max(aioctx.prefetch, 1):
+                offset = next(offsets, None)
+                if offset is None:
+                    break
+                pending.append(asyncio.ensure_future(aioctx.read(oid, min(readsize, object_size - offset), offset)))
+            if not pending:
+                return
+            buf = await pending.pop(0)
+            if len(buf) == 0:
+                return
+            yield buf
+            if len(buf) < readsize:
+                # short read, end of the data in this stripe
+                return
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def cks_from_file(aioctx, path, readsize=64*1024*1024):
+    """Calculate checksum from path. Returns None or checksum object
+    Without striper metadata, the stripes are found with discover_stripes.
+    Raise error if the bytes read do not match the striper size"""
+    async with aioctx.stream_slots:
+        loop = asyncio.get_event_loop()
+        try:
+            size, mtime = await aioctx.stat(path + chunk0)
+        except rados.ObjectNotFound:
+            logging.error(f"File {path} not found")
+            return None
+        object_size, total_size, num_stripes, last_stripe_size = await get_striper_xattrs(aioctx, path)
+        if total_size is None:
+            logging.debug(f'No striper metadata for {path}; discovering the stripes')
+            object_size, total_size, num_stripes, last_stripe_size = await discover_stripes(aioctx, path)
+            if total_size is None:
+                logging.error(f"File {path} not found")
+                return None
+
+        value = 1
+        bytes_read = 0
+        for counter in range(num_stripes):
+            oid = path + f'.{counter:016x}'
+            try:
+                async for buf in _read_stripe(aioctx, oid, object_size, readsize):
+                    # zlib releases the GIL for large buffers, so checksum off the event loop
+                    value = await loop.run_in_executor(None, zlib.adler32, buf, value)
+                    bytes_read += len(buf)
+            except rados.ObjectNotFound:
+                break
+
+    if bytes_read != total_size:
+        logging.error(f"Mismatch in bytes read {bytes_read} and striped total size metadata {total_size}")
+        raise IOError(f"Mismatch in bytes read: {path}, {bytes_read}, {total_size}")
+
+    cks = XrdCks.XrdCks.from_mtime('adler32', mtime, adler32.adler32.adler32_inttohex(value))
+    cks.source_type = 'file'
+    cks.total_size_bytes = total_size
+    logging.info(cks)
+    return cks
+
+
+async def cks_write_metadata(aioctx, path, xattr_name, xattr_value, force_overwrite=False):
+    """Write into the xattr, with a single write operation. Unless force_overwrite, raise ValueError if already existing"""
+    try:
+        return await aioctx.write_xattr(path + chunk0, xattr_name, xattr_value, force_overwrite)
+    except rados.Error as e:
+        if not force_overwrite and getattr(e, 'errno', None) == errno.ECANCELED:
+            logging.info(f'{path}: Xattr existing {xattr_name} and force not set')
+            raise ValueError(f"Xattr {xattr_name} already existing for {path}")
+        raise
+
+
+async def get_checksum(aioctx, path, readsize=64*1024*1024, xattr_name="XrdCks.adler32"):
+    """Get checksum info from metadata; else from the file. Nothing is written to metadata"""
+    xrdcks = await get_from_metadata(aioctx, path, xattr_name)
+    if xrdcks is None:
+        xrdcks = await cks_from_file(aioctx, path, readsize)
+    return xrdcks
+
+
+async def inget(aioctx, path, readsize=64*1024*1024, xattr_name="XrdCks.adler32", rewriteto_littleendian=True):
+    """Return a checksum; if in metadata, just return that. If no metadata, obtain from file and store metadata.
+    If rewriteto_littleendian and metadata was stored in big endian; write it back as little endian
+    """
+    source = 'metadata'
+    xrdcks = await get_from_metadata(aioctx, path, xattr_name)
+
+    if rewriteto_littleendian and xrdcks is not None and xrdcks.read_format == 'big':
+        logging.debug(f'Rewriting to little endian {path}')
+        await cks_write_metadata(aioctx, path, xattr_name, xrdcks.to_binary(), force_overwrite=True)
+
+    if xrdcks is None:
+        source = 'file'
+        xrdcks = await cks_from_file(aioctx, path, readsize)
+        if xrdcks is None:
+            logging.warning(f"No checksum possible for {path} from file")
+            return None
+        await cks_write_metadata(aioctx, path, xattr_name, xrdcks.to_binary(), force_overwrite=False)
+
+    logging.info(f'Path:{path}; From:{source}; Checksum:{xrdcks.get_cksum_as_hex()}')
+    return xrdcks
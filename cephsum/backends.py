@@ -0,0 +1,282 @@
+import logging
+import os, mmap, time
+
+import XrdCks
+import adler32
+import pagecrc
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available; only the non-rados backends can be used
+    cephtools = None
+
+
+# Storage backends used by the actions.
+# A backend provides stat, xattr get/set, stripe enumeration and ranged reads for a path;
+# the checksum operations are built on top of these, and can be overridden with more efficient versions.
+
+
+class Backend:
+    """Interface for the storage operations needed by the actions.
+    Subclasses implement the basic operations; the checksum operations use these by default.
+    """
+    name = 'base'
+
+    def stat(self, path):
+        """Return size and mtime (as time.struct_time) of the file (or its first stripe)"""
+        raise NotImplementedError()
+
+    def get_xattr(self, path, xattr_name):
+        """Return the value (bytes) of the xattr, or None if not set or file not existing"""
+        raise NotImplementedError()
+
+    def set_xattr(self, path, xattr_name, xattr_value, force=False):
+        """Write value into xattr name. If attribute already exists, only overwrite if force is True.
+        returns True if ok, else raise exception (ValueError if existing)
+        """
+        raise NotImplementedError()
+
+    def get_stripes(self, path, stripe_count=None):
+        """Return an iterable of the ordered stripe names for the path"""
+        raise NotImplementedError()
+
+    def read(self, stripe, length, offset=0):
+        """Read up to length bytes at offset from the stripe"""
+        raise NotImplementedError()
+
+    def get_striper_xattrs(self, path):
+        """Returns tuple of object size, total size, number of stripes and last stripe size.
+        If not existing, None values are used for each element.
+        """
+        raise NotImplementedError()
+
+    def check_structure(self, path):
+        """Return a list of problems with the layout of the file on storage, found without reading data"""
+        return []
+
+    def read_file_bytes(self, path, object_size=None, number_of_stripes=None, readsize=64*1024*1024):
+        """Yield all bytes in a file, looping over the stripes, and then ranged reads within each stripe."""
+        for stripe in self.get_stripes(path, number_of_stripes):
+            offset = 0
+            read_length = readsize if object_size is None else min(readsize, object_size)
+            while True:
+                buf = self.read(stripe, read_length, offset)
+                if len(buf) == 0:
+                    break
+                offset += len(buf)
+                yield buf
+                if len(buf) < read_length or (object_size is not None and offset >= object_size):
+                    break
+
+    def cks_from_metadata(self, path, xattr_name):
+        """Get checksum from metadata only. Returns None or checksum object"""
+        val = self.get_xattr(path, xattr_name)
+        if val is None:
+            return None
+        rados_object_size, total_size, num_stripes, last_stripe_size = self.get_striper_xattrs(path)
+
+        cks = XrdCks.XrdCks.from_binary(val)
+        cks.source_type = 'metadata'
+        cks.total_size_bytes = total_size
+        return cks
+
+    def cks_write_metadata(self, path, xattr_name, xattr_value, force_overwrite=False):
+        """Write the checksum into the xattr. Only overwrite an existing value if force_overwrite"""
+        return self.set_xattr(path, xattr_name, xattr_value, force_overwrite)
+
+    def cks_from_file(self, path, readsize):
+        """Calculate checksum from path. Returns None or checksum object"""
+        try:
+            size, mtime = self.stat(path)
+        except FileNotFoundError:
+            logging.error(f"File {path} not found")
+            return None
+        rados_object_size, total_size, num_stripes, last_stripe_size = self.get_striper_xattrs(path)
+
+        cks_alg = adler32.adler32('adler32')
+        cks_hex = cks_alg.calc_checksum( self.read_file_bytes(path, rados_object_size, num_stripes, readsize) )
+        if cks_alg.bytes_read != total_size:
+            logging.error(f"Mismatch in bytes read {cks_alg.bytes_read} and total size {total_size}")
+            raise IOError(f"Mismatch in bytes read: {path}, {cks_alg.bytes_read}, {total_size}")
+
+        cks = XrdCks.XrdCks.from_mtime('adler32', mtime, cks_hex)
+        cks.source_type = 'file'
+        cks.total_size_bytes = total_size
+        return cks
+
+    def cks_verify(self, path, readsize, xattr_name, force_fileread=False):
+        """Return the stored checksum, and that calculated from the file (only if one is stored, or force_fileread);
+        each None if not available"""
+        stored = self.cks_from_metadata(path, xattr_name)
+        if stored is None and not force_fileread:
+            return None, None
+        return stored, self.cks_from_file(path, readsize)
+
+    def cks_from_stream(self, path, cks_hex, bytes_read):
+        """Create the checksum object for a file whose checksum was calculated from the written data stream."""
+        try:
+            size, mtime = self.stat(path)
+        except FileNotFoundError:
+            logging.error(f"File {path} not found")
+            return None
+        rados_object_size, total_size, num_stripes, last_stripe_size = self.get_striper_xattrs(path)
+        if bytes_read != total_size:
+            logging.error(f"Mismatch in bytes streamed {bytes_read} and total size {total_size}")
+            raise IOError(f"Mismatch in bytes streamed: {path}, {bytes_read}, {total_size}")
+
+        cks = XrdCks.XrdCks.from_mtime('adler32', mtime, cks_hex)
+        cks.source_type = 'transfer'
+        cks.total_size_bytes = total_size
+        return cks
+
+
+class RadosBackend(Backend):
+    """Objects in a ceph pool, via the librados ioctx; uses the cephtools functions.
+    If reader (e.g. a cephtools.HedgedReader) is given, data reads are made through it.
+    If sparse, missing or short stripes within the striper size are holes, read as zeros.
+    If page_crcs is 'xattr' or 'sidecar', the page crc32c of each stripe are calculated with the checksum of the file data,
+    and stored in a stripe xattr or sidecar object (see pagecrc).
+    """
+    name = 'rados'
+
+    def __init__(self, ioctx, reader=None, sparse=False, page_crcs=None):
+        if cephtools is None:
+            raise ImportError("The librados python bindings are needed for the rados backend")
+        self.ioctx = ioctx
+        self.reader = reader
+        self.sparse = sparse
+        if page_crcs not in (None, 'xattr', 'sidecar'):
+            raise ValueError(f"Expected page_crcs of 'xattr' or 'sidecar', got {page_crcs}")
+        if page_crcs is not None and not pagecrc.ACCELERATED:
+            logging.warning('The crc32c package is not installed; the page checksums are calculated in python, '
+                            'at a few MB/s')
+        self.page_crcs = page_crcs
+
+    def stat(self, path):
+        return cephtools.stat(self.ioctx, path)
+
+    def get_xattr(self, path, xattr_name):
+        return cephtools.retrieve_xattr(self.ioctx, path, xattr_name)
+
+    def set_xattr(self, path, xattr_name, xattr_value, force=False):
+        return cephtools.write_xattr(self.ioctx, path, xattr_name, xattr_value, force)
+
+    def get_stripes(self, path, stripe_count=None):
+        return cephtools.get_chunks(self.ioctx, path, stripe_count)
+
+    def read(self, stripe, length, offset=0):
+        if self.reader is not None:
+            return self.reader.read(stripe, length, offset)
+        return self.ioctx.read(stripe, length, offset)
+
+    def get_striper_xattrs(self, path):
+        return cephtools.get_striper_xattrs(self.ioctx, path)
+
+    def check_structure(self, path):
+        return cephtools.check_structure(self.ioctx, path, allow_holes=self.sparse)
+
+    def read_file_bytes(self, path, object_size=None, number_of_stripes=None, readsize=64*1024*1024):
+        return cephtools.read_file_btyes(self.ioctx, path, object_size, number_of_stripes, readsize, self.reader)
+
+    def cks_from_metadata(self, path, xattr_name):
+        return cephtools.cks_from_metadata(self.ioctx, path, xattr_name)
+
+    def cks_write_metadata(self, path, xattr_name, xattr_value, force_overwrite=False):
+        return cephtools.cks_write_metadata(self.ioctx, path, xattr_name, xattr_value, force_overwrite)
+
+    def cks_from_file(self, path, readsize):
+        if self.page_crcs is None:
+            return cephtools.cks_from_file(self.ioctx, path, readsize, self.reader, sparse=self.sparse)
+        pages = pagecrc.PageCrcBuilder()
+        cks = cephtools.cks_from_file(self.ioctx, path, readsize, self.reader, sparse=self.sparse, pages=pages)
+        if cks is not None and pages.stripes:
+            try:
+                pagecrc.store(self.ioctx, path, pages, sidecar=self.page_crcs == 'sidecar')
+            except Exception as e:
+                # the page checksums are an addition; the file checksum stands without them
+                logging.warning(f'Could not store the page checksums of {path}: {e}')
+        return cks
+
+    def cks_verify(self, path, readsize, xattr_name, force_fileread=False):
+        return cephtools.cks_verify(self.ioctx, path, readsize, xattr_name, self.reader, self.sparse, force_fileread)
+
+    def cks_from_stream(self, path, cks_hex, bytes_read):
+        return cephtools.cks_from_stream(self.ioctx, path, cks_hex, bytes_read)
+
+
+class PosixBackend(Backend):
+    """Files in a (local, or e.g. CephFS mounted) filesystem below root.
+    Each file is a single 'stripe'; xattrs are stored with the xattr_prefix (user. namespace by default)
+    in the same XrdCks binary format. Data is checksummed directly from an mmap of the file.
+    """
+    name = 'posix'
+
+    def __init__(self, root='/', xattr_prefix='user.'):
+        self.root = root
+        self.xattr_prefix = xattr_prefix
+
+    def _filename(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def stat(self, path):
+        st = os.stat(self._filename(path))
+        return st.st_size, time.localtime(st.st_mtime)
+
+    def get_xattr(self, path, xattr_name):
+        try:
+            return os.getxattr(self._filename(path), self.xattr_prefix + xattr_name)
+        except FileNotFoundError:
+            logging.debug("No file found: %s", path)
+        except OSError as e:
+            logging.debug("No metadata stored for %s %s: %s", xattr_name, path, e)
+        return None
+
+    def set_xattr(self, path, xattr_name, xattr_value, force=False):
+        try:
+            os.setxattr(self._filename(path), self.xattr_prefix + xattr_name, xattr_value,
+                        0 if force else os.XATTR_CREATE)
+        except FileExistsError:
+            logging.info(f'{path}: Xattr existing {xattr_name} and force not set')
+            raise ValueError(f"Xattr {xattr_name} already existing for {path}")
+        return True
+
+    def get_stripes(self, path, stripe_count=None):
+        return [self._filename(path)]
+
+    def read(self, stripe, length, offset=0):
+        with open(stripe, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get_striper_xattrs(self, path):
+        size, mtime = self.stat(path)
+        return size, size, 1, 0
+
+    def read_file_bytes(self, path, object_size=None, number_of_stripes=None, readsize=64*1024*1024):
+        """Yield memoryview slices of an mmap of the file; no data is copied"""
+        with open(self._filename(path), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, size, readsize):
+                        buf = view[offset:offset+readsize]
+                        try:
+                            yield buf
+                        finally:
+                            # the mmap can only be closed once no views are left
+                            buf.release()
+                finally:
+                    view.release()
+
+
+def as_backend(ioctx):
+    """Return ioctx if already a Backend, else wrap a librados ioctx in the RadosBackend"""
+    if isinstance(ioctx, Backend):
+        return ioctx
+    return RadosBackend(ioctx)
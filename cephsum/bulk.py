@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Run a checksum action over many files in a pool, e.g. from a plan written by plan.py
+
+
+import logging,argparse
+import sys, os, time, math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import actions
+import adaptive
+import backends
+import osdmap
+import plan as planner
+import scheduler as priority
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available
+    cephtools = None
+
+
+def run_one(ioctx, path, action, readsize, xattr_name="XrdCks.adler32", scheduler=None):
+    """Run the action for one path; returns the checksum object, or None if failed.
+    If scheduler (a scheduler.PriorityScheduler) is given, the reads are scheduled in its background class."""
+    if action == 'inget' and scheduler is not None:
+        return scheduler.inget(ioctx, path, 'background', readsize, xattr_name)
+    elif action == 'inget':
+        return actions.inget(ioctx, path, readsize, xattr_name)
+    elif action == 'verify' and scheduler is not None:
+        return scheduler.verify(ioctx, path, 'background', readsize, xattr_name)
+    elif action == 'verify':
+        return actions.verify(ioctx, path, readsize, xattr_name)
+    raise NotImplementedError(f'Action {action} is not implemented for bulk runs')
+
+
+def run_paths(ioctx, paths, action='inget', readsize=64*1024*1024, workers=4, xattr_name="XrdCks.adler32", scheduler=None,
+              controller=None):
+    """Run the action over all paths with workers threads.
+    Returns a dict with counts of done and failed files, bytes read from file, elapsed seconds,
+    the throughput (bytes read per second) and the list of failed paths.
+    scheduler (a scheduler.PriorityScheduler) shares the reads with other work in the same process, or of the host, as background.
+    If controller (an adaptive.AimdController) is given, the number of files in flight is its setpoint instead, with
+    up to its ceiling of threads; its reads should be observed (e.g. ioctx a RadosBackend with an adaptive.ObservedReader).
+    """
+    results = {'done': 0, 'failed': 0, 'bytes_read': 0, 'failed_paths': []}
+    lock = threading.Lock()
+
+    def process(path):
+        if controller is not None:
+            with controller.slot():
+                return run(path)
+        return run(path)
+
+    def run(path):
+        try:
+            xrdcks = run_one(ioctx, path, action, readsize, xattr_name, scheduler)
+        except Exception as e:
+            logging.warning(f'{action} failed for {path}: {e}')
+            xrdcks = None
+        with lock:
+            if xrdcks is None:
+                results['failed'] += 1
+                results['failed_paths'].append(path)
+            else:
+                results['done'] += 1
+                if xrdcks.source_type == 'file' or action == 'verify':
+                    results['bytes_read'] += xrdcks.total_size_bytes or 0
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers if controller is None else controller.ceiling) as executor:
+        for _ in executor.map(process, paths):
+            pass
+    results['seconds'] = time.monotonic() - start
+    results['throughput_bytes_per_s'] = results['bytes_read'] / results['seconds'] if results['seconds'] > 0 else None
+    return results
+
+
+def ab_compare(ioctx, readers, paths, readsize=64*1024*1024, workers=4, files_per_round=10, rounds=2):
+    """Compare the read throughput of readers, a dict of name to reader (e.g. ioctxs from connections with different
+    replica read policies; None to read from ioctx itself), by checksumming files from paths. Nothing is written.
+    In each round, each reader reads its own files_per_round files (so that none benefits from data cached for another),
+    with the order of the readers alternating between rounds.
+    Returns a dict of name to a dict of files, failed, bytes, seconds, throughput and per-file latency percentiles.
+    """
+    names = list(readers)
+    arms = {name: {'files': 0, 'failed': 0, 'bytes': 0, 'seconds': 0., 'latencies': []} for name in names}
+    groups = [paths[i:i+files_per_round] for i in range(0, len(paths), files_per_round)]
+
+    def read(path, reader):
+        start = time.monotonic()
+        try:
+            xrdcks = cephtools.cks_from_file(ioctx, path, readsize, reader, preflight=False)
+        except Exception as e:
+            logging.warning(f'Read of {path} failed: {e}')
+            xrdcks = None
+        return time.monotonic() - start, None if xrdcks is None else xrdcks.total_size_bytes
+
+    for round_number in range(rounds):
+        order = names if round_number % 2 == 0 else names[::-1]
+        for k, name in enumerate(order):
+            index = round_number*len(names) + k
+            if index >= len(groups):
+                logging.warning(f'Not enough files for {rounds} rounds of {files_per_round} files per reader')
+                break
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda path: read(path, readers[name]), groups[index]))
+            arm = arms[name]
+            arm['seconds'] += time.monotonic() - start
+            for latency, size in results:
+                if size is None:
+                    arm['failed'] += 1
+                    continue
+                arm['files'] += 1
+                arm['bytes'] += size
+                arm['latencies'].append(latency)
+
+    for arm in arms.values():
+        latencies = sorted(arm.pop('latencies'))
+        arm['throughput_bytes_per_s'] = arm['bytes'] / arm['seconds'] if arm['seconds'] > 0 else None
+        for pct in [50, 99]:
+            arm[f'latency_p{pct}_s'] = latencies[max(0, math.ceil(len(latencies) * pct / 100.) - 1)] if latencies else None
+    return arms
+
+
+def run_plan(ioctx, plan, readsize=64*1024*1024, workers=4, controller=None, scheduler=None):
+    """Run the action of a plan (see plan.py) over its paths; see run_paths for scheduler and controller"""
+    if plan['sample_fraction'] < 1:
+        logging.warning(f"Plan is from a sample of {plan['sample_fraction']}; only the sampled paths are processed")
+    return run_paths(ioctx, plan['paths'], plan['action'], readsize, workers, plan['xattr_name'], scheduler=scheduler,
+                     controller=controller)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a checksum action over many files in a pool')
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+    parser.add_argument('-p','--plan',required=True, dest='plan_file', help='Plan file written by plan.py')
+    parser.add_argument('-w','--workers',default=4,type=int, help='Number of files processed concurrently')
+    parser.add_argument('-r','--readsize',default=64,type=int, help='Readsize in MiB')
+    parser.add_argument('--per-osd',default=None, dest='per_osd', type=int,
+                        help='Schedule the reads of all workers by OSD, with at most this many in flight to each')
+    parser.add_argument('--read-policy',default=None, dest='read_policy',
+                        help='Read the data from replicas: balance or localize, for all pools, or per pool as e.g. dteam=balance,atlas=localize')
+    parser.add_argument('--ab',default=None, choices=['balance','localize'],
+                        help='Instead of running the plan, compare the read throughput of the default policy to this one on files of the plan')
+    parser.add_argument('--ab-files',default=10,type=int, dest='ab_files', help='Files read by each policy in each round of --ab')
+    parser.add_argument('--ab-rounds',default=2,type=int, dest='ab_rounds', help='Number of rounds of --ab')
+    parser.add_argument('--adaptive',action='store_true',
+                        help='Adjust the number of files in flight to the read latency and errors, from --workers within --min-workers and --max-workers')
+    parser.add_argument('--min-workers',default=1,type=int, dest='min_workers', help='Floor of the files in flight with --adaptive')
+    parser.add_argument('--max-workers',default=32,type=int, dest='max_workers', help='Ceiling of the files in flight with --adaptive')
+    parser.add_argument('--target-latency',default=None,type=float, dest='target_latency',
+                        help='With --adaptive, reduce the files in flight when the median read latency exceeds this many seconds per MiB; '
+                             'by default twice the lowest latency seen')
+    parser.add_argument('--setpoint-file',default=None, dest='setpoint_file',
+                        help='With --adaptive, write the current setpoint (json) to this file at the start and when it changes')
+    parser.add_argument('--jobs-dir',default='', dest='jobs_dir',
+                        help=f'Register the run as background work in this directory (e.g. {priority.DEFAULT_JOBS_DIR}), pause reading at each stripe '
+                             'boundary while interactive requests (cephsum.py --jobs-dir) run on this host, and leave the other classes '
+                             'running on the host their weighted share of the reads; off by default')
+    parser.add_argument('--weights',default='',
+                        help='Weights of the classes of work sharing the reads of the host with --jobs-dir, '
+                             'as e.g. interactive=8,transfer=4,background=1 (the default)')
+    parser.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file')
+    parser.add_argument('--keyring',default='/etc/ceph/ceph.client.xrootd.keyring', dest='keyring_file')
+    parser.add_argument('--cephuser',default='client.xrootd', dest='ceph_user')
+
+    args = parser.parse_args()
+    try:
+        weights = priority.parse_weights(args.weights)
+    except ValueError as e:
+        parser.error(str(e))
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    plan = planner.read_plan(args.plan_file)
+    policy = cephtools.read_policy_for(cephtools.parse_read_policies(args.read_policy), plan['pool'])
+    readsize = args.readsize*1024*1024
+    results, arms = None, None
+    cluster = cephtools.cluster_connect(conffile=args.conf_file, keyring=args.keyring_file, name=args.ceph_user)
+    policy_cluster = None
+    try:
+        with cluster.open_ioctx(plan['pool']) as ioctx:
+            # with a replica read policy, the data is read through a second connection; metadata from the primary
+            read_ioctx = ioctx
+            if policy != 'default' or args.ab is not None:
+                policy_cluster = cephtools.cluster_connect(conffile=args.conf_file, keyring=args.keyring_file, name=args.ceph_user,
+                                                           conf={'rados_replica_read_policy': args.ab or policy})
+                read_ioctx = policy_cluster.open_ioctx(plan['pool'])
+
+            # background work: yields to the interactive requests registered by the cephsum.py processes of the host,
+            # and shares the reads with the transfer work of spool.py run by weight
+            scheduler = None
+            if args.jobs_dir:
+                scheduler = priority.PriorityScheduler(weights, max_reads=None, host_jobs=priority.HostJobs(args.jobs_dir))
+
+            controller = None
+            if args.adaptive:
+                controller = adaptive.AimdController(args.min_workers, args.max_workers, args.workers,
+                                                     target_latency=args.target_latency, export_file=args.setpoint_file)
+
+            if args.ab is not None:
+                arms = ab_compare(ioctx, {'default': None, args.ab: read_ioctx}, plan['paths'], readsize, args.workers,
+                                  args.ab_files, args.ab_rounds)
+            elif args.per_osd is not None:
+                osd_scheduler = osdmap.OsdScheduler(read_ioctx, osdmap.OsdMap(cluster, plan['pool']), max_per_osd=args.per_osd,
+                                                    replicas=policy != 'default')
+                # the reads in flight follow the setpoint, at the reads each file submits ahead (see cephtools.read_file_scheduled)
+                reader = osd_scheduler if controller is None else adaptive.ObservedReader(
+                    controller, read_ioctx, osd_scheduler, reads_per_file=math.ceil(256*1024*1024 / readsize))
+                results = run_plan(backends.RadosBackend(ioctx, reader=reader), plan, readsize, args.workers, controller,
+                                   scheduler)
+                logging.debug(f'Peak reads in flight per OSD: { {osd: float(load) for osd, load in osd_scheduler.peak_inflight.items()} }')
+            elif controller is not None:
+                results = run_plan(backends.RadosBackend(ioctx, reader=adaptive.ObservedReader(controller, read_ioctx)),
+                                   plan, readsize, args.workers, controller, scheduler)
+            elif read_ioctx is not ioctx:
+                results = run_plan(backends.RadosBackend(ioctx, reader=read_ioctx), plan, readsize, args.workers,
+                                   scheduler=scheduler)
+            else:
+                results = run_plan(ioctx, plan, readsize, args.workers, scheduler=scheduler)
+            if scheduler is not None and scheduler.yields:
+                logging.info(f'Yielded to interactive requests {scheduler.yields} times')
+            if controller is not None:
+                logging.info(f'Adaptive concurrency: {controller.stats()}')
+    finally:
+        if policy_cluster is not None:
+            policy_cluster.shutdown()
+        cluster.shutdown()
+
+    if arms is not None:
+        for name, arm in arms.items():
+            sys.stdout.write(f'{name}: ' + ', '.join(f'{k}:{v}' for k, v in arm.items()) + '\n')
+        baseline, other = arms['default']['throughput_bytes_per_s'], arms[args.ab]['throughput_bytes_per_s']
+        if baseline and other:
+            sys.stdout.write(f'throughput {args.ab}/default: {other/baseline:.3f}\n')
+        sys.exit(0)
+
+    logging.info(f"Bulk {plan['action']}: pool:{plan['pool']}, done:{results['done']}, failed:{results['failed']}, "\
+                 f"bytes:{results['bytes_read']}, time_s:{results['seconds']}, throughput:{results['throughput_bytes_per_s']}")
+    for path in results['failed_paths']:
+        sys.stdout.write(f'{path}\n')
+    sys.exit(0 if results['failed'] == 0 else 1)
@@ -8,17 +8,28 @@ import sys, os,re
 from datetime import datetime
 import functools
 
-import rados
 import XrdCks
 import adler32
-import cephtools
 import lfn2pfn
 import actions
+import backends
+import osdmap
+import pagecrc
+import progress
+import repairs
+import scheduler
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available; only --posixroot can be used
+    cephtools = None
 
 ERRCODE_OK = 0
 ERRCODE_MISMATCH_SOURCE = 101
 ERRCODE_NO_CHECKSUM     = 102
 ERRCODE_FAILED_VERIFY   = 103
+ERRCODE_BAD_STRUCTURE   = 104
 
 
 def convert_path(path, xmlfile=None):
@@ -79,6 +90,7 @@ if __name__ == "__main__":
     \nfileonly:    Get checksum, from file only
     \nverify:      Calculate checksum from file and compares to metadata value (if not in metadata, fail). If --source is given, also compare to source value
     \ncheck:       Requires --source value; if not in metadata, calculate and insert to metadata if matches.  
+    \nstructure:   Check that all stripes exist, with sizes matching the striper metadata, without reading data.
                         """)
 
     parser.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file', 
@@ -87,12 +99,39 @@ if __name__ == "__main__":
                         help='location of the ceph keyring file, if different from default')
     parser.add_argument('--cephuser',default='client.xrootd', dest='ceph_user', 
                         help='ceph user name for the client keyring')
+    parser.add_argument('--hedge',action='store_true', dest='hedge',
+                        help='Duplicate slow data reads (slower than the 95th percentile of recent reads) through a second connection using balanced replica reads')
+    parser.add_argument('--deadline',default=None, dest='deadline', type=float,
+                        help='Fail if reading the file data takes longer than this many seconds')
+    parser.add_argument('--read-policy',default=None, dest='read_policy',
+                        help='Read the data from replicas: balance or localize, for all pools, or per pool as e.g. dteam=balance,atlas=localize')
+    parser.add_argument('--per-osd',default=None, dest='per_osd', type=int,
+                        help='Read the stripes in parallel, with at most this many reads in flight to each primary OSD; not with --hedge or --deadline')
+    parser.add_argument('--sparse',action='store_true', dest='sparse',
+                        help='Treat missing or short stripes within the striper size as holes (zeros), rather than as a broken file')
+    parser.add_argument('--repair-journal',default=None, dest='repair_journal',
+                        help='Journal metadata repairs (rewrite of big endian xattrs) in this database, for repairs.py run to apply later, rather than writing them before answering')
+    parser.add_argument('--page-crcs',default=None, dest='page_crcs', choices=['xattr','sidecar'],
+                        help='When reading the file data, also store the crc32c of each 4 KiB page of each stripe, in a stripe xattr or a sidecar object')
+    parser.add_argument('--progress-dir',default='', dest='progress_dir',
+                        help=f'Publish the progress of file reads in this directory for top.py, e.g. {progress.DEFAULT_REGISTRY}; off by default')
+    parser.add_argument('--jobs-dir',default='', dest='jobs_dir',
+                        help=f'Register the request as interactive work in this directory (e.g. {scheduler.DEFAULT_JOBS_DIR}) while it runs, '
+                             'for the background and transfer runs on the host to yield to; off by default')
+    parser.add_argument('--posixroot',default=None, dest='posix_root', 
+                        help='Use files below this directory (e.g. a CephFS mount or local disk) instead of the rados pool. xattrs are stored in the user. namespace')
 
 
     # actual path to use, as a positional argument; only one allowed
     parser.add_argument('path', nargs=1)
 
     args = parser.parse_args()
+    if args.page_crcs is not None and not pagecrc.ACCELERATED:
+        # the pure python crc32c would slow every file read to a few MB/s
+        parser.error('--page-crcs needs the crc32c package (pip install cephsum[pgcrc])')
+    if args.per_osd is not None and (args.hedge or args.deadline is not None):
+        # the reads scheduled by OSD are not hedged, nor bounded by a deadline
+        parser.error('--per-osd cannot be combined with --hedge or --deadline')
 
     logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
                     filename=None if args.logfile is None else args.logfile,
@@ -140,30 +179,107 @@ if __name__ == "__main__":
     timestart = datetime.now()
 
 
-    cluster = cephtools.cluster_connect(conffile=args.conf_file, 
-                                        keyring=args.keyring_file,
-                                        name=args.ceph_user)
-    try:
-        with cluster.open_ioctx(pool) as ioctx:
-            if args.action in ['inget','check']:
-                xrdcks = actions.inget(ioctx,path,readsize,xattr_name)
-            elif args.action == 'verify':
-                xrdcks = actions.verify(ioctx,path,readsize,xattr_name)
-            elif args.action == 'get':
-                xrdcks = actions.get_checksum(ioctx,path,readsize, xattr_name)
-            elif args.action == 'metaonly':
-                xrdcks = actions.get_from_metatdata(ioctx,path,xattr_name)
-            elif args.action == 'fileonly':
-                xrdcks = actions.get_from_file(ioctx,path, readsize)    
-            else:
-                logging.warning(f'Action {args.action} is not implemented')
-                raise NotImplementedError(f'Action {args.action} is not implemented')
-    finally:
-        cluster.shutdown()
+    defer = None
+    if args.repair_journal is not None:
+        defer = functools.partial(repairs.RepairJournal(args.repair_journal).record, pool)
+
+    # register the request while it runs, so that background reads on this host (e.g. bulk.py) yield to it
+    host_jobs = scheduler.HostJobs(args.jobs_dir) if args.jobs_dir else None
+
+    def run_action(ioctx):
+        if host_jobs is None:
+            return dispatch_action(ioctx)
+        with host_jobs.job(scheduler.INTERACTIVE):
+            return dispatch_action(ioctx)
+
+    def dispatch_action(ioctx):
+        if args.action in ['inget','check']:
+            return actions.inget(ioctx,path,readsize,xattr_name, defer=defer)
+        elif args.action == 'verify':
+            return actions.verify(ioctx,path,readsize,xattr_name)
+        elif args.action == 'get':
+            return actions.get_checksum(ioctx,path,readsize, xattr_name)
+        elif args.action == 'metaonly':
+            return actions.get_from_metatdata(ioctx,path,xattr_name)
+        elif args.action == 'fileonly':
+            return actions.get_from_file(ioctx,path, readsize)    
+        elif args.action == 'structure':
+            return actions.check_structure(ioctx,path)
+        else:
+            logging.warning(f'Action {args.action} is not implemented')
+            raise NotImplementedError(f'Action {args.action} is not implemented')
+
+    if args.posix_root is not None:
+        xrdcks = run_action(backends.PosixBackend(args.posix_root))
+    else:
+        cluster = cephtools.cluster_connect(conffile=args.conf_file, 
+                                            keyring=args.keyring_file,
+                                            name=args.ceph_user)
+        policy = cephtools.read_policy_for(cephtools.parse_read_policies(args.read_policy), pool)
+        policy_cluster, hedge_cluster, reader = None, None, None
+        progress_record = progress.Progress(args.action, pool, path, registry=args.progress_dir) if args.progress_dir else None
+        try:
+            with cluster.open_ioctx(pool) as ioctx:
+                def observed(read_from, inner=None):
+                    # the reader of the backend, publishing its progress if enabled
+                    if progress_record is None:
+                        return inner if read_from is ioctx else read_from
+                    return progress.ProgressReader(progress_record, read_from, inner)
+
+                # with a replica read policy, the data is read through a second connection; metadata from the primary
+                read_ioctx = ioctx
+                if policy != 'default':
+                    policy_cluster = cephtools.cluster_connect(conffile=args.conf_file, 
+                                            keyring=args.keyring_file,
+                                            name=args.ceph_user,
+                                            conf={'rados_replica_read_policy':policy})
+                    read_ioctx = policy_cluster.open_ioctx(pool)
+
+                if args.per_osd is not None:
+                    osd_scheduler = osdmap.OsdScheduler(read_ioctx, osdmap.OsdMap(cluster, pool), max_per_osd=args.per_osd,
+                                                        replicas=policy != 'default')
+                    xrdcks = run_action(backends.RadosBackend(ioctx, reader=observed(ioctx, osd_scheduler), sparse=args.sparse,
+                                                              page_crcs=args.page_crcs))
+                    logging.debug(f'Peak reads in flight per OSD: { {osd: float(load) for osd, load in osd_scheduler.peak_inflight.items()} }')
+                elif args.hedge or args.deadline is not None:
+                    hedge_ioctx = None
+                    if args.hedge:
+                        hedge_cluster = cephtools.cluster_connect(conffile=args.conf_file, 
+                                            keyring=args.keyring_file,
+                                            name=args.ceph_user,
+                                            conf={'rados_replica_read_policy':'balance'})
+                        hedge_ioctx = hedge_cluster.open_ioctx(pool)
+                    reader = cephtools.HedgedReader(read_ioctx, hedge_ioctx, deadline=args.deadline)
+                    xrdcks = run_action(backends.RadosBackend(ioctx, reader=observed(ioctx, reader), sparse=args.sparse,
+                                                              page_crcs=args.page_crcs))
+                    logging.debug(f'Hedged reads: {reader.hedges}, won by hedge: {reader.hedge_wins}')
+                else:
+                    xrdcks = run_action(backends.RadosBackend(ioctx, reader=observed(read_ioctx), sparse=args.sparse,
+                                                              page_crcs=args.page_crcs))
+        finally:
+            if progress_record is not None:
+                progress_record.close()
+            if reader is not None:
+                reader.close()
+            if hedge_cluster is not None:
+                hedge_cluster.shutdown()
+            if policy_cluster is not None:
+                policy_cluster.shutdown()
+            cluster.shutdown()
 
     timeend = datetime.now()
     time_delta_seconds = (timeend - timestart).total_seconds()
 
+    if args.action == 'structure':
+        # the result is the list of problems found, rather than a checksum
+        problems = xrdcks
+        exit_code = ERRCODE_OK if not problems else ERRCODE_BAD_STRUCTURE
+        logging.info(f'Result:{"Failed" if exit_code !=0 else "Done"}, pool:{pool}, path:{lfn_path}, time_s:{time_delta_seconds}, '\
+                     f'problems:{len(problems)}, exit_code:{exit_code}')
+        sys.stdout.write(('ok' if not problems else 'broken') + '\n')
+        sys.stdout.flush()
+        sys.exit(exit_code)
+
     xrdcks_hex = "N/A" if xrdcks is None else xrdcks.get_cksum_as_hex()
     exit_code = ERRCODE_OK
 
@@ -1,23 +1,28 @@
 from datetime import date, datetime, timedelta
 import time
 import logging,argparse,math
+import hashlib, errno, itertools
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 
 import XrdCks,adler32
 import rados
 
 chunk0=f'.{0:016x}' # Chunks are hex valued
 nZeros=16
+CMPXATTR_OP_EQ=1 # LIBRADOS_CMPXATTR_OP_EQ
 
 ### Admin operations
 
 def cluster_connect(conffile = '/etc/ceph/ceph.conf',
                  keyring = '/etc/ceph/ceph.client.xrootd.keyring',
-                 name='client.xrootd'):
-    """Open the cluster; remember to call shutdown."""
+                 name='client.xrootd', conf=None):
+    """Open the cluster; remember to call shutdown.
+    conf is a dict of additional client options, e.g. {'rados_replica_read_policy':'balance'}"""
     # TODO can we enable this in a context managed?
 
     try:
-        cluster = rados.Rados(conffile = conffile, conf = dict (keyring = keyring), name=name)
+        cluster = rados.Rados(conffile = conffile, conf = dict (keyring = keyring, **(conf or {})), name=name)
         cluster.connect()
     except Exception as e:
         # Log and re-raise the exception for now
@@ -26,11 +31,31 @@ def cluster_connect(conffile = '/etc/ceph/ceph.conf',
     return cluster
 
 
+READ_POLICIES = ('default', 'balance', 'localize') # values of rados_replica_read_policy
+
+def parse_read_policies(spec):
+    """Parse the replica read policy per pool, e.g. 'balance' for all pools, or 'dteam=balance,atlas=localize'.
+    Returns a dict of pool (with '*' for all other pools) to policy"""
+    policies = {}
+    if not spec:
+        return policies
+    for item in spec.split(','):
+        pool, sep, policy = item.strip().rpartition('=')
+        if policy not in READ_POLICIES:
+            raise ValueError(f"Unknown read policy {policy}; expected one of {READ_POLICIES}")
+        policies[pool if sep else '*'] = policy
+    return policies
+
+
+def read_policy_for(policies, pool):
+    """The read policy for the pool, from the dict of parse_read_policies"""
+    return policies.get(pool, policies.get('*', 'default'))
+
 
 
 ### Object based operations 
 
-def path_exists(path):
+def path_exists(ioctx,path):
     """Return a bool based on stat response of a path+chunk0
     The provided path should not have chunk0, this is appended
     """
@@ -57,21 +82,22 @@ def get_chunks(ioctx,path, stripe_count=None):
             #logging.debug(oid)
             yield oid
         except rados.ObjectNotFound:
-            raise StopIteration
+            return
         counter += 1
         if stripe_count is not None and counter == stripe_count:
             # read all required chunks; stop
-            raise StopIteration
+            return
 
-def read_oid_bytes(ioctx,oid,stripe_size_bytes=None, readsize=64*1024*1024):
+def read_oid_bytes(ioctx,oid,stripe_size_bytes=None, readsize=64*1024*1024, reader=None, offset=0):
     """Yield the bytes in a file, grouped by readsize and offset
+    If reader (e.g. a HedgedReader) is given, reads are made through it, rather than directly from ioctx.
+    Reading starts at offset (e.g. after a first block already read).
     """
-    offset = 0
     # read at most readsize bytes, and stripe_size_bytes if defined
     read_length = readsize if stripe_size_bytes is None else min(readsize,stripe_size_bytes)
     while True:
         try:
-            buf = ioctx.read(oid, read_length, offset)
+            buf = ioctx.read(oid, read_length, offset) if reader is None else reader.read(oid, read_length, offset)
         except Exception as e:
             #logging.error ("Exception in read", exc_info=True)
             raise e
@@ -81,7 +107,7 @@ def read_oid_bytes(ioctx,oid,stripe_size_bytes=None, readsize=64*1024*1024):
         offset = offset + actual_length #TODO actual or expected length to add to offset
         if actual_length == 0:
             # end of chunk
-            raise StopIteration
+            return
 
         # yield buffer here, as something to give back
         yield buf
@@ -89,31 +115,217 @@ def read_oid_bytes(ioctx,oid,stripe_size_bytes=None, readsize=64*1024*1024):
         #must assume we read and of the file, and read a remainder bytes in the last chunk; so we stop
         if actual_length < read_length:
             #FIXME - is the abover acertian always true?
-            raise StopIteration
+            return
 
         # if we know we've read all data in the chunk, stop aleady
         if stripe_size_bytes is not None and offset >= stripe_size_bytes:
             # assumed end of chunk, or we fell of the end?
-            raise StopIteration
+            return
             
 
 
 
-def read_file_btyes(ioctx, path, stripe_size_bytes=None, number_of_stripes=None,readsize=64*1024*1024):
+def read_file_btyes(ioctx, path, stripe_size_bytes=None, number_of_stripes=None,readsize=64*1024*1024, reader=None, start=0):
     """Yield all bytes in a file, looping over chunks, and then bytes with the file.
 
     if stripe_size_bytes is None, will use READSIZE and read each stripe for all data.
     if stripe_size_bytes is given, will assume each chunk is the given size.
+    if number_of_stripes is given (from the striper metadata, or discover_stripes), the stripes are read without
+    a stat of each first; a missing stripe raises rados.ObjectNotFound.
+    The first start bytes of chunk0 are skipped (already read).
     """
-    for oid in get_chunks(ioctx, path, number_of_stripes):
-        for buffer in read_oid_bytes(ioctx, oid, stripe_size_bytes, readsize=readsize):
+    if number_of_stripes is not None:
+        oids = (path + f'.{counter:016x}' for counter in range(number_of_stripes))
+    else:
+        oids = get_chunks(ioctx, path)
+    for index, oid in enumerate(oids):
+        for buffer in read_oid_bytes(ioctx, oid, stripe_size_bytes, readsize=readsize, reader=reader,
+                                     offset=start if index == 0 else 0):
             yield buffer
     # Sanity stop statement at end.
-    raise StopIteration
+    return
+
+
+def read_file_sparse(ioctx, path, object_size, total_size, readsize=64*1024*1024, reader=None, start=0):
+    """Yield all bytes in a file that may have holes, using the layout from the striper metadata.
+    Missing stripes, and the unwritten end of short stripes, within total_size are yielded as adler32.ZeroRun 
+    of their length, rather than being read.
+    The first start bytes of chunk0 are skipped (already read).
+    """
+    skip = start
+    for start in range(0, total_size, object_size):
+        oid = path + f'.{start // object_size:016x}'
+        expected = min(object_size, total_size - start)
+        found = skip if start == 0 else 0
+        try:
+            for buf in read_oid_bytes(ioctx, oid, expected, readsize=readsize, reader=reader, offset=found):
+                found += len(buf)
+                yield buf
+        except rados.ObjectNotFound:
+            logging.debug(f'Hole of {expected} bytes at stripe {oid}')
+        if found < expected:
+            yield adler32.ZeroRun(expected - found)
+
+
+def read_file_scheduled(scheduler, path, object_size, total_size, readsize=64*1024*1024, max_ahead_bytes=256*1024*1024,
+                        start=0):
+    """Yield all bytes in a file in order, with the reads of the following stripes submitted ahead to scheduler 
+    (e.g. an osdmap.OsdScheduler), so that many stripes are read in parallel.
+    The layout is taken from the striper metadata; at most max_ahead_bytes are requested beyond the buffer being yielded.
+    The first start bytes of chunk0 are skipped (already read).
+    """
+    skip = start
+    def stripe_ranges():
+        for start in range(0, total_size, object_size):
+            oid = path + f'.{start // object_size:016x}'
+            stripe_size = min(object_size, total_size - start)
+            for offset in range(skip if start == 0 else 0, stripe_size, readsize):
+                yield oid, offset, min(readsize, stripe_size - offset)
+
+    ranges = stripe_ranges()
+    pending = deque()
+    ahead = 0
+    try:
+        while True:
+            for oid, offset, length in ranges:
+                pending.append((scheduler.submit(oid, length, offset), length))
+                ahead += length
+                if ahead >= max_ahead_bytes:
+                    break
+            if not pending:
+                return
+            future, length = pending.popleft()
+            ahead -= length
+            buf = future.result()
+            yield buf
+            if len(buf) < length:
+                # short read; the byte count will not match the striper size
+                return
+    finally:
+        for future, length in pending:
+            future.cancel()
 
 
 
 
+def aio_read(ioctx, oid, length, offset=0):
+    """Start a read of up to length bytes at offset from oid with aio; returns a concurrent.futures.Future of the data,
+    failing with rados.ObjectNotFound if oid does not exist. Cancelling the Future drops the data when it arrives."""
+    future = Future()
+    def oncomplete(completion, data=None):
+        ret = completion.get_return_value()
+        if future.done():
+            # cancelled; not needed after all
+            return
+        if ret == -errno.ENOENT:
+            future.set_exception(rados.ObjectNotFound(f"Read failed for {oid}: {ret}", errno=-ret))
+        elif ret < 0:
+            future.set_exception(IOError(f"Read failed for {oid} at offset {offset}: {ret}"))
+        else:
+            future.set_result(data)
+    ioctx.aio_read(oid, length, offset, oncomplete)
+    return future
+
+
+class HedgedReader:
+    """Make reads with a deadline, and hedge slow reads with a duplicate request.
+
+    The latency of recent reads is tracked; if a read has not returned within the given percentile
+    of these (and at least min_delay seconds), the same read is issued on hedge_ioctx, and whichever 
+    result arrives first is used. hedge_ioctx should be opened from a cluster connected with 
+    rados_replica_read_policy=balance (see cluster_connect), so that the duplicate can be served by a replica
+    rather than the (slow) primary; if not given, reads are not hedged, and only the deadline applies.
+    If deadline (seconds) is set, all reads must complete within that time from creation, 
+    or from the last call to set_deadline, else TimeoutError is raised.
+
+    Reads are made with aio (see aio_read), and waited for with a timeout; a read that lost the race, or timed out, 
+    is left to librados, and its data dropped, so that no thread is held by it.
+    """
+    def __init__(self, ioctx, hedge_ioctx=None, percentile=95, min_delay=0.05, initial_delay=1.0,
+                 window=200, min_samples=10, deadline=None):
+        self.ioctx = ioctx
+        self.hedge_ioctx = hedge_ioctx
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.set_deadline(deadline)
+
+    def set_deadline(self, deadline):
+        """Set the deadline to deadline seconds from now; None for no deadline"""
+        self.deadline_at = None if deadline is None else time.monotonic() + deadline
+
+    def _remaining(self):
+        if self.deadline_at is None:
+            return None
+        remaining = self.deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Deadline for reads exceeded")
+        return remaining
+
+    def hedge_delay(self):
+        """Seconds to wait before a duplicate read is issued"""
+        if len(self.latencies) < self.min_samples:
+            return self.initial_delay
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def read(self, oid, length, offset=0):
+        """Read up to length bytes at offset from oid"""
+        start = time.monotonic()
+        remaining = self._remaining()
+        primary = aio_read(self.ioctx, oid, length, offset)
+
+        delay = self.hedge_delay() if self.hedge_ioctx is not None else remaining
+        done, _ = wait([primary], timeout=delay if remaining is None else min(delay, remaining))
+        if done:
+            buf = primary.result()
+            self.latencies.append(time.monotonic() - start)
+            return buf
+        if self.hedge_ioctx is None:
+            primary.cancel()
+            raise TimeoutError(f"Deadline for reads exceeded reading {oid} at offset {offset}")
+
+        try:
+            remaining = self._remaining()
+        except TimeoutError:
+            primary.cancel()
+            raise
+        logging.debug(f'Hedging read of {oid} at offset {offset} after {delay:.3f}s')
+        self.hedges += 1
+        hedge = aio_read(self.hedge_ioctx, oid, length, offset)
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=self._remaining(), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    if future is hedge:
+                        self.hedge_wins += 1
+                    # the latency of the slow read is recorded, so that the threshold adapts
+                    self.latencies.append(time.monotonic() - start)
+                    return future.result()
+        finally:
+            # the data of the loser is dropped when it arrives
+            for future in pending:
+                future.cancel()
+        if error is not None:
+            raise error
+        raise TimeoutError(f"Deadline for reads exceeded reading {oid} at offset {offset}")
+
+    def close(self):
+        """Nothing to release: reads still in flight are completed by librados, and their data dropped"""
+
+
 def stat(ioctx,path):
     """Stat the first chunk, the chunk0 is added to the path
     """
@@ -145,34 +357,70 @@ def retrieve_xattr(ioctx,path,xattr_name='XrdCks.adler32'):
 
 
 def write_xattr(ioctx,path,xattr_name, xattr_value, force=False):
-    """Write value into xattr name. If attribute already exists, only overwrite if force is True.
-    If overwriting existing metadata, first removes the existing one. 
+    """Write value into xattr name, with a single write operation. 
+    If attribute already exists, only overwrite if force is True:
+    without force, the set is guarded by an xattr compare (an unset xattr compares equal to an empty value),
+    so that of concurrent writers only one succeeds, and the others raise ValueError.
     returns True if ok, else raise exception
     """
 
     global chunk0
     oid = path + chunk0
 
-    data = retrieve_xattr( ioctx,path,xattr_name)
+    write_op = ioctx.create_write_op()
+    try:
+        if not force:
+            if not hasattr(write_op, 'cmpxattr'):
+                # bindings without the compare; check and set in separate calls
+                logging.debug("No cmpxattr in write op; using separate check for %s", oid)
+                return _write_xattr_unguarded(ioctx, path, xattr_name, xattr_value)
+            write_op.cmpxattr(xattr_name, CMPXATTR_OP_EQ, b'')
+        write_op.set_xattr(xattr_name, xattr_value)
+        ioctx.operate_write_op(write_op, oid)
+    except rados.Error as e:
+        if not force and getattr(e, 'errno', None) == errno.ECANCELED:
+            logging.info(f'{path}: Xattr existing {xattr_name} and force not set')
+            raise ValueError(f"Xattr {xattr_name} already existing for {path}")
+        logging.error("Error setting new metadata: %s" % oid, exc_info=True)
+        raise e
+    finally:
+        ioctx.release_write_op(write_op)
 
-    if data is not None and not force:
-        #print(data)
-        logging.info(f'{path}: Xattr existing {xattr_name} and force not set')
-        raise ValueError(f"Xattr {xattr_name} already existing for {path}")
+    return True
 
-    if data is not None and force:
-        #print(data)
-        try:
-            ioctx.rm_xattr(oid, xattr_name)
-        except Exception as e:
-            logging.error(f"Error removing existing xattr: {path}", exc_info=True)
-            raise e
 
+def _write_xattr_unguarded(ioctx,path,xattr_name, xattr_value):
+    """Set the xattr if not already existing, checking first with a separate read (not race free)"""
+    oid = path + chunk0
+    if retrieve_xattr(ioctx,path,xattr_name) is not None:
+        logging.info(f'{path}: Xattr existing {xattr_name} and force not set')
+        raise ValueError(f"Xattr {xattr_name} already existing for {path}")
     try:
         ioctx.set_xattr(oid, xattr_name, xattr_value)
     except Exception as e:
         logging.error("Error setting new metadata: %s" % oid, exc_info=True)
         raise e
+    return True
+
+
+def set_xattrs(ioctx,path,xattrs):
+    """Set several xattrs on chunk0 in a single write operation; either all or none are applied.
+    xattrs is a dict of name to value (bytes).
+    returns True if ok, else raise exception
+    """
+    global chunk0
+    oid = path + chunk0
+
+    write_op = ioctx.create_write_op()
+    try:
+        for xattr_name, xattr_value in xattrs.items():
+            write_op.set_xattr(xattr_name, xattr_value)
+        ioctx.operate_write_op(write_op, oid)
+    except Exception as e:
+        logging.error("Error setting metadata: %s %s" % (oid, list(xattrs)), exc_info=True)
+        raise e
+    finally:
+        ioctx.release_write_op(write_op)
 
     return True
 
@@ -184,19 +432,229 @@ def get_striper_xattrs(ioctx,path):
 
         Note, total size can be smaller than the object size, if only one (partly filled) stripe.
     """
-    rados_object_size=int(retrieve_xattr(ioctx, path, "striper.layout.object_size"))
-    total_size       =int(retrieve_xattr(ioctx, path, "striper.size"))
+    rados_object_size=retrieve_xattr(ioctx, path, "striper.layout.object_size")
+    total_size       =retrieve_xattr(ioctx, path, "striper.size")
     
     if rados_object_size is None or total_size is None:
+        rados_object_size = None
+        total_size = None
         num_stripes = None
         last_stripe_size = None
     else:
+        rados_object_size = int(rados_object_size)
+        total_size = int(total_size)
         num_stripes=math.ceil(total_size/rados_object_size) 
         last_stripe_size=total_size % rados_object_size
 
     return rados_object_size, total_size, num_stripes, last_stripe_size
 
 
+def discover_stripes(ioctx, path, probes=8):
+    """Find the layout of a file written without the striper metadata, assuming its stripes are contiguous.
+
+    Rather than a stat of each stripe in turn, up to probes stripes are stat'ed concurrently in each round:
+    first at exponentially increasing indices (with chunk0) until a missing stripe is found, then evenly spaced 
+    between the last stripe found and the first missing one, so that O(log n) rounds are needed (see probe_stripes).
+    Returns tuple of object size (the size of chunk0), total size, number of stripes and the size of the last stripe;
+    None values if chunk0 does not exist.
+    """
+    rounds = probe_stripes(path, probes)
+    sizes = None
+    try:
+        while True:
+            sizes = stat_oids(ioctx, rounds.send(sizes))
+    except StopIteration as e:
+        return e.value
+
+
+def probe_stripes(path, probes=8):
+    """The probe sequence of discover_stripes, independent of how the stats are made: a generator yielding the list of
+    oids to stat in each round, to be sent back the dict of oid to size (None for a missing oid) of the round, and 
+    returning (as StopIteration.value) the layout found, as discover_stripes."""
+    def oid(index):
+        return path + f'.{index:016x}'
+
+    found = {}
+    last, missing = None, None # highest index found, lowest index missing
+    exponent = 0
+    while missing is None:
+        indices = ([0] if exponent == 0 else []) + [2**e for e in range(exponent, exponent + probes)]
+        exponent += probes
+        sizes = yield [oid(i) for i in indices]
+        for i in indices:
+            if sizes[oid(i)] is None:
+                missing = i
+                break
+            found[i], last = sizes[oid(i)], i
+    if last is None:
+        return None, None, None, None
+
+    while missing - last > 1:
+        step = (missing - last) / (probes + 1)
+        indices = sorted({min(missing - 1, last + max(1, round(step * k))) for k in range(1, probes + 1)})
+        sizes = yield [oid(i) for i in indices]
+        for i in indices:
+            if sizes[oid(i)] is None:
+                missing = i
+                break
+            found[i], last = sizes[oid(i)], i
+
+    num_stripes = last + 1
+    object_size = found[0]
+    logging.debug(f'Discovered {num_stripes} stripes of {path} in {exponent // probes} + search rounds')
+    return object_size, object_size * last + found[last], num_stripes, found[last]
+
+
+def stat_oids(ioctx, oids):
+    """Stat all the oids in parallel with aio_stat. 
+    Returns a dict of oid to size, with None for oids that do not exist."""
+    sizes = {}
+    def make_callback(oid):
+        def oncomplete(completion, size=None, mtime=None):
+            sizes[oid] = size
+        return oncomplete
+    completions = [(oid, ioctx.aio_stat(oid, make_callback(oid))) for oid in oids]
+    for oid, completion in completions:
+        completion.wait_for_complete_and_cb()
+        ret = completion.get_return_value()
+        if ret == -errno.ENOENT:
+            sizes[oid] = None
+        elif ret < 0:
+            raise IOError(f"Stat failed for {oid}: {ret}")
+    return sizes
+
+
+def retrieve_xattrs(ioctx, paths, xattr_names, max_inflight=1000):
+    """Retrieve xattrs from chunk0 of many paths in parallel with aio_getxattr, at most max_inflight at a time.
+    Returns a dict of path to dict of xattr name to value; None if not set or the file does not exist."""
+    values = {path: {} for path in paths}
+    def make_callback(path, xattr_name):
+        def oncomplete(completion, value=None):
+            values[path][xattr_name] = value
+        return oncomplete
+
+    requests = [(path, xattr_name) for path in paths for xattr_name in xattr_names]
+    for start in range(0, len(requests), max_inflight):
+        completions = [(path, xattr_name, ioctx.aio_getxattr(path + chunk0, xattr_name, make_callback(path, xattr_name)))
+                       for path, xattr_name in requests[start:start+max_inflight]]
+        for path, xattr_name, completion in completions:
+            completion.wait_for_complete_and_cb()
+            ret = completion.get_return_value()
+            if ret in (-errno.ENOENT, -errno.ENODATA):
+                values[path][xattr_name] = None
+            elif ret < 0:
+                raise IOError(f"Get xattr {xattr_name} failed for {path}: {ret}")
+    return values
+
+
+def apply_xattr_writes(ioctx, writes, max_inflight=1000):
+    """Set xattrs on chunk0 of many paths in parallel with aio write operations, at most max_inflight at a time.
+    writes is a list of (path, xattr_name, value, expected); unless expected is None, each write is guarded by 
+    an xattr compare, and only applied if the current value equals expected (b'' for not set).
+    With bindings that have no xattr compare in write operations, the current values are read first (in parallel),
+    and only the writes that match are made: not race free, as with write_xattr.
+    Returns the list of return values, in order: 0 if applied, -ECANCELED if the compare failed, 
+    -ENOENT if the file does not exist, or another negative errno."""
+    results = []
+    for start in range(0, len(writes), max_inflight):
+        batch = writes[start:start+max_inflight]
+        checked = [0] * len(batch)
+        probe = ioctx.create_write_op()
+        guarded = hasattr(probe, 'cmpxattr')
+        ioctx.release_write_op(probe)
+        if not guarded:
+            logging.debug(f'No cmpxattr in write op; checking {len(batch)} xattrs before writing')
+            checked = _compare_xattrs(ioctx, batch)
+        inflight = []
+        for (path, xattr_name, value, expected), ret in zip(batch, checked):
+            if ret < 0:
+                # failed the check; not written
+                inflight.append((None, None, ret))
+                continue
+            write_op = ioctx.create_write_op()
+            if expected is not None and guarded:
+                write_op.cmpxattr(xattr_name, CMPXATTR_OP_EQ, expected)
+            write_op.set_xattr(xattr_name, value)
+            inflight.append((write_op, ioctx.operate_aio_write_op(write_op, path + chunk0), None))
+        for write_op, completion, ret in inflight:
+            if completion is None:
+                results.append(ret)
+                continue
+            completion.wait_for_complete_and_cb()
+            results.append(completion.get_return_value())
+            ioctx.release_write_op(write_op)
+    return results
+
+
+def _compare_xattrs(ioctx, writes):
+    """For apply_xattr_writes without cmpxattr: 0 for each guarded write whose xattr has the expected value 
+    (or unguarded write), else -ECANCELED, -ENOENT if the file does not exist, or another negative errno"""
+    values = {}
+    def make_callback(i):
+        def oncomplete(completion, value=None):
+            values[i] = value
+        return oncomplete
+    completions = [(i, ioctx.aio_getxattr(path + chunk0, xattr_name, make_callback(i)))
+                   for i, (path, xattr_name, value, expected) in enumerate(writes) if expected is not None]
+    checked = [0] * len(writes)
+    for i, completion in completions:
+        completion.wait_for_complete_and_cb()
+        ret = completion.get_return_value()
+        if ret == -errno.ENODATA:
+            ret, values[i] = 0, b''
+        if ret < 0:
+            checked[i] = ret
+        elif bytes(values[i] or b'') != bytes(writes[i][3]):
+            checked[i] = -errno.ECANCELED
+    return checked
+
+
+def check_structure(ioctx, path, orphan_probes=2, allow_holes=False, layout=None):
+    """Check the stripe objects of a file against the striper metadata, without reading any data.
+
+    Every stripe expected from striper.size and striper.layout.object_size is stat'ed in parallel; 
+    each must exist with the expected size (so the sizes sum to striper.size), and the orphan_probes 
+    stripes beyond the last one must not exist.
+    If allow_holes (a sparse file), stripes other than chunk0 may be missing, and stripes may be short.
+    Returns a list of problems found; empty if the file is intact. 
+    If there is no striper metadata, the structure can not be checked, and no problems are reported.
+    layout, if given, is the object size and total size from the striper metadata already read by the caller 
+    (None values if not set), so that they are not read again.
+    """
+    if layout is None:
+        layout = (retrieve_xattr(ioctx, path, "striper.layout.object_size"), retrieve_xattr(ioctx, path, "striper.size"))
+    object_size, total_size = layout
+    if object_size is None or total_size is None:
+        logging.debug(f"No striper metadata for {path}; structure not checked")
+        return []
+    object_size, total_size = int(object_size), int(total_size)
+
+    # an empty file still has chunk0
+    num_stripes = max(1, math.ceil(total_size/object_size))
+    oids = [path + f'.{i:016x}' for i in range(num_stripes + orphan_probes)]
+    sizes = stat_oids(ioctx, oids)
+
+    problems = []
+    for i, oid in enumerate(oids[:num_stripes]):
+        expected = min(object_size, total_size - i*object_size)
+        if sizes[oid] is None:
+            if not allow_holes or i == 0:
+                problems.append(f"Missing stripe {oid}")
+        elif sizes[oid] > expected or (sizes[oid] < expected and not allow_holes):
+            problems.append(f"Stripe {oid} has size {sizes[oid]}, expected {expected}")
+    for oid in oids[num_stripes:]:
+        if sizes[oid] is not None:
+            problems.append(f"Orphan stripe {oid} beyond striper.size {total_size}")
+
+    found = sum(size for size in sizes.values() if size is not None)
+    if found > total_size or (found < total_size and not allow_holes):
+        problems.append(f"Stripe sizes sum to {found}, striper.size is {total_size}")
+
+    for problem in problems:
+        logging.warning(f'{path}: {problem}')
+    return problems
+
+
 
 
 
@@ -234,9 +692,15 @@ def cks_write_metadata(ioctx, path, xattr_name, xattr_value, force_overwrite=Fal
 
 
 
-def cks_from_file(ioctx, path, readsize):
+def cks_from_file(ioctx, path, readsize, reader=None, preflight=True, sparse=False, pages=None):
     """Calculate checksum from path. Returns None or checksum object
-    Raise error if not existing"""
+    Raise error if not existing.
+    If reader (e.g. a HedgedReader) is given, data reads are made through it; if it can submit reads ahead 
+    (an osdmap.OsdScheduler), the stripes are read in parallel.
+    If preflight, the stripe structure is checked first (see check_structure), and IOError raised if broken,
+    before any data is read.
+    If sparse, missing or short stripes within striper.size are holes, and checksummed as zeros without being read.
+    If pages (a pagecrc.PageCrcBuilder) is given, the page checksums of each stripe are calculated in the same pass."""
 
     # stat the file for timestamp
     try:
@@ -244,20 +708,41 @@ def cks_from_file(ioctx, path, readsize):
     except rados.ObjectNotFound:
         logging.error(f"File {path} not found")
         return None
-    fmtime = datetime(mtime.tm_year, mtime.tm_mon, mtime.tm_mday ,mtime.tm_hour ,mtime.tm_min ,mtime.tm_sec ) 
-    if mtime.tm_isdst:
-        fmtime = fmtime - timedelta(hours=1)
+    logging.debug(f'Size chunk0: {size}, mtime: {time.asctime(mtime)}') 
 
-    logging.debug(f'Size chunk0: {size}, fmtime: {fmtime}') 
-
-    # obtain the striper info, if existing; otherwise values will be None
+    # obtain the striper info, if existing; otherwise from the stripes found
     rados_object_size, total_size, num_stripes, last_stripe_size = get_striper_xattrs(ioctx,path)
+    layout = (rados_object_size, total_size)
+    if total_size is None:
+        logging.debug(f'No striper metadata for {path}; discovering the stripes')
+        rados_object_size, total_size, num_stripes, last_stripe_size = discover_stripes(ioctx, path)
     logging.debug(f'Striper: Object size:{rados_object_size}, Total size:{total_size}, Num Stripes:{num_stripes}, Last Stripe size:{last_stripe_size}') 
 
+    if hasattr(reader, 'set_total_size'):
+        # e.g. a progress.ProgressReader
+        reader.set_total_size(total_size)
+
+    if preflight:
+        problems = check_structure(ioctx, path, allow_holes=sparse, layout=layout)
+        if problems:
+            raise IOError(f"File structure broken: {path}, {problems[0]}")
+
+    if sparse and total_size is not None:
+        buffers = read_file_sparse(ioctx, path, rados_object_size, total_size, readsize, reader)
+    elif getattr(reader, 'submit', None) is not None and total_size is not None:
+        # the reader schedules reads ahead (e.g. an osdmap.OsdScheduler); read the stripes in parallel
+        buffers = read_file_scheduled(reader, path, rados_object_size, total_size, readsize)
+    else:
+        buffers = read_file_btyes(ioctx, path, rados_object_size, num_stripes,readsize, reader)
+    if pages is not None and (rados_object_size is None or rados_object_size % pages.page_size):
+        # e.g. a layout from discover_stripes; the page checksums are an addition, and the file checksum stands without them
+        logging.warning(f'Stripes of {path} are {rados_object_size} bytes, not whole pages; no page checksums calculated')
+    elif pages is not None:
+        buffers = pages.feed(buffers, rados_object_size)
 
     try:
         cks_alg = adler32.adler32('adler32')
-        cks_hex = cks_alg.calc_checksum( read_file_btyes(ioctx, path, rados_object_size, num_stripes,readsize) )
+        cks_hex = cks_alg.calc_checksum( buffers )
         bytes_read = cks_alg.bytes_read
     except Exception as e:
         raise e
@@ -266,20 +751,311 @@ def cks_from_file(ioctx, path, readsize):
         logging.error(f"Mismatch in bytes read {bytes_read} and striped total size metadata {total_size}")
         raise IOError(f"Mismatch in bytes read: {path}, {bytes_read}, {total_size}")
     
-    # get current time 
-    #now   = datetime.now()
-    mnow  = time.localtime()
-    now = datetime(mnow.tm_year, mnow.tm_mon, mnow.tm_mday ,mnow.tm_hour ,mnow.tm_min ,mnow.tm_sec ) 
-    if mtime.tm_isdst:
-        now = now - timedelta(hours=1)
+    cks = XrdCks.XrdCks.from_mtime('adler32', mtime, cks_hex)
+    cks.source_type = 'file'
+    cks.total_size_bytes = total_size
+    return cks
 
-    delta = now - fmtime
 
-    fmtime_asint = int(fmtime.timestamp())
-    cstime_asint = int(delta.total_seconds())
+def metadata_snapshot(ioctx, path, xattr_names):
+    """Start a stat of chunk0 and the reads of its xattr_names, concurrently with aio; returns a function waiting for them,
+    which returns size, mtime and a dict of xattr name to value (None if not set); size and mtime are None if the file 
+    does not exist."""
+    values = {}
+    def stat_callback(completion, size=None, mtime=None):
+        values['stat'] = (size, mtime)
+    def make_callback(xattr_name):
+        def oncomplete(completion, value=None):
+            values[xattr_name] = value
+        return oncomplete
+    oid = path + chunk0
+    completions = [('stat', ioctx.aio_stat(oid, stat_callback))]
+    completions += [(xattr_name, ioctx.aio_getxattr(oid, xattr_name, make_callback(xattr_name))) for xattr_name in xattr_names]
 
-    cks = XrdCks.XrdCks('adler32', fmtime_asint, cstime_asint, cks_hex)
-    cks.source_type = 'file'
+    def wait():
+        for name, completion in completions:
+            completion.wait_for_complete_and_cb()
+            ret = completion.get_return_value()
+            if ret in (-errno.ENOENT, -errno.ENODATA):
+                values[name] = (None, None) if name == 'stat' else None
+            elif ret < 0:
+                raise IOError(f"{'Stat' if name == 'stat' else 'Get xattr ' + name} failed for {path}: {ret}")
+        size, mtime = values['stat']
+        return size, mtime, {xattr_name: values[xattr_name] for xattr_name in xattr_names}
+    return wait
+
+
+def _start_first_read(ioctx, oid, readsize, reader=None):
+    """Start the read of the first readsize bytes of oid, with aio (or through reader, if it can submit reads ahead).
+    Returns a Future of the data; or None if the read can not be started ahead."""
+    if reader is not None:
+        return reader.submit(oid, readsize, 0) if getattr(reader, 'submit', None) is not None else None
+    return aio_read(ioctx, oid, readsize, 0)
+
+
+def cks_verify(ioctx, path, readsize, xattr_name="XrdCks.adler32", reader=None, sparse=False, force_fileread=False,
+               preflight=True):
+    """Return the stored checksum and that calculated from the file, for verification; each None if not available
+    (the file is only read if a checksum is stored, or force_fileread).
+
+    The stat of chunk0, the stored checksum and the striper xattrs are fetched in one round, while the first block 
+    of data is read ahead (with aio, or the reader's submit), and used for both checksums; if there is no stored checksum, 
+    and not force_fileread, the first block is dropped. After the data is read, the stat of chunk0, the stored checksum 
+    and striper.size are fetched again, and IOError is raised if any changed during the read. Only these are compared:
+    a rewrite of other stripes that leaves chunk0 and the size unchanged is not detected.
+    See cks_from_file for reader, sparse and preflight; the structure check uses the striper xattrs of the snapshot,
+    while the first block is read.
+    """
+    names = [xattr_name, 'striper.layout.object_size', 'striper.size']
+    snapshot = metadata_snapshot(ioctx, path, names)
+    oid = path + chunk0
+    first_read = _start_first_read(ioctx, oid, readsize, reader)
+    size, mtime, values = snapshot()
+    if size is None:
+        if first_read is not None:
+            first_read.cancel()
+        logging.error(f"File {path} not found")
+        return None, None
+
+    stored = None
+    if values[xattr_name] is not None:
+        stored = XrdCks.XrdCks.from_binary(values[xattr_name])
+        stored.source_type = 'metadata'
+    if stored is None and not force_fileread:
+        if first_read is not None:
+            # queued reads are not started; one in flight is dropped
+            first_read.cancel()
+        return None, None
+
+    if preflight:
+        problems = check_structure(ioctx, path, allow_holes=sparse,
+                                   layout=(values['striper.layout.object_size'], values['striper.size']))
+        if problems:
+            if first_read is not None:
+                first_read.cancel()
+            raise IOError(f"File structure broken: {path}, {problems[0]}")
+
+    try:
+        if first_read is not None:
+            first = first_read.result()
+        else:
+            first = ioctx.read(oid, readsize, 0) if reader is None else reader.read(oid, readsize, 0)
+    except rados.ObjectNotFound:
+        first = None
+    if first is None:
+        logging.error(f"File {path} not found")
+        return None, None
+
+    if values['striper.size'] is not None and values['striper.layout.object_size'] is not None:
+        object_size, total_size = int(values['striper.layout.object_size']), int(values['striper.size'])
+        num_stripes = math.ceil(total_size / object_size)
+    else:
+        logging.debug(f'No striper metadata for {path}; discovering the stripes')
+        object_size, total_size, num_stripes, last_stripe_size = discover_stripes(ioctx, path)
+    if stored is not None:
+        stored.total_size_bytes = total_size
+    if hasattr(reader, 'set_total_size'):
+        reader.set_total_size(total_size)
+
+    start = len(first)
+    if sparse:
+        rest = read_file_sparse(ioctx, path, object_size, total_size, readsize, reader, start=start)
+    elif getattr(reader, 'submit', None) is not None:
+        rest = read_file_scheduled(reader, path, object_size, total_size, readsize, start=start)
+    else:
+        rest = read_file_btyes(ioctx, path, object_size, num_stripes, readsize, reader, start=start)
+
+    cks_alg = adler32.adler32('adler32')
+    cks_hex = cks_alg.calc_checksum(itertools.chain([first], rest))
+    if cks_alg.bytes_read != total_size:
+        logging.error(f"Mismatch in bytes read {cks_alg.bytes_read} and striped total size metadata {total_size}")
+        raise IOError(f"Mismatch in bytes read: {path}, {cks_alg.bytes_read}, {total_size}")
+
+    size_after, mtime_after, values_after = metadata_snapshot(ioctx, path, [xattr_name, 'striper.size'])()
+    if (size_after, mtime_after) != (size, mtime) or any(values_after[k] != values[k] for k in values_after):
+        logging.error(f"{path} changed during the read")
+        raise IOError(f"File modified during verify: {path}")
+
+    from_file = XrdCks.XrdCks.from_mtime('adler32', mtime, cks_hex)
+    from_file.source_type = 'file'
+    from_file.total_size_bytes = total_size
+    return stored, from_file
+
+
+def cks_from_stream(ioctx, path, cks_hex, bytes_read):
+    """Create the checksum object for a file whose checksum was calculated from the data stream 
+    while it was being written (e.g. during a transfer). Returns None or checksum object
+    Raise error if the bytes seen in the stream do not match the striper size"""
+
+    try:
+        size, mtime = stat(ioctx,path)
+    except rados.ObjectNotFound:
+        logging.error(f"File {path} not found")
+        return None
+
+    rados_object_size, total_size, num_stripes, last_stripe_size = get_striper_xattrs(ioctx,path)
+    logging.debug(f'Striper: Object size:{rados_object_size}, Total size:{total_size}, Num Stripes:{num_stripes}, Last Stripe size:{last_stripe_size}') 
+
+    if bytes_read != total_size:
+        logging.error(f"Mismatch in bytes streamed {bytes_read} and striped total size metadata {total_size}")
+        raise IOError(f"Mismatch in bytes streamed: {path}, {bytes_read}, {total_size}")
+
+    cks = XrdCks.XrdCks.from_mtime('adler32', mtime, cks_hex)
+    cks.source_type = 'transfer'
     cks.total_size_bytes = total_size
     return cks
 
+
+
+
+class StripedWriter:
+    """Write a file as path.%016x stripe objects, in the libradosstriper layout, calculating the checksum as data is written.
+
+    Data is sent with aio writes, with at most max_inflight_bytes not yet acknowledged.
+    On close, the striper xattrs and the XrdCks checksum are set on chunk0 in a single write operation, 
+    so a reader either sees a complete file with its checksum, or no striper size at all.
+    Additional hashlib digests (e.g. md5) can be requested; these are calculated but not stored.
+
+    Use as a context manager; if an exception is raised, nothing is committed, and the stripes written are removed:
+        with cephtools.StripedWriter(ioctx, path) as writer:
+            writer.write(data)
+        xrdcks = writer.xrdcks
+    """
+    def __init__(self, ioctx, path, object_size=64*1024*1024, writesize=8*1024*1024, 
+                 max_inflight_bytes=256*1024*1024, digests=None, xattr_name='XrdCks.adler32', overwrite=False):
+        self.ioctx = ioctx
+        self.path = path
+        self.object_size = object_size
+        self.writesize = min(writesize, object_size)
+        self.max_inflight_bytes = max(max_inflight_bytes, self.writesize)
+        self.xattr_name = xattr_name
+
+        self.cks_alg = adler32.adler32('adler32').reset()
+        self.digests = {name: hashlib.new(name) for name in (digests or [])}
+        self.bytes_written = 0
+        self.xrdcks = None
+        self.closed = False
+
+        self._buffer = bytearray()
+        self._inflight = deque()
+        self._inflight_bytes = 0
+
+        if path_exists(ioctx, path):
+            if not overwrite:
+                raise ValueError(f"File {path} already exists")
+            for oid in list(get_chunks(ioctx, path)):
+                ioctx.remove_object(oid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            try:
+                self.close()
+            except Exception:
+                self.abort()
+                raise
+        else:
+            self.abort()
+        return False
+
+    def write(self, data):
+        """Checksum and queue data to be written; returns the number of bytes accepted"""
+        if self.closed:
+            raise ValueError(f"Writer for {self.path} is closed")
+        self.cks_alg.update(data)
+        for digest in self.digests.values():
+            digest.update(data)
+        self._buffer += data
+        while len(self._buffer) >= self._next_write_length():
+            self._flush_buffer()
+        return len(data)
+
+    def _next_write_length(self):
+        """Bytes to send in the next write; a write never crosses a stripe boundary"""
+        offset = (self.bytes_written % self.object_size)
+        return min(self.writesize, self.object_size - offset)
+
+    def _flush_buffer(self):
+        length = min(len(self._buffer), self._next_write_length())
+        if length == 0:
+            return
+        stripe = self.bytes_written // self.object_size
+        offset = self.bytes_written % self.object_size
+        oid = self.path + f'.{stripe:016x}'
+        buf = bytes(self._buffer[:length])
+        del self._buffer[:length]
+
+        while self._inflight and self._inflight_bytes + length > self.max_inflight_bytes:
+            self._wait_oldest()
+
+        completion = self.ioctx.aio_write(oid, buf, offset)
+        self._inflight.append((completion, oid, length))
+        self._inflight_bytes += length
+        self.bytes_written += length
+
+    def _wait_oldest(self):
+        completion, oid, length = self._inflight.popleft()
+        self._inflight_bytes -= length
+        completion.wait_for_complete()
+        ret = completion.get_return_value()
+        if ret < 0:
+            logging.error(f"Write failed for {oid}: {ret}")
+            raise IOError(f"Write failed for {oid}: {ret}")
+
+    def _wait_all(self):
+        while self._inflight:
+            self._wait_oldest()
+
+    def hexdigests(self):
+        """Dict of the digests calculated so far, including adler32, in lowercase hex"""
+        values = {name: digest.hexdigest() for name, digest in self.digests.items()}
+        values['adler32'] = self.cks_alg.value
+        return values
+
+    def abort(self):
+        """Wait for outstanding writes, without committing the metadata, then remove the stripes written.
+        Stripes without the striper xattrs would otherwise be taken for a complete file (see discover_stripes)."""
+        self.closed = True
+        try:
+            self._wait_all()
+        except IOError:
+            logging.debug(f"Write error while aborting {self.path}", exc_info=True)
+        for stripe in range(math.ceil(self.bytes_written / self.object_size)):
+            oid = self.path + f'.{stripe:016x}'
+            try:
+                self.ioctx.remove_object(oid)
+            except rados.ObjectNotFound:
+                pass
+            except rados.Error:
+                logging.warning(f"Could not remove {oid} of the aborted write of {self.path}", exc_info=True)
+
+    def close(self):
+        """Write any remaining data, then commit the striper and checksum xattrs. Returns the checksum object"""
+        if self.closed:
+            return self.xrdcks
+        while self._buffer:
+            self._flush_buffer()
+        self.closed = True
+        self._wait_all()
+
+        if self.bytes_written == 0:
+            # empty file; chunk0 must still exist to carry the metadata
+            self.ioctx.write_full(self.path + chunk0, b'')
+
+        size, mtime = stat(self.ioctx, self.path)
+        cks = XrdCks.XrdCks.from_mtime('adler32', mtime, self.cks_alg.value)
+        cks.source_type = 'write'
+        cks.total_size_bytes = self.bytes_written
+
+        set_xattrs(self.ioctx, self.path, {
+            'striper.layout.stripe_unit': str(self.object_size).encode(),
+            'striper.layout.stripe_count': b'1',
+            'striper.layout.object_size': str(self.object_size).encode(),
+            'striper.size': str(self.bytes_written).encode(),
+            self.xattr_name: cks.to_binary(),
+            })
+        logging.info(f'Path:{self.path}; From:{cks.source_type}; Checksum:{cks.get_cksum_as_hex()}; Bytes:{self.bytes_written}')
+        self.xrdcks = cks
+        return cks
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Import trusted adler32 checksums from an external catalogue (e.g. of files migrated from older storage)
+# into the XrdCks.adler32 xattrs, with metadata operations only: the size in the catalogue is checked against
+# striper.size, and the xattrs are written with aio write operations, many files at a time.
+# A random sample of the imported files can be verified with a full read.
+#
+#   importcks.py -x storage.xml --verify-fraction 0.001 catalogue.txt
+#   dump_catalogue | importcks.py -x storage.xml -
+#
+# Each line of the catalogue holds: lfn size adler32 mtime (separated by spaces, tabs or commas),
+# with adler32 in hex and mtime in seconds since the epoch; empty lines and lines starting with # are skipped.
+
+
+import logging,argparse
+import sys, os, time, errno
+import random
+import re
+
+import XrdCks
+import lfn2pfn
+import actions
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available; only the catalogue parsing can be used
+    cephtools = None
+
+_separators = re.compile(r'[\s,]+')
+
+RESULTS = ['imported', 'existing', 'conflict', 'size_mismatch', 'missing', 'failed']
+
+
+def parse_catalogue_line(line):
+    """Return (lfn, size, adler32 as 8 lower case hex digits, mtime) of a catalogue line; None if empty or a comment.
+    Raises ValueError if malformed."""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    fields = _separators.split(line)
+    if len(fields) != 4:
+        raise ValueError(f'Expected lfn, size, adler32 and mtime: {line}')
+    lfn, size, cks_hex, mtime = fields
+    cks_hex = cks_hex.lower()
+    if cks_hex.startswith('0x'):
+        cks_hex = cks_hex[2:]
+    if not 0 < len(cks_hex) <= 8 or int(cks_hex, 16) < 0:
+        raise ValueError(f'Not an adler32 value: {fields[2]}')
+    return lfn, int(size), cks_hex.zfill(8), int(float(mtime))
+
+
+def import_batch(ioctx, entries, xattr_name="XrdCks.adler32"):
+    """Import the checksums of entries, a list of (path, size, adler32 hex, mtime), all in the pool of ioctx.
+    One round of aio reads of striper.size and the existing xattr, then one of guarded aio writes (so that
+    a checksum stored in the meantime is not overwritten).
+    Returns a dict of path to result, one of RESULTS: conflict if a different checksum is already stored."""
+    paths = [path for path, _, _, _ in entries]
+    values = cephtools.retrieve_xattrs(ioctx, paths, ['striper.size', xattr_name])
+    results = {}
+    writes = []
+    for path, size, cks_hex, mtime in entries:
+        striper_size, stored = values[path]['striper.size'], values[path][xattr_name]
+        if striper_size is None:
+            # not existing, or not written by libradosstriper
+            results[path] = 'missing'
+        elif int(striper_size) != size:
+            logging.warning(f'{path}: size {size} in catalogue, striper.size is {int(striper_size)}')
+            results[path] = 'size_mismatch'
+        elif stored is not None:
+            same = XrdCks.XrdCks.from_binary(stored).get_cksum_as_hex() == cks_hex
+            if not same:
+                logging.warning(f'{path}: adler32 {cks_hex} in catalogue, {XrdCks.XrdCks.from_binary(stored)} stored')
+            results[path] = 'existing' if same else 'conflict'
+        else:
+            cks_binary = XrdCks.XrdCks('adler32', mtime, 0, cks_hex).to_binary()
+            writes.append((path, xattr_name, cks_binary, b''))
+
+    for (path, _, _, _), ret in zip(writes, cephtools.apply_xattr_writes(ioctx, writes)):
+        if ret == 0:
+            results[path] = 'imported'
+        elif ret == -errno.ECANCELED:
+            results[path] = 'existing'
+        elif ret == -errno.ENOENT:
+            results[path] = 'missing'
+        else:
+            logging.warning(f'{path}: write of {xattr_name} failed: {ret}')
+            results[path] = 'failed'
+    return results
+
+
+def run_import(get_ioctx, lines, mapper, batch_size=1000, xattr_name="XrdCks.adler32",
+               verify_fraction=0., readsize=64*1024*1024, rng=None):
+    """Import the checksums of the catalogue lines, in batches of batch_size lines; get_ioctx(pool) returns the ioctx
+    for a pool. Of the files imported, a random verify_fraction is then read in full with actions.verify.
+    Returns a dict of counts of each of RESULTS, plus malformed lines, and verified and verify_failed files."""
+    rng = random.Random() if rng is None else rng
+    counts = {result: 0 for result in RESULTS + ['malformed', 'verified', 'verify_failed']}
+    to_verify = []
+
+    def flush(batch):
+        for pool, entries in batch.items():
+            try:
+                results = import_batch(get_ioctx(pool), entries, xattr_name)
+            except Exception as e:
+                logging.warning(f'Import of {len(entries)} files in {pool} failed: {e}')
+                results = {path: 'failed' for path, _, _, _ in entries}
+            for path, result in results.items():
+                counts[result] += 1
+                if result == 'imported' and verify_fraction > 0 and rng.random() < verify_fraction:
+                    to_verify.append((pool, path))
+        batch.clear()
+
+    batch, batched = {}, 0
+    for line in lines:
+        try:
+            entry = parse_catalogue_line(line)
+            if entry is None:
+                continue
+            lfn, size, cks_hex, mtime = entry
+            pool, path = mapper.parse(lfn)
+        except Exception as e:
+            logging.warning(f'Skipping catalogue line: {e}')
+            counts['malformed'] += 1
+            continue
+        batch.setdefault(pool, []).append((path, size, cks_hex, mtime))
+        batched += 1
+        if batched >= batch_size:
+            flush(batch)
+            batched = 0
+            logging.info(f'Import: {counts}')
+    flush(batch)
+
+    for pool, path in to_verify:
+        try:
+            ok = actions.verify(get_ioctx(pool), path, readsize, xattr_name) is not None
+        except Exception as e:
+            logging.warning(f'Verify of {pool}:{path} failed: {e}')
+            ok = False
+        if not ok:
+            logging.error(f'Imported checksum of {pool}:{path} does not match the file')
+        counts['verified' if ok else 'verify_failed'] += 1
+    return counts
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import trusted adler32 checksums from a catalogue into the xattrs')
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+    parser.add_argument('-x','--lfn2pfnxml',default=None, dest='lfn2pfn_xmlfile',
+                        help='The storage.xml file usually provided to xrootd for lfn2pfn mapping.')
+    parser.add_argument('-b','--batch',default=1000,type=int, help='Number of files imported concurrently')
+    parser.add_argument('-r','--readsize',default=64,type=int, help='Readsize in MiB, for the verification')
+    parser.add_argument('--verify-fraction',default=0.,type=float, dest='verify_fraction',
+                        help='Verify this fraction of the imported files with a full read')
+    parser.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file')
+    parser.add_argument('--keyring',default='/etc/ceph/ceph.client.xrootd.keyring', dest='keyring_file')
+    parser.add_argument('--cephuser',default='client.xrootd', dest='ceph_user')
+    parser.add_argument('catalogue', help='Catalogue file, or - for stdin')
+
+    args = parser.parse_args()
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    mapper = lfn2pfn.Lfn2PfnMapper() if args.lfn2pfn_xmlfile is None else lfn2pfn.Lfn2PfnMapper.from_file(args.lfn2pfn_xmlfile)
+    cluster = cephtools.cluster_connect(conffile=args.conf_file, keyring=args.keyring_file, name=args.ceph_user)
+    ioctxs = {}
+    def get_ioctx(pool):
+        if pool not in ioctxs:
+            ioctxs[pool] = cluster.open_ioctx(pool)
+        return ioctxs[pool]
+    lines = sys.stdin if args.catalogue == '-' else open(args.catalogue)
+    try:
+        counts = run_import(get_ioctx, lines, mapper, args.batch, verify_fraction=args.verify_fraction,
+                            readsize=args.readsize*1024*1024)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        for ioctx in ioctxs.values():
+            ioctx.close()
+        cluster.shutdown()
+
+    for k, v in counts.items():
+        sys.stdout.write(f'{k}: {v}\n')
+    sys.exit(0 if counts['failed'] == counts['size_mismatch'] == counts['conflict'] == counts['verify_failed'] == 0 else 1)
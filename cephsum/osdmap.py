@@ -0,0 +1,259 @@
+import logging
+import json, time, errno
+import threading, itertools
+from collections import OrderedDict, deque
+from fractions import Fraction
+from concurrent.futures import Future
+
+import rados
+
+# Scheduling of reads by the OSDs serving each object.
+# Reads of many stripes (of one or many files) are spread over the OSDs serving them, with a bounded
+# number in flight to each, rather than piling up on whichever OSD the workers happen to reach first.
+
+
+def _mix(a, b, c):
+    a = (a - b - c) & 0xFFFFFFFF; a ^= c >> 13
+    b = (b - c - a) & 0xFFFFFFFF; b ^= (a << 8) & 0xFFFFFFFF
+    c = (c - a - b) & 0xFFFFFFFF; c ^= b >> 13
+    a = (a - b - c) & 0xFFFFFFFF; a ^= c >> 12
+    b = (b - c - a) & 0xFFFFFFFF; b ^= (a << 16) & 0xFFFFFFFF
+    c = (c - a - b) & 0xFFFFFFFF; c ^= b >> 5
+    a = (a - b - c) & 0xFFFFFFFF; a ^= c >> 3
+    b = (b - c - a) & 0xFFFFFFFF; b ^= (a << 10) & 0xFFFFFFFF
+    c = (c - a - b) & 0xFFFFFFFF; c ^= b >> 15
+    return a, b, c
+
+
+def object_hash(name):
+    """The rjenkins hash of an object name (ceph_str_hash_rjenkins, the default object_hash of a pool)"""
+    k = name.encode() if isinstance(name, str) else bytes(name)
+    length = len(k)
+    a, b, c = 0x9e3779b9, 0x9e3779b9, 0
+    while len(k) >= 12:
+        a = (a + int.from_bytes(k[0:4], 'little')) & 0xFFFFFFFF
+        b = (b + int.from_bytes(k[4:8], 'little')) & 0xFFFFFFFF
+        c = (c + int.from_bytes(k[8:12], 'little')) & 0xFFFFFFFF
+        a, b, c = _mix(a, b, c)
+        k = k[12:]
+    # the last 11 bytes; the first byte of c is reserved for the length
+    c = (c + length + (int.from_bytes(k[8:11], 'little') << 8)) & 0xFFFFFFFF
+    b = (b + int.from_bytes(k[4:8], 'little')) & 0xFFFFFFFF
+    a = (a + int.from_bytes(k[0:4], 'little')) & 0xFFFFFFFF
+    return _mix(a, b, c)[2]
+
+
+def pg_of(name, pg_num):
+    """The placement seed (the x of PG pool.x) of an object in a pool of pg_num PGs (ceph_stable_mod of the hash)"""
+    mask = (1 << (pg_num - 1).bit_length()) - 1
+    ps = object_hash(name)
+    return ps & mask if (ps & mask) < pg_num else ps & (mask >> 1)
+
+
+class OsdMap:
+    """Resolve the acting set of OSDs of objects in a pool with the 'osd map' mon command.
+
+    Objects are hashed to their placement group locally (from the pg_num of the pool, itself refreshed every ttl seconds),
+    and the acting sets are cached per PG for ttl seconds, so that a mon command is only needed for the first object 
+    seen in each PG, rather than for each stripe. The local placement is checked against the mon answers; 
+    if it does not match (e.g. a pool with another object hash), the acting sets are cached per object instead,
+    for at most max_entries objects.
+    lookup(oid) can be given to resolve them otherwise (e.g. from a local osdmap snapshot);
+    it should return the list of acting OSD ids, primary first, or None if unknown.
+    """
+    def __init__(self, cluster, pool, ttl=300, max_entries=100000, lookup=None):
+        self.cluster = cluster
+        self.pool = pool
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lookup = self._mon_lookup if lookup is None else lookup
+        self.local_placement = True
+        self._pg_num = None
+        self._pg_num_expiry = 0.
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pg_num(self):
+        """The pg_num of the pool, refreshed every ttl seconds; None if it could not be found"""
+        now = time.monotonic()
+        if self._pg_num_expiry > now:
+            return self._pg_num
+        cmd = json.dumps({'prefix': 'osd pool get', 'pool': self.pool, 'var': 'pg_num', 'format': 'json'})
+        try:
+            ret, outbuf, outs = self.cluster.mon_command(cmd, b'')
+            pg_num = json.loads(outbuf)['pg_num'] if ret == 0 else None
+        except Exception as e:
+            ret, outs, pg_num = None, e, None
+        if pg_num is None:
+            logging.debug(f'pg_num of {self.pool} not found: {ret} {outs}; caching the acting sets per object')
+        self._pg_num, self._pg_num_expiry = pg_num, now + self.ttl
+        return pg_num
+
+    def _key(self, oid):
+        """The cache key of oid: its PG, with the local placement; otherwise the object itself"""
+        if self.local_placement:
+            pg_num = self.pg_num()
+            if pg_num:
+                return ('pg', pg_of(oid, pg_num))
+        return oid
+
+    def _mon_lookup(self, oid):
+        cmd = json.dumps({'prefix': 'osd map', 'pool': self.pool, 'object': oid, 'format': 'json'})
+        ret, outbuf, outs = self.cluster.mon_command(cmd, b'')
+        if ret != 0:
+            logging.debug(f'osd map failed for {self.pool} {oid}: {ret} {outs}')
+            return None
+        result = json.loads(outbuf)
+        self._check_placement(oid, result)
+        primary = result['acting_primary']
+        return [primary] + [osd for osd in result.get('acting', []) if osd != primary]
+
+    def _check_placement(self, oid, result):
+        """Compare the local placement of oid with the raw and actual PG in the osd map answer"""
+        if not self.local_placement or 'raw_pgid' not in result:
+            return
+        if int(result['raw_pgid'].split('.')[1], 16) != object_hash(oid):
+            logging.warning(f'Local placement does not match osd map for {self.pool} {oid} ({result["raw_pgid"]}); '
+                            f'caching the acting sets per object')
+            self.local_placement = False
+            self.invalidate()
+        elif self._pg_num and 'pgid' in result and int(result['pgid'].split('.')[1], 16) != pg_of(oid, self._pg_num):
+            # the PGs of the pool were split or merged
+            logging.debug(f'pg_num of {self.pool} changed; refreshing')
+            self._pg_num_expiry = 0.
+            self.invalidate()
+
+    def acting(self, oid):
+        """Return the tuple of acting OSD ids of oid, primary first; empty if it could not be resolved"""
+        now = time.monotonic()
+        key = self._key(oid)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[1] > now:
+                self._cache.move_to_end(key)
+                return cached[0]
+        try:
+            osds = tuple(self.lookup(oid) or ())
+        except Exception as e:
+            logging.debug(f'Acting set lookup failed for {oid}: {e}')
+            osds = ()
+        key = self._key(oid)
+        with self._lock:
+            self._cache[key] = (osds, now + self.ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return osds
+
+    def primary(self, oid):
+        """Return the id of the acting primary OSD of oid; None if it could not be resolved"""
+        osds = self.acting(oid)
+        return osds[0] if osds else None
+
+    def invalidate(self, oid=None):
+        """Forget the cached acting set of (the PG of) oid, or of all objects (e.g. after an osdmap change)"""
+        with self._lock:
+            if oid is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(oid, None)
+                if self._pg_num:
+                    self._cache.pop(('pg', pg_of(oid, self._pg_num)), None)
+
+
+class OsdScheduler:
+    """Issue aio reads on ioctx, with at most max_per_osd in flight to each OSD, and max_inflight in total.
+
+    Queued reads are started for the least busy OSDs first (then oldest first), so that the requests are spread
+    evenly over the OSDs. Reads for objects whose OSDs are unknown share one queue.
+    If replicas, ioctx reads from any replica (see cephtools.cluster_connect with rados_replica_read_policy), and each
+    read counts as an equal fraction of a read on every OSD of the acting set; otherwise as one read on the primary.
+    submit returns a concurrent.futures.Future of the data; read waits for it, so that the scheduler can also be used
+    as the reader of the cephtools read functions, shared by many threads. Reads cancelled while queued are not started.
+    """
+    def __init__(self, ioctx, osdmap, max_per_osd=2, max_inflight=32, replicas=False):
+        self.ioctx = ioctx
+        self.osdmap = osdmap
+        self.max_per_osd = max_per_osd
+        self.max_inflight = max_inflight
+        self.replicas = replicas
+        self.queues = {}
+        self.inflight = {}
+        self.peak_inflight = {}
+        self.total_inflight = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _targets(self, oid):
+        if self.replicas:
+            return self.osdmap.acting(oid) or (None,)
+        return (self.osdmap.primary(oid),)
+
+    def submit(self, oid, length, offset=0):
+        """Queue a read of up to length bytes at offset from oid; returns a Future of the data"""
+        osds = self._targets(oid)
+        future = Future()
+        with self._lock:
+            self.queues.setdefault(osds, deque()).append((next(self._seq), oid, length, offset, future))
+        self._dispatch()
+        return future
+
+    def read(self, oid, length, offset=0):
+        return self.submit(oid, length, offset).result()
+
+    def _dispatch(self):
+        started = []
+        with self._lock:
+            while self.total_inflight < self.max_inflight:
+                candidates = []
+                for osds, queue in self.queues.items():
+                    if not queue:
+                        continue
+                    share = Fraction(1, len(osds))
+                    loads = [self.inflight.get(osd, 0) for osd in osds]
+                    if all(load + share <= self.max_per_osd for load in loads):
+                        candidates.append((max(loads), queue[0][0], osds))
+                if not candidates:
+                    break
+                _, _, osds = min(candidates)
+                request = self.queues[osds].popleft()
+                if not request[-1].set_running_or_notify_cancel():
+                    # cancelled while queued (e.g. by read_file_scheduled, when the reading stopped early)
+                    continue
+                started.append((osds, request))
+                self._account(osds, 1)
+                self.total_inflight += 1
+        for osds, request in started:
+            self._start(osds, *request)
+
+    def _account(self, osds, sign):
+        # exact fractions, so that the shares of a read add back up to whole reads
+        share = Fraction(1, len(osds))
+        for osd in osds:
+            load = self.inflight.get(osd, 0) + sign * share
+            self.inflight[osd] = load
+            self.peak_inflight[osd] = max(self.peak_inflight.get(osd, 0), load)
+
+    def _release(self, osds):
+        with self._lock:
+            self._account(osds, -1)
+            self.total_inflight -= 1
+        self._dispatch()
+
+    def _start(self, osds, seq, oid, length, offset, future):
+        def oncomplete(completion, data=None):
+            ret = completion.get_return_value()
+            self._release(osds)
+            if future.done():
+                return
+            if ret == -errno.ENOENT:
+                future.set_exception(rados.ObjectNotFound(f"Read failed for {oid}: {ret}", errno=-ret))
+            elif ret < 0:
+                future.set_exception(IOError(f"Read failed for {oid} at offset {offset}: {ret}"))
+            else:
+                future.set_result(data)
+        try:
+            self.ioctx.aio_read(oid, length, offset, oncomplete)
+        except Exception as e:
+            self._release(osds)
+            future.set_exception(e)
@@ -0,0 +1,200 @@
+import logging
+import struct
+from array import array
+
+import adler32
+
+# Per-page crc32c checksums of each stripe object, as needed by the xrootd pgread/pgwrite protocol, computed in the
+# same pass over the data as the adler32 (cephsum.py --page-crcs) and stored with the stripe, so that page reads
+# can be answered by slicing the stored array rather than recomputing.
+#
+# Stored per stripe as a header (magic, page size, stripe length) followed by one little endian uint32 per page,
+# either in the PAGE_XATTR xattr of the stripe object, or in a sidecar object named <stripe oid>.pgcrc32c.
+
+try:
+    import rados
+except ImportError:
+    # librados python bindings not available; the page checksums can still be calculated
+    rados = None
+
+# the errors of a stripe, or its xattr, not existing
+_not_stored = () if rados is None else (rados.ObjectNotFound, rados.NoData)
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    # the pure python version is correct but slow (a few MB/s); install the crc32c package for production use
+    _crc32c = None
+
+# whether crc32c uses the crc32c package, rather than the pure python version
+ACCELERATED = _crc32c is not None
+
+PAGE_SIZE = 4096
+PAGE_XATTR = 'cephsum.pgcrc32c'
+SIDECAR_SUFFIX = '.pgcrc32c'
+_header = struct.Struct('<4sIQ')
+_MAGIC = b'PGC1'
+
+
+def _make_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_table = _make_table()
+
+
+def crc32c(data, value=0):
+    """crc32c (Castagnoli) of data, continuing from value (the crc32c of the preceding data)"""
+    if _crc32c is not None:
+        return _crc32c.crc32c(data, value)
+    crc = value ^ 0xFFFFFFFF
+    table = _table
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+class PageCrcBuilder:
+    """Calculate the crc32c of each page of each stripe from the buffers of a file read in order (see feed).
+    The arrays are available from stripes, as a dict of stripe index to array('I') of the page checksums;
+    stripes read only as zeros (holes of a sparse file, with no stripe object) are listed in holes."""
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.stripes = {}
+        self.lengths = {}
+        self.holes = set()
+        self._zero_page = None
+
+    def feed(self, buffers, object_size):
+        """Yield the buffers (bytes, or adler32.ZeroRun) unchanged, adding their pages to the stripe arrays;
+        stripes are object_size bytes, which should be a multiple of the page size.
+        Should adding the pages fail, the arrays are dropped (stripes is empty) and the buffers still yielded."""
+        if object_size % self.page_size:
+            raise ValueError(f'Object size {object_size} is not a multiple of the page size {self.page_size}')
+        offset = 0
+        failed = False
+        for buf in buffers:
+            if not failed:
+                try:
+                    self._add(buf, offset, object_size)
+                except Exception as e:
+                    logging.warning(f'Could not calculate the page checksums: {e}')
+                    self.stripes.clear()
+                    failed = True
+            offset += len(buf)
+            yield buf
+
+    def _add(self, buf, offset, object_size):
+        page_size = self.page_size
+        zeros = isinstance(buf, adler32.ZeroRun)
+        position = 0
+        while position < len(buf):
+            stripe, in_stripe = divmod(offset + position, object_size)
+            if stripe not in self.stripes:
+                self.stripes[stripe] = array('I')
+                if zeros and in_stripe == 0:
+                    self.holes.add(stripe)
+            if not zeros:
+                self.holes.discard(stripe)
+            pages = self.stripes[stripe]
+            in_page = in_stripe % page_size
+            n = min(page_size - in_page, len(buf) - position)
+            if zeros:
+                if in_page == 0 and n == page_size:
+                    # whole zero pages, up to the end of the run or stripe
+                    count = min(len(buf) - position, object_size - in_stripe) // page_size
+                    pages.extend([self._zero_page_crc()] * count)
+                    n = count * page_size
+                else:
+                    self._extend_page(pages, in_page, bytes(n))
+            else:
+                self._extend_page(pages, in_page, memoryview(buf)[position:position + n])
+            self.lengths[stripe] = in_stripe + n
+            position += n
+
+    def _extend_page(self, pages, in_page, data):
+        if in_page == 0:
+            pages.append(crc32c(data))
+        else:
+            pages[-1] = crc32c(data, pages[-1])
+
+    def _zero_page_crc(self):
+        if self._zero_page is None:
+            self._zero_page = crc32c(bytes(self.page_size))
+        return self._zero_page
+
+    def encoded(self, stripe):
+        """The stored form of the array of a stripe"""
+        pages = array('I', self.stripes[stripe])
+        if pages.itemsize != 4:
+            raise ValueError('No 4 byte unsigned int array type')
+        if struct.pack('=I', 1) != struct.pack('<I', 1):
+            pages.byteswap()
+        return _header.pack(_MAGIC, self.page_size, self.lengths[stripe]) + pages.tobytes()
+
+
+def decode(value):
+    """Return page size, stripe length and the list of page checksums from a stored value"""
+    magic, page_size, length = _header.unpack_from(value)
+    if magic != _MAGIC:
+        raise ValueError(f'Not a page checksum array: {bytes(value[:4])}')
+    count = (len(value) - _header.size) // 4
+    return page_size, length, list(struct.unpack_from(f'<{count}I', value, _header.size))
+
+
+def store(ioctx, path, builder, sidecar=False):
+    """Store the arrays of all stripes in builder, for the file path, in the stripe xattrs or sidecar objects.
+    Holes have no stripe object to hold an xattr (and setting one would create it), so are only stored in sidecars."""
+    for stripe in sorted(builder.stripes):
+        oid = path + f'.{stripe:016x}'
+        value = builder.encoded(stripe)
+        if sidecar:
+            ioctx.write_full(oid + SIDECAR_SUFFIX, value)
+        elif stripe in builder.holes:
+            logging.debug(f'No page checksums stored for the hole at {oid}')
+        else:
+            ioctx.set_xattr(oid, PAGE_XATTR, value)
+    logging.debug(f'Stored page checksums of {len(builder.stripes)} stripes of {path}')
+
+
+def _stored_pages(ioctx, oid, first, last, sidecar):
+    """Checksums of pages first to last (inclusive) of the stripe oid, and the stripe length"""
+    if sidecar:
+        header = ioctx.read(oid + SIDECAR_SUFFIX, _header.size, 0)
+        if len(header) < _header.size:
+            raise ValueError(f'Truncated page checksums of {oid}')
+        value = ioctx.read(oid + SIDECAR_SUFFIX, (last - first + 1) * 4, _header.size + first * 4)
+        page_size, length, pages = decode(bytes(header) + bytes(value))
+    else:
+        page_size, length, pages = decode(ioctx.get_xattr(oid, PAGE_XATTR))
+        pages = pages[first:last + 1]
+    if page_size != PAGE_SIZE:
+        raise ValueError(f'Page checksums of {oid} are for {page_size} byte pages')
+    return pages, length
+
+
+def page_checksums(ioctx, path, offset, length, object_size, sidecar=False):
+    """Return the crc32c of the PAGE_SIZE pages overlapping the byte range [offset, offset+length) of the file, in order,
+    from the stored arrays (object_size is the stripe size, e.g. from striper.layout.object_size).
+    Only the part of the array needed is read from sidecar objects.
+    Raises KeyError if the checksums of a stripe are not stored, or do not cover the range."""
+    checksums = []
+    end = offset + length
+    for stripe in range(offset // object_size, (end - 1) // object_size + 1 if length > 0 else 0):
+        oid = path + f'.{stripe:016x}'
+        start = max(offset - stripe * object_size, 0)
+        stop = min(end - stripe * object_size, object_size)
+        first, last = start // PAGE_SIZE, (stop - 1) // PAGE_SIZE
+        try:
+            pages, stripe_length = _stored_pages(ioctx, oid, first, last, sidecar)
+        except _not_stored:
+            raise KeyError(f'No page checksums stored for {oid}')
+        if stop > stripe_length or len(pages) < last - first + 1:
+            raise KeyError(f'Page checksums of {oid} do not cover bytes {start}-{stop}')
+        checksums.extend(pages)
+    return checksums
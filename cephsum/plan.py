@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Plan a bulk checksum job (e.g. a pool-wide verification, or backfill of missing checksums)
+# before running it: how many objects and bytes, and how long it is expected to take.
+# Only striper.size and the presence of the XrdCks xattr are read for each file.
+# The plan is written as json, and can be run with bulk.py --plan <file>
+
+
+import logging,argparse
+import sys, os, time
+import json, math, random
+import itertools, zlib
+
+import cephtools
+import poolindex
+
+PLAN_VERSION = 1
+
+
+def list_base_paths(ioctx, sample_fraction=1.0, rng=None):
+    """Yield the path of each file in the pool, from its chunk0 object.
+    If sample_fraction < 1, only a random sample of that fraction of the files is returned."""
+    rng = random.Random() if rng is None else rng
+    for obj in ioctx.list_objects():
+        if not obj.key.endswith(cephtools.chunk0):
+            continue
+        if sample_fraction < 1 and rng.random() >= sample_fraction:
+            continue
+        yield obj.key[:-len(cephtools.chunk0)]
+
+
+def size_bucket(size):
+    """Histogram bucket for a size in bytes: the next power of 2 (0 for empty files)"""
+    return 0 if size == 0 else 2**math.ceil(math.log2(size))
+
+
+def measure_throughput(ioctx, paths, readsize=64*1024*1024, max_files=3, reads_per_file=4):
+    """Read (and checksum) the first reads_per_file readsize blocks of up to max_files of the given files, 
+    and return the measured bytes per second for a single stream; None if nothing could be read.
+    At most max_files * reads_per_file * readsize bytes are read, whatever the size of the files."""
+    bytes_read, seconds = 0, 0.
+    for path in paths[:max_files]:
+        start = time.monotonic()
+        try:
+            object_size, total_size, num_stripes, _ = cephtools.get_striper_xattrs(ioctx, path)
+            value, reads = 1, 0
+            for buf in cephtools.read_file_btyes(ioctx, path, object_size, num_stripes, readsize):
+                value = zlib.adler32(buf, value)
+                bytes_read += len(buf)
+                reads += 1
+                if reads >= reads_per_file:
+                    break
+        except Exception as e:
+            logging.warning(f'Throughput measurement failed for {path}: {e}')
+            continue
+        seconds += time.monotonic() - start
+    if bytes_read == 0 or seconds == 0:
+        return None
+    return bytes_read / seconds
+
+
+def make_plan(ioctx, pool, paths, action='inget', sample_fraction=1.0, throughput=None, workers=1,
+              xattr_name='XrdCks.adler32', batch_size=10000):
+    """Build the plan for running action over paths.
+
+    For inget, only the files lacking a checksum need to be read; for verify, all files are read.
+    With a sample, the totals are scaled up by 1/sample_fraction, but only the sampled paths are listed.
+    throughput is the bytes per second of a single stream, used with workers for the projected duration.
+    paths can be an iterator (e.g. of a pool listing); the xattrs are read for batch_size paths at a time.
+    """
+    histogram = {}
+    objects, no_checksum, no_size = 0, 0, 0
+    bytes_total, bytes_to_read = 0, 0
+    to_process = []
+    for path, values in _batched_xattrs(ioctx, paths, ['striper.size', xattr_name], batch_size):
+        objects += 1
+        size = values['striper.size']
+        size = None if size is None else int(size)
+        has_checksum = values[xattr_name] is not None
+        if size is None:
+            no_size += 1
+        else:
+            bucket = str(size_bucket(size))
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+            bytes_total += size
+        if not has_checksum:
+            no_checksum += 1
+        if action == 'verify' or not has_checksum:
+            to_process.append(path)
+            bytes_to_read += 0 if size is None else size
+
+    scale = 1. / sample_fraction
+    summary = {'objects': round(objects * scale),
+               'objects_without_checksum': round(no_checksum * scale),
+               'objects_without_striper_size': round(no_size * scale),
+               'objects_to_process': round(len(to_process) * scale),
+               'bytes_total': round(bytes_total * scale),
+               'bytes_to_read': round(bytes_to_read * scale),
+               }
+
+    plan = {'version': PLAN_VERSION,
+            'pool': pool,
+            'action': action,
+            'xattr_name': xattr_name,
+            'created': time.time(),
+            'sample_fraction': sample_fraction,
+            'summary': summary,
+            'histogram': {k: histogram[k] for k in sorted(histogram, key=int)},
+            'paths': to_process,
+            }
+    return project_duration(plan, throughput, workers)
+
+
+def _batched_xattrs(ioctx, paths, xattr_names, batch_size):
+    """Yield each path with the dict of its xattr values, reading those of batch_size paths at a time"""
+    paths = iter(paths)
+    while True:
+        batch = list(itertools.islice(paths, batch_size))
+        if not batch:
+            return
+        values = cephtools.retrieve_xattrs(ioctx, batch, xattr_names)
+        for path in batch:
+            yield path, values[path]
+
+
+def project_duration(plan, throughput, workers=1):
+    """Set the projected duration in the plan, for throughput bytes per second from each of workers streams"""
+    summary = plan['summary']
+    summary['throughput_bytes_per_s'] = throughput
+    summary['workers'] = workers
+    summary['projected_hours'] = None
+    if throughput:
+        summary['projected_hours'] = summary['bytes_to_read'] / (throughput * workers) / 3600.
+    return plan
+
+
+def write_plan(plan, filename):
+    with open(filename, 'w') as f:
+        json.dump(plan, f, indent=1)
+
+
+def read_plan(filename):
+    with open(filename) as f:
+        plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError(f"Plan {filename} has version {plan.get('version')}, expected {PLAN_VERSION}")
+    return plan
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Plan a bulk checksum job over a pool, reading only metadata')
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+    parser.add_argument('-a','--action',default='inget', choices=['inget','verify'],
+                        help='inget: read only files without a stored checksum. verify: read all files')
+    parser.add_argument('-s','--sample',default=1.0,type=float, dest='sample_fraction',
+                        help='Fraction of the files to sample, e.g. 0.01; totals are scaled up accordingly')
+    parser.add_argument('-i','--input',default=None, dest='input',
+                        help='File with one path per line, instead of listing the pool')
+    parser.add_argument('--index',default=None, dest='index_file',
+                        help='Index of the pool built with poolindex.py, instead of listing the pool')
+    parser.add_argument('-o','--output',default='plan.json', dest='output', help='Plan file to write')
+    parser.add_argument('-w','--workers',default=1,type=int, help='Number of parallel streams the job will use')
+    parser.add_argument('-t','--throughput',default=None,type=float,
+                        help='Throughput of a single stream in MiB/s; if not given, measured by reading a few of the files')
+    parser.add_argument('-r','--readsize',default=64,type=int, help='Readsize in MiB for the throughput measurement')
+    parser.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file')
+    parser.add_argument('--keyring',default='/etc/ceph/ceph.client.xrootd.keyring', dest='keyring_file')
+    parser.add_argument('--cephuser',default='client.xrootd', dest='ceph_user')
+    parser.add_argument('pool')
+
+    args = parser.parse_args()
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    cluster = cephtools.cluster_connect(conffile=args.conf_file, keyring=args.keyring_file, name=args.ceph_user)
+    try:
+        with cluster.open_ioctx(args.pool) as ioctx:
+            index = None
+            if args.input is not None:
+                f = open(args.input)
+                paths = (line.strip() for line in f if line.strip())
+                if args.sample_fraction < 1:
+                    paths = (p for p in paths if random.random() < args.sample_fraction)
+            elif args.index_file is not None:
+                index = poolindex.PoolIndex(args.index_file)
+                paths = index.paths(args.sample_fraction)
+            else:
+                paths = list_base_paths(ioctx, args.sample_fraction)
+            logging.info(f'Planning {args.action} over the files in {args.pool}')
+
+            throughput = None if args.throughput is None else args.throughput*1024*1024
+            try:
+                plan = make_plan(ioctx, args.pool, paths, args.action, args.sample_fraction, throughput, args.workers)
+            finally:
+                if index is not None:
+                    index.close()
+                if args.input is not None:
+                    f.close()
+            if throughput is None:
+                throughput = measure_throughput(ioctx, plan['paths'], args.readsize*1024*1024)
+                project_duration(plan, throughput, args.workers)
+    finally:
+        cluster.shutdown()
+
+    write_plan(plan, args.output)
+    for k, v in plan['summary'].items():
+        sys.stdout.write(f'{k}: {v}\n')
+    for k, v in plan['histogram'].items():
+        sys.stdout.write(f'size <= {k}: {v}\n')
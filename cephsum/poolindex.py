@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# Persistent index of the files (chunk0 objects) in a pool, for bulk operations (e.g. plan.py --index).
+# The pool is listed by placement group, with many PGs listed concurrently, and only the chunk0 oids are kept.
+# Each PG is stored as it completes, so an interrupted build continues where it stopped, and a refresh only
+# re-lists the PGs listed longer ago than a given age.
+#
+#   poolindex.py -i dteam.db build -w 16 dteam     list all PGs not yet in the index
+#   poolindex.py -i dteam.db refresh --max-age 86400 dteam
+#   poolindex.py -i dteam.db stats
+
+
+import logging,argparse
+import sys, os, time
+import json, random
+import sqlite3
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available; an existing index can still be read
+    cephtools = None
+
+chunk0=f'.{0:016x}' # Chunks are hex valued
+
+
+def pool_shards(cluster, pool):
+    """Return the placement group ids of the pool, e.g. ['3.0', '3.1', ...]"""
+    pool_id = cluster.pool_lookup(pool)
+    cmd = json.dumps({'prefix': 'osd pool get', 'pool': pool, 'var': 'pg_num', 'format': 'json'})
+    ret, outbuf, outs = cluster.mon_command(cmd, b'')
+    if ret != 0:
+        raise IOError(f'Could not get pg_num of {pool}: {ret} {outs}')
+    pg_num = json.loads(outbuf)['pg_num']
+    return [f'{pool_id}.{ps:x}' for ps in range(pg_num)]
+
+
+def rados_pg_lister(pool, conf_file='/etc/ceph/ceph.conf', keyring_file='/etc/ceph/ceph.client.xrootd.keyring',
+                    ceph_user='client.xrootd'):
+    """Return a function listing the oids in one PG of the pool, with the rados command line tool
+    (the python bindings can not list a single PG)"""
+    def list_shard(pgid):
+        cmd = ['rados', '-c', conf_file, '--keyring', keyring_file, '--name', ceph_user,
+               '-p', pool, '--pgid', pgid, 'ls']
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True) as proc:
+            for line in proc.stdout:
+                yield line.rstrip('\n')
+            stderr = proc.stderr.read()
+        if proc.returncode != 0:
+            raise IOError(f'Listing of PG {pgid} failed: {proc.returncode} {stderr.strip()}')
+    return list_shard
+
+
+def base_paths(oids):
+    """The base paths of the chunk0 oids, dropping all other stripes"""
+    return [oid[:-len(chunk0)] for oid in oids if oid.endswith(chunk0)]
+
+
+class PoolIndex:
+    """Base paths of the files in a pool, in a local sqlite database, with the PG (shard) each was listed from"""
+    _schema = """CREATE TABLE IF NOT EXISTS paths (
+                    path TEXT PRIMARY KEY,
+                    shard TEXT NOT NULL,
+                    listed REAL NOT NULL);
+                 CREATE INDEX IF NOT EXISTS paths_shard ON paths (shard);
+                 CREATE TABLE IF NOT EXISTS shards (
+                    shard TEXT PRIMARY KEY,
+                    listed REAL NOT NULL,
+                    count INTEGER NOT NULL);
+              """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self._schema)
+
+    def close(self):
+        self.conn.close()
+
+    def store_shard(self, shard, paths, listed=None):
+        """Replace the paths of one shard with those just listed"""
+        listed = time.time() if listed is None else listed
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany("INSERT OR REPLACE INTO paths (path, shard, listed) VALUES (?, ?, ?)",
+                             ((path, shard, listed) for path in paths))
+            conn.execute("DELETE FROM paths WHERE shard = ? AND listed < ?", (shard, listed))
+            conn.execute("INSERT OR REPLACE INTO shards (shard, listed, count) VALUES (?, ?, ?)",
+                         (shard, listed, len(paths)))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stale_shards(self, shards, max_age=None):
+        """The shards never listed, or (if max_age is given) listed more than max_age seconds ago"""
+        listed = dict(self.conn.execute("SELECT shard, listed FROM shards"))
+        now = time.time()
+        return [shard for shard in shards
+                if shard not in listed or (max_age is not None and listed[shard] < now - max_age)]
+
+    def refresh(self, list_shard, shards, workers=8, max_age=None):
+        """List the stale shards (see stale_shards) concurrently with list_shard(shard), an iterable of oids,
+        and store the chunk0 paths of each. Shards no longer in the pool are dropped.
+        Returns the number of shards listed, and those that failed."""
+        known = [row[0] for row in self.conn.execute("SELECT shard FROM shards")]
+        for shard in set(known) - set(shards):
+            self.conn.execute("DELETE FROM paths WHERE shard = ?", (shard,))
+            self.conn.execute("DELETE FROM shards WHERE shard = ?", (shard,))
+
+        todo = self.stale_shards(shards, max_age)
+        logging.info(f'Listing {len(todo)} of {len(shards)} shards with {workers} workers')
+
+        def list_paths(shard):
+            listed = time.time()
+            return listed, base_paths(list_shard(shard))
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(list_paths, shard): shard for shard in todo}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    listed, paths = future.result()
+                except Exception as e:
+                    logging.warning(f'Listing of shard {shard} failed: {e}')
+                    failed.append(shard)
+                    continue
+                self.store_shard(shard, paths, listed)
+        return len(todo) - len(failed), failed
+
+    def paths(self, sample_fraction=1.0, rng=None):
+        """Yield the indexed base paths; if sample_fraction < 1, only a random sample of that fraction"""
+        rng = random.Random() if rng is None else rng
+        for path, in self.conn.execute("SELECT path FROM paths ORDER BY path"):
+            if sample_fraction < 1 and rng.random() >= sample_fraction:
+                continue
+            yield path
+
+    def stats(self):
+        """Dict of the number of paths and shards, and the age in seconds of the oldest and newest shard listing"""
+        paths = self.conn.execute("SELECT count(*) FROM paths").fetchone()[0]
+        shards, oldest, newest = self.conn.execute("SELECT count(*), min(listed), max(listed) FROM shards").fetchone()
+        now = time.time()
+        return {'paths': paths, 'shards': shards,
+                'oldest_listing_s': None if oldest is None else now - oldest,
+                'newest_listing_s': None if newest is None else now - newest}
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Persistent index of the files in a pool, listed by placement group')
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+    parser.add_argument('-i','--index',required=True, dest='index_file', help='Location of the index database')
+    subparsers = parser.add_subparsers(dest='command')
+
+    for command, help_text in [('build', 'List the PGs not yet in the index'),
+                               ('refresh', 'List the PGs not yet in the index, or listed longer ago than --max-age')]:
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument('-w','--workers',default=8,type=int, help='Number of PGs listed concurrently')
+        sub.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file')
+        sub.add_argument('--keyring',default='/etc/ceph/ceph.client.xrootd.keyring', dest='keyring_file')
+        sub.add_argument('--cephuser',default='client.xrootd', dest='ceph_user')
+        sub.add_argument('pool')
+        if command == 'refresh':
+            sub.add_argument('--max-age',default=86400,type=float, dest='max_age',
+                             help='Re-list the PGs listed more than this many seconds ago')
+
+    subparsers.add_parser('stats', help='Print the number of paths and the age of the listings')
+
+    args = parser.parse_args()
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    index = PoolIndex(args.index_file)
+    if args.command == 'stats':
+        for k, v in index.stats().items():
+            sys.stdout.write(f'{k}: {v}\n')
+    elif args.command in ('build', 'refresh'):
+        cluster = cephtools.cluster_connect(conffile=args.conf_file, keyring=args.keyring_file, name=args.ceph_user)
+        try:
+            shards = pool_shards(cluster, args.pool)
+        finally:
+            cluster.shutdown()
+        list_shard = rados_pg_lister(args.pool, args.conf_file, args.keyring_file, args.ceph_user)
+        max_age = args.max_age if args.command == 'refresh' else None
+        listed, failed = index.refresh(list_shard, shards, args.workers, max_age)
+        logging.info(f'Listed {listed} PGs of {args.pool}, failed: {len(failed)}; {index.stats()}')
+        if failed:
+            sys.exit(1)
+    else:
+        parser.print_help()
+        sys.exit(1)
+    index.close()
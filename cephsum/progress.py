@@ -0,0 +1,166 @@
+import logging
+import os, json, time
+import threading, itertools
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available; reads can not be submitted ahead without a reader that can
+    cephtools = None
+
+# Live progress of the checksum computations on a host: each computation publishes its state as a small json file
+# in a shared local directory (in memory, under /dev/shm by default), which top.py shows.
+
+DEFAULT_REGISTRY = '/dev/shm/cephsum'
+
+_counter = itertools.count()
+
+
+class Progress:
+    """Progress of one checksum computation, published in the registry directory at most every interval seconds
+    (and at the start of each stripe). The file is created at the first update, and removed by close."""
+    def __init__(self, action, pool, path, total_size=None, registry=DEFAULT_REGISTRY, interval=1.0):
+        self.action = action
+        self.pool = pool
+        self.path = path
+        self.total_size = total_size
+        self.registry = registry
+        self.interval = interval
+        self.filename = os.path.join(registry, f'{os.getpid()}-{next(_counter)}.json')
+        self.started = None
+        self.bytes_done = 0
+        self.stripe = None
+        self.reading = False
+        self.last_progress = None
+        self._published = 0.
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def update(self, nbytes=0, stripe=None, reading=False):
+        """Add nbytes done; stripe is the index of the stripe being read, reading whether a read is in flight"""
+        now = time.time()
+        with self._lock:
+            if self.started is None:
+                self.started = now
+            self.bytes_done += nbytes
+            new_stripe = stripe is not None and stripe != self.stripe
+            if stripe is not None:
+                self.stripe = max(stripe, self.stripe or 0)
+            self.reading = reading
+            if nbytes or self.last_progress is None:
+                self.last_progress = now
+            if new_stripe or now - self._published >= self.interval:
+                self._published = now
+                self._publish(now)
+
+    def state(self, now=None):
+        now = time.time() if now is None else now
+        elapsed = now - self.started if self.started is not None else 0.
+        return {'pid': os.getpid(), 'action': self.action, 'pool': self.pool, 'path': self.path,
+                'bytes_done': self.bytes_done, 'total_size': self.total_size, 'stripe': self.stripe,
+                'reading': self.reading, 'started': self.started, 'last_progress': self.last_progress,
+                'updated': now, 'rate_bytes_per_s': self.bytes_done / elapsed if elapsed > 0 else None}
+
+    def _publish(self, now):
+        if self._failed:
+            return
+        tmp = self.filename + '.tmp'
+        try:
+            os.makedirs(self.registry, exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(self.state(now), f)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            # progress is only informative; give up for this computation
+            logging.debug(f'Could not publish progress to {self.filename}: {e}')
+            self._failed = True
+
+    def close(self):
+        with self._lock:
+            self._failed = True
+        for filename in [self.filename, self.filename + '.tmp']:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+
+class ProgressReader:
+    """Reader (see cephtools.read_oid_bytes) updating a Progress with each read.
+    Reads are made from ioctx, or through reader (e.g. a cephtools.HedgedReader) if given. Reads can be submitted ahead
+    if reader can (an osdmap.OsdScheduler), or without a reader, as aio reads on ioctx (see cephtools.aio_read).
+    The total size of the file is set by the read functions with set_total_size, from the layout they read anyway."""
+    def __init__(self, progress, ioctx, reader=None):
+        self.progress = progress
+        self.ioctx = ioctx
+        self.reader = reader
+        if hasattr(reader, 'submit') or (reader is None and cephtools is not None and hasattr(ioctx, 'aio_read')):
+            self.submit = self._submit
+
+    @staticmethod
+    def _stripe(oid):
+        try:
+            return int(oid.rsplit('.', 1)[1], 16)
+        except (IndexError, ValueError):
+            return None
+
+    def set_total_size(self, total_size):
+        self.progress.total_size = total_size
+
+    def _start(self, oid):
+        self.progress.update(stripe=self._stripe(oid), reading=True)
+
+    def read(self, oid, length, offset=0):
+        self._start(oid)
+        if self.reader is not None:
+            data = self.reader.read(oid, length, offset)
+        else:
+            data = self.ioctx.read(oid, length, offset)
+        self.progress.update(len(data))
+        return data
+
+    def _submit(self, oid, length, offset=0):
+        self._start(oid)
+        if self.reader is not None:
+            future = self.reader.submit(oid, length, offset)
+        else:
+            future = cephtools.aio_read(self.ioctx, oid, length, offset)
+        future.add_done_callback(lambda f: self.progress.update(0 if f.cancelled() or f.exception() else len(f.result())))
+        return future
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def list_progress(registry=DEFAULT_REGISTRY, remove_stale=True):
+    """States of the computations in the registry; files left by processes no longer running are removed"""
+    states = []
+    try:
+        filenames = os.listdir(registry)
+    except FileNotFoundError:
+        return states
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        full = os.path.join(registry, filename)
+        try:
+            with open(full) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not pid_alive(state['pid']):
+            if remove_stale:
+                try:
+                    os.unlink(full)
+                except OSError:
+                    pass
+            continue
+        states.append(state)
+    return states
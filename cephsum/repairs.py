@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Durable local journal of metadata repairs that need not be made while a client waits, e.g. the rewrite of a
+# big endian XrdCks xattr as little endian by actions.inget (cephsum.py --repair-journal). A background worker
+# applies the journal in batches, with aio write operations.
+#
+#   repairs.py run --interval 5        apply the journal as it fills
+#   repairs.py stats                   journal depth and age
+
+
+import logging,argparse
+import sys, os, time, errno
+import sqlite3
+import threading
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available; only the journal itself can be used
+    cephtools = None
+
+
+class RepairJournal:
+    """Pending xattr writes in a local sqlite database, at most one per (pool, path, xattr name): a later
+    repair of the same xattr replaces the pending one.
+    Each repair carries the value it expects to replace; it is dropped, rather than applied, if the xattr
+    changed in the meantime (e.g. a new checksum was stored after a transfer).
+    A failed repair is retried after retry_delay seconds, up to max_attempts times.
+    Each thread uses its own database connection.
+    """
+    _schema = """CREATE TABLE IF NOT EXISTS repairs (
+                    pool TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    xattr_name TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    expected BLOB,
+                    queued REAL NOT NULL,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    PRIMARY KEY (pool, path, xattr_name));
+                 CREATE INDEX IF NOT EXISTS repairs_order ON repairs (not_before, queued);
+              """
+
+    def __init__(self, filename='/var/spool/cephsum/repairs.db', max_attempts=3, retry_delay=60):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(self._schema)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def record(self, pool, path, xattr_name, value, expected=None):
+        """Journal a write of value to the xattr; if expected is given, only to replace that value"""
+        self._connection().execute(
+            """INSERT OR REPLACE INTO repairs (pool, path, xattr_name, value, expected, queued)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (pool, path, xattr_name, bytes(value), None if expected is None else bytes(expected), time.time()))
+
+    def pending(self, limit=1000):
+        """Up to limit repairs due, oldest first, as tuples of (pool, path, xattr_name, value, expected, queued)"""
+        return self._connection().execute(
+            """SELECT pool, path, xattr_name, value, expected, queued FROM repairs WHERE not_before <= ?
+               ORDER BY queued LIMIT ?""", (time.time(), limit)).fetchall()
+
+    def done(self, repair):
+        """Remove the repair, unless it was replaced by a later one"""
+        pool, path, xattr_name, value, expected, queued = repair
+        self._connection().execute("DELETE FROM repairs WHERE pool = ? AND path = ? AND xattr_name = ? AND queued = ?",
+                                   (pool, path, xattr_name, queued))
+
+    def failed(self, repair, error):
+        """Retry the repair later, or drop it after max_attempts"""
+        pool, path, xattr_name, value, expected, queued = repair
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("""SELECT attempts FROM repairs WHERE pool = ? AND path = ? AND xattr_name = ?
+                                  AND queued = ?""", (pool, path, xattr_name, queued)).fetchone()
+            if row is not None and row[0] + 1 >= self.max_attempts:
+                logging.warning(f'Dropping repair of {xattr_name} of {pool}:{path} after {row[0] + 1} attempts: {error}')
+                conn.execute("DELETE FROM repairs WHERE pool = ? AND path = ? AND xattr_name = ? AND queued = ?",
+                             (pool, path, xattr_name, queued))
+            elif row is not None:
+                conn.execute("""UPDATE repairs SET attempts = attempts + 1, not_before = ?, error = ?
+                                WHERE pool = ? AND path = ? AND xattr_name = ? AND queued = ?""",
+                             (time.time() + self.retry_delay, str(error), pool, path, xattr_name, queued))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stats(self):
+        """Dict of the number of pending repairs, those retried, and the age of the oldest in seconds"""
+        count, retried, oldest = self._connection().execute(
+            "SELECT count(*), sum(attempts > 0), min(queued) FROM repairs").fetchone()
+        return {'pending': count, 'retried': retried or 0, 'lag_s': 0. if oldest is None else time.time() - oldest}
+
+
+def apply_pending(journal, get_ioctx, batch_size=1000):
+    """Apply one batch of the pending repairs, with one aio write operation per repair for each pool.
+    get_ioctx(pool) returns the ioctx for a pool.
+    Returns a dict of the number of repairs applied, superseded (the xattr changed, or the file is gone) and failed."""
+    counts = {'applied': 0, 'superseded': 0, 'failed': 0}
+    by_pool = {}
+    for repair in journal.pending(batch_size):
+        by_pool.setdefault(repair[0], []).append(repair)
+
+    for pool, repairs in by_pool.items():
+        try:
+            results = cephtools.apply_xattr_writes(get_ioctx(pool), [(path, xattr_name, value, expected)
+                                                   for _, path, xattr_name, value, expected, _ in repairs])
+        except Exception as e:
+            logging.warning(f'Repairs in {pool} failed: {e}')
+            results = [e] * len(repairs)
+        for repair, ret in zip(repairs, results):
+            if ret == 0:
+                journal.done(repair)
+                counts['applied'] += 1
+            elif ret in (-errno.ECANCELED, -errno.ENOENT):
+                logging.info(f'Repair of {repair[2]} of {pool}:{repair[1]} superseded: {ret}')
+                journal.done(repair)
+                counts['superseded'] += 1
+            else:
+                journal.failed(repair, ret)
+                counts['failed'] += 1
+    if by_pool:
+        logging.debug(f'Repairs: {counts}')
+    return counts
+
+
+def run_worker(journal, get_ioctx, batch_size=1000, interval=5, stop_event=None):
+    """Apply the journal in batches until stop_event is set (or forever); waits interval seconds when empty"""
+    stop_event = threading.Event() if stop_event is None else stop_event
+    while not stop_event.is_set():
+        counts = apply_pending(journal, get_ioctx, batch_size)
+        if sum(counts.values()) < batch_size:
+            stop_event.wait(interval)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Journal of metadata repairs, applied in the background')
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+    parser.add_argument('-j','--journal',default='/var/spool/cephsum/repairs.db', dest='journal_file',
+                        help='Location of the journal database')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Apply the journal with a background worker')
+    run_parser.add_argument('-b','--batch',default=1000,type=int, help='Number of repairs applied concurrently')
+    run_parser.add_argument('--interval',default=5,type=float, help='Seconds to wait when the journal is empty')
+    run_parser.add_argument('--once',action='store_true', help='Apply the pending repairs, then exit')
+    run_parser.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file')
+    run_parser.add_argument('--keyring',default='/etc/ceph/ceph.client.xrootd.keyring', dest='keyring_file')
+    run_parser.add_argument('--cephuser',default='client.xrootd', dest='ceph_user')
+
+    subparsers.add_parser('stats', help='Print the number of pending repairs and the age of the oldest')
+
+    args = parser.parse_args()
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    journal = RepairJournal(args.journal_file)
+    if args.command == 'stats':
+        for k, v in journal.stats().items():
+            sys.stdout.write(f'{k}: {v}\n')
+    elif args.command == 'run':
+        cluster = cephtools.cluster_connect(conffile=args.conf_file, keyring=args.keyring_file, name=args.ceph_user)
+        ioctxs = {}
+        def get_ioctx(pool):
+            if pool not in ioctxs:
+                ioctxs[pool] = cluster.open_ioctx(pool)
+            return ioctxs[pool]
+        try:
+            if args.once:
+                while sum(apply_pending(journal, get_ioctx, args.batch).values()) >= args.batch:
+                    pass
+            else:
+                run_worker(journal, get_ioctx, args.batch, args.interval)
+        finally:
+            for ioctx in ioctxs.values():
+                ioctx.close()
+            cluster.shutdown()
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+# Replay the checksum requests found in cephsum logs (the Result: lines), with their arrival times and
+# concurrency, against a synthetic backend (or files below a directory), to evaluate changes offline.
+#
+#   python3 replay.py --speed 10 --bandwidth 200 /var/log/xrootd/cephsum.log
+
+
+import logging,argparse
+import sys, os, time, re
+import json, math
+import threading
+from datetime import datetime
+
+import XrdCks
+import adler32
+import lfn2pfn
+import actions
+import backends
+
+# e.g. CEPHSUM-2022-04-25 10:01:02,345-12345-INFO-Result:Done, pool:dteam, path:dteam:test1/file, checksum:..., time_s:1.5, ...
+_result_line = re.compile(r'CEPHSUM-(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})-(\d+)-\w+-Result:(.*)$')
+
+
+class Request:
+    """A checksum request from the logs; arrival is in seconds since the epoch"""
+    def __init__(self, arrival, lfn, pool, size=None, source=None, duration=None, result=None):
+        self.arrival = arrival
+        self.lfn = lfn
+        self.pool = pool
+        self.size = size
+        self.source = source
+        self.duration = duration
+        self.result = result
+
+    def __repr__(self):
+        return f'Request({self.arrival}, {self.lfn}, size:{self.size}, source:{self.source}, duration:{self.duration})'
+
+
+def parse_result_line(line):
+    """Return the Request of a Result: log line; None if the line is not one"""
+    match = _result_line.search(line)
+    if match is None:
+        return None
+    logged = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S,%f').timestamp()
+    fields = match.group(3).split(',')
+    values = {'result': fields[0].strip()}
+    for field in fields[1:]:
+        key, sep, value = field.strip().partition(':')
+        if sep:
+            values[key] = value
+    if 'path' not in values:
+        return None
+    duration = float(values['time_s']) if 'time_s' in values else None
+    size = values.get('filesize_bytes')
+    size = int(size) if size not in (None, 'None') else None
+    # the line is logged when the request completes
+    arrival = logged - (duration or 0.)
+    return Request(arrival, values['path'], values.get('pool'), size, values.get('source'), duration, values['result'])
+
+
+def parse_logs(lines):
+    """Requests from all Result: lines, ordered by arrival"""
+    requests = [request for request in map(parse_result_line, lines) if request is not None]
+    return sorted(requests, key=lambda r: r.arrival)
+
+
+class SyntheticBackend(backends.Backend):
+    """Files of the given sizes, filled with zeros, held only as sizes and xattrs in memory.
+    Each read takes read_latency seconds, plus the time at stream_bandwidth bytes per second (if given),
+    to model the storage; the checksum calculation itself is real.
+    """
+    name = 'synthetic'
+
+    def __init__(self, object_size=64*1024*1024, read_latency=0.005, stream_bandwidth=None):
+        self.object_size = object_size
+        self.read_latency = read_latency
+        self.stream_bandwidth = stream_bandwidth
+        self.files = {}
+        self.xattrs = {}
+        self._zeros = b''
+        self._lock = threading.Lock()
+
+    def add_file(self, path, size, with_checksum=False, xattr_name="XrdCks.adler32"):
+        """Add a file of size bytes; if with_checksum, its checksum is already stored in the xattr"""
+        self.files[path] = (size, time.time())
+        self.xattrs[path] = {}
+        if with_checksum:
+            cks_hex = adler32.adler32.adler32_inttohex(adler32.adler32.adler32_zeros(1, size))
+            xrdcks = XrdCks.XrdCks.from_mtime('adler32', time.localtime(), cks_hex)
+            self.xattrs[path][xattr_name] = xrdcks.to_binary()
+
+    def stat(self, path):
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        size, mtime = self.files[path]
+        return size, time.localtime(mtime)
+
+    def get_xattr(self, path, xattr_name):
+        return self.xattrs.get(path, {}).get(xattr_name)
+
+    def set_xattr(self, path, xattr_name, xattr_value, force=False):
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        with self._lock:
+            if not force and xattr_name in self.xattrs[path]:
+                raise ValueError(f"Xattr {xattr_name} already existing for {path}")
+            self.xattrs[path][xattr_name] = bytes(xattr_value)
+        return True
+
+    def get_stripes(self, path, stripe_count=None):
+        size, mtime = self.files[path]
+        num_stripes = max(1, math.ceil(size / self.object_size))
+        for i in range(num_stripes if stripe_count is None else min(stripe_count, num_stripes)):
+            yield path + f'.{i:016x}'
+
+    def read(self, stripe, length, offset=0):
+        path, index = stripe.rsplit('.', 1)
+        size, mtime = self.files[path]
+        stripe_size = min(self.object_size, size - int(index, 16) * self.object_size)
+        length = max(0, min(length, stripe_size - offset))
+        delay = self.read_latency + (0. if not self.stream_bandwidth else length / self.stream_bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+        if len(self._zeros) < length:
+            with self._lock:
+                if len(self._zeros) < length:
+                    self._zeros = bytes(length)
+        return memoryview(self._zeros)[:length]
+
+    def get_striper_xattrs(self, path):
+        if path not in self.files:
+            return None, None, None, None
+        size, mtime = self.files[path]
+        return self.object_size, size, math.ceil(size / self.object_size), size % self.object_size
+
+
+def populate(backend, requests, mapper, size_scale=1.0):
+    """Add the files of the requests to a SyntheticBackend, in their state at the first request.
+    Files first answered from metadata already have a checksum; requests that failed have no file."""
+    for request in requests:
+        pool, path = mapper.parse(request.lfn)
+        if path in backend.files or request.size is None:
+            continue
+        backend.add_file(path, int(request.size * size_scale), with_checksum=request.source == 'metadata')
+
+
+def replay(requests, run_request, speed=1.0, max_concurrency=None):
+    """Start run_request(request) for each request at its (relative) arrival time, divided by speed, each in its own
+    thread, with at most max_concurrency running (if given); returns a list of per-request records, with
+    the queueing delay (waiting for a free slot), service and total latency in seconds."""
+    if not requests:
+        return []
+    slots = None if max_concurrency is None else threading.Semaphore(max_concurrency)
+    records = []
+    records_lock = threading.Lock()
+
+    def handle(request, due):
+        if slots is not None:
+            slots.acquire()
+        started = time.monotonic()
+        try:
+            ok = run_request(request) is not None
+        except Exception as e:
+            logging.debug(f'Replay of {request.lfn} failed: {e}')
+            ok = False
+        finally:
+            if slots is not None:
+                slots.release()
+        ended = time.monotonic()
+        with records_lock:
+            records.append({'lfn': request.lfn, 'size': request.size, 'ok': ok, 'arrival_s': due - start,
+                            'queue_s': started - due, 'service_s': ended - started, 'latency_s': ended - due})
+
+    threads = []
+    first = requests[0].arrival
+    start = time.monotonic()
+    for request in requests:
+        due = start + (request.arrival - first) / speed
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        thread = threading.Thread(target=handle, args=(request, due))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return sorted(records, key=lambda r: r['arrival_s'])
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values; None if empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * pct / 100.) - 1)]
+
+
+def report(records):
+    """Summary dict of the replay: counts, latency, queueing delay and service time percentiles, and throughput"""
+    summary = {'requests': len(records), 'failed': sum(1 for r in records if not r['ok'])}
+    for key in ['latency_s', 'queue_s', 'service_s']:
+        values = [r[key] for r in records]
+        for pct in [50, 90, 99, 100]:
+            summary[f'{key[:-2]}_p{pct}_s'] = percentile(values, pct)
+    elapsed = max((r['arrival_s'] + r['latency_s'] for r in records), default=0.)
+    bytes_total = sum(r['size'] or 0 for r in records if r['ok'])
+    summary['elapsed_s'] = elapsed
+    summary['requests_per_s'] = len(records) / elapsed if elapsed > 0 else None
+    summary['bytes_per_s'] = bytes_total / elapsed if elapsed > 0 else None
+    return summary
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay the checksum requests in cephsum logs against a test backend')
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+    parser.add_argument('-a','--action',default='inget', choices=['inget','get','verify'])
+    parser.add_argument('-r','--readsize',default=64,type=int, help='Readsize in MiB')
+    parser.add_argument('-x','--lfn2pfnxml',default=None, dest='lfn2pfn_xmlfile',
+                        help='The storage.xml file usually provided to xrootd for lfn2pfn mapping.')
+    parser.add_argument('--speed',default=1.0,type=float, help='Replay this many times faster than logged')
+    parser.add_argument('--max-concurrency',default=None,type=int, dest='max_concurrency',
+                        help='At most this many requests are served at the same time; others queue')
+    parser.add_argument('--object-size',default=64,type=int, dest='object_size', help='Stripe size of the synthetic files, in MiB')
+    parser.add_argument('--read-latency',default=0.005,type=float, dest='read_latency', help='Seconds per synthetic read')
+    parser.add_argument('--bandwidth',default=None,type=float, help='Synthetic per-stream read bandwidth in MiB/s')
+    parser.add_argument('--size-scale',default=1.0,type=float, dest='size_scale', help='Scale the logged file sizes by this factor')
+    parser.add_argument('--posixroot',default=None, dest='posix_root',
+                        help='Replay against existing files below this directory, instead of synthetic files')
+    parser.add_argument('-o','--output',default=None, help='Write the per-request records to this json file')
+    parser.add_argument('logs', nargs='+', help='Log files with the cephsum Result: lines')
+
+    args = parser.parse_args()
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.WARNING,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    lines = []
+    for filename in args.logs:
+        with open(filename, errors='replace') as f:
+            lines.extend(f)
+    requests = parse_logs(lines)
+    mapper = lfn2pfn.Lfn2PfnMapper() if args.lfn2pfn_xmlfile is None else lfn2pfn.Lfn2PfnMapper.from_file(args.lfn2pfn_xmlfile)
+
+    if args.posix_root is not None:
+        backend = backends.PosixBackend(args.posix_root)
+    else:
+        backend = SyntheticBackend(args.object_size*1024*1024, args.read_latency,
+                                   None if args.bandwidth is None else args.bandwidth*1024*1024)
+        populate(backend, requests, mapper, args.size_scale)
+
+    readsize = args.readsize*1024*1024
+    def run_request(request):
+        pool, path = mapper.parse(request.lfn)
+        if args.action == 'inget':
+            return actions.inget(backend, path, readsize)
+        elif args.action == 'verify':
+            return actions.verify(backend, path, readsize)
+        return actions.get_checksum(backend, path, readsize)
+
+    logging.info(f'Replaying {len(requests)} requests')
+    records = replay(requests, run_request, args.speed, args.max_concurrency)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(records, f, indent=1)
+    for k, v in report(records).items():
+        sys.stdout.write(f'{k}: {v}\n')
@@ -0,0 +1,285 @@
+import logging
+import os, itertools
+import threading, time
+from collections import deque
+from contextlib import contextmanager
+
+import actions
+import backends
+import progress
+
+# Sharing of the read bandwidth of a gateway between classes of checksum work,
+# e.g. interactive checksum requests, checksums following transfers (spool.py), and background backfill or scrub runs (bulk.py).
+# The weighted sharing applies within one process, and, through HostJobs, also across the processes of a host (e.g. a
+# bulk.py run, a spool.py run, and the cephsum.py processes started by xrootd for each request), as does the preemption
+# of background reads.
+
+INTERACTIVE = 'interactive'
+TRANSFER = 'transfer'
+BACKGROUND = 'background'
+
+DEFAULT_WEIGHTS = {INTERACTIVE: 8, TRANSFER: 4, BACKGROUND: 1}
+DEFAULT_JOBS_DIR = '/dev/shm/cephsum-jobs'
+
+_counter = itertools.count()
+
+
+class HostJobs:
+    """The jobs running in all the processes of a host, by class, as empty marker files <class>.<pid>.<n> in directory
+    (in memory, under /dev/shm by default). Markers left by processes no longer running are ignored, and removed."""
+    def __init__(self, directory=DEFAULT_JOBS_DIR):
+        self.directory = directory
+
+    @contextmanager
+    def job(self, cls):
+        """Register a job of class cls for the duration of the context; failing that, the job runs unregistered"""
+        filename = os.path.join(self.directory, f'{cls}.{os.getpid()}.{next(_counter)}')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            open(filename, 'w').close()
+        except OSError as e:
+            logging.debug(f'Could not register the {cls} job in {self.directory}: {e}')
+            filename = None
+        try:
+            yield self
+        finally:
+            if filename is not None:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+
+    def running(self, classes, exclude_pid=None):
+        """Number of jobs of the classes running, in processes other than exclude_pid"""
+        counts = self.counts(exclude_pid)
+        return sum(counts.get(cls, 0) for cls in classes)
+
+    def counts(self, exclude_pid=None):
+        """Number of jobs running by class, in processes other than exclude_pid"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return {}
+        counts = {}
+        for name in names:
+            try:
+                cls, pid, _ = name.split('.')
+                pid = int(pid)
+            except ValueError:
+                continue
+            if pid == exclude_pid:
+                continue
+            if not progress.pid_alive(pid):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                continue
+            counts[cls] = counts.get(cls, 0) + 1
+        return counts
+
+
+def parse_weights(text):
+    """Weights of the classes from 'class=weight,...' (e.g. 'interactive=8,transfer=4,background=1'), the classes not 
+    given keeping their default weight"""
+    weights = dict(DEFAULT_WEIGHTS)
+    for item in filter(None, (i.strip() for i in text.split(','))):
+        cls, _, weight = item.partition('=')
+        cls = cls.strip()
+        if cls not in DEFAULT_WEIGHTS:
+            raise ValueError(f'Unknown class {cls}; expected one of {list(DEFAULT_WEIGHTS)}')
+        try:
+            weights[cls] = float(weight)
+        except ValueError:
+            raise ValueError(f'Invalid weight {weight!r} for {cls}') from None
+        if not weights[cls] > 0:
+            raise ValueError(f'The weight of {cls} must be positive')
+    return weights
+
+
+class PriorityScheduler:
+    """Weighted fair sharing of data reads between classes of work, with preemption at stripe boundaries.
+
+    At most max_reads (None for no limit) are in flight. A free slot goes to the waiting class that has been granted 
+    the fewest bytes relative to its weight (a class that was idle does not bank credit). In addition, reads of the 
+    preempted classes wait at each stripe boundary while any job of the preempting classes is running, so that a long 
+    background read gives way to interactive work within one stripe.
+    With host_jobs (a HostJobs), the jobs of all the classes are registered there, and those running in other processes 
+    of the host (polled at most every poll_interval seconds) count too: jobs of the preempting classes preempt, and after 
+    each read, a class waits in proportion to the weights of the other classes running elsewhere on the host (see 
+    host_delay), so that each class gets about its weighted share of the read time of the host.
+    """
+    def __init__(self, weights=None, max_reads=4, preempting=(INTERACTIVE,), preempted=(BACKGROUND,), host_jobs=None,
+                 poll_interval=0.5):
+        self.weights = dict(DEFAULT_WEIGHTS if weights is None else weights)
+        self.max_reads = max_reads
+        self.preempting = preempting
+        self.preempted = preempted
+        self.host_jobs = host_jobs
+        self.poll_interval = poll_interval
+        self.reads = 0
+        self.yields = 0
+        self.virtual_time = 0.
+        self.finish_time = {cls: 0. for cls in self.weights}
+        self.waiting = {cls: deque() for cls in self.weights}
+        self.active = {cls: 0 for cls in self.weights}
+        self.bytes_granted = {cls: 0 for cls in self.weights}
+        self._cond = threading.Condition()
+        self._host_counts = {}
+        self._host_polled = None
+
+    def _next_ticket(self):
+        classes = [cls for cls in self.weights if self.waiting[cls]]
+        if not classes:
+            return None
+        cls = min(classes, key=lambda c: (self.finish_time[c], -self.weights[c]))
+        return self.waiting[cls][0]
+
+    def acquire(self, cls, length):
+        """Wait for a read slot for length bytes of class cls; call release when the read is done"""
+        ticket = object()
+        with self._cond:
+            if not self.waiting[cls]:
+                self.finish_time[cls] = max(self.finish_time[cls], self.virtual_time)
+            self.waiting[cls].append(ticket)
+            while (self.max_reads is not None and self.reads >= self.max_reads) or self._next_ticket() is not ticket:
+                self._cond.wait()
+            self.waiting[cls].popleft()
+            self.reads += 1
+            self.virtual_time = self.finish_time[cls]
+            self.finish_time[cls] += length / self.weights[cls]
+            self.bytes_granted[cls] += length
+            self._cond.notify_all()
+
+    def release(self, cls):
+        with self._cond:
+            self.reads -= 1
+            self._cond.notify_all()
+
+    def _preempting_running(self):
+        if any(self.active[c] for c in self.preempting):
+            return True
+        return self.host_jobs is not None and self.host_jobs.running(self.preempting, exclude_pid=os.getpid()) > 0
+
+    def host_counts(self):
+        """Number of jobs running by class in the other processes of the host, polled at most every poll_interval"""
+        if self.host_jobs is None:
+            return {}
+        now = time.monotonic()
+        with self._cond:
+            if self._host_polled is None or now - self._host_polled >= self.poll_interval:
+                self._host_counts = self.host_jobs.counts(exclude_pid=os.getpid())
+                self._host_polled = now
+            return self._host_counts
+
+    def host_delay(self, cls, seconds):
+        """Time for a job of class cls to wait after a read that took seconds, for the classes running in other 
+        processes of the host to get their weighted share of the reads: seconds times the sum of the weights of these 
+        classes, over the weight of cls. Preempted classes are left out for a preempting class, as they are yielding."""
+        others = [c for c, n in self.host_counts().items() if n and c != cls and c in self.weights]
+        if cls in self.preempting:
+            others = [c for c in others if c not in self.preempted]
+        return seconds * sum(self.weights[c] for c in others) / self.weights[cls]
+
+    def stripe_boundary(self, cls):
+        """Called before the first read of each stripe; preempted classes wait while preempting work is running"""
+        if cls not in self.preempted:
+            return
+        with self._cond:
+            if self._preempting_running():
+                self.yields += 1
+                logging.debug(f'{cls} read yielding to {list(self.preempting)}')
+            while self._preempting_running():
+                self._cond.wait(None if self.host_jobs is None else self.poll_interval)
+
+    @contextmanager
+    def job(self, cls):
+        """Mark a job of class cls as running, for the duration of the context"""
+        with self._cond:
+            self.active[cls] += 1
+        try:
+            if self.host_jobs is not None:
+                with self.host_jobs.job(cls):
+                    yield self
+            else:
+                yield self
+        finally:
+            with self._cond:
+                self.active[cls] -= 1
+                self._cond.notify_all()
+
+    def backend(self, ioctx, cls, reader=None, sparse=False):
+        """RadosBackend for ioctx whose data reads are scheduled as class cls; 
+        ioctx can also be a RadosBackend, whose reads (through its reader) are then scheduled"""
+        if isinstance(ioctx, backends.RadosBackend):
+            return backends.RadosBackend(ioctx.ioctx, reader=ClassReader(self, ioctx.ioctx, cls, ioctx.reader),
+                                         sparse=ioctx.sparse, page_crcs=ioctx.page_crcs)
+        return backends.RadosBackend(ioctx, reader=ClassReader(self, ioctx, cls, reader), sparse=sparse)
+
+    def inget(self, ioctx, path, cls, readsize=64*1024*1024, xattr_name="XrdCks.adler32"):
+        """actions.inget, with the data reads scheduled as class cls"""
+        with self.job(cls):
+            return actions.inget(self.backend(ioctx, cls), path, readsize, xattr_name)
+
+    def verify(self, ioctx, path, cls, readsize=64*1024*1024, xattr_name="XrdCks.adler32"):
+        """actions.verify, with the data reads scheduled as class cls"""
+        with self.job(cls):
+            return actions.verify(self.backend(ioctx, cls), path, readsize, xattr_name)
+
+
+class ClassReader:
+    """Reader (see cephtools.read_oid_bytes) making the reads of one class through a PriorityScheduler.
+    Reads are made from ioctx, or through reader (e.g. a cephtools.HedgedReader) if given; if reader can submit
+    reads ahead (an osdmap.OsdScheduler), so can this one, each holding its slot until the read completes.
+    The wait for the share of the other processes of the host (see PriorityScheduler.host_delay) owed by each read is 
+    made before the next read, outside of the read slot."""
+    def __init__(self, scheduler, ioctx, cls, reader=None):
+        if cls not in scheduler.weights:
+            raise ValueError(f'Unknown class {cls}; expected one of {list(scheduler.weights)}')
+        self.scheduler = scheduler
+        self.ioctx = ioctx
+        self.cls = cls
+        self.reader = reader
+        self.owed = 0.
+        self._lock = threading.Lock()
+        if hasattr(reader, 'submit'):
+            self.submit = self._submit
+
+    def _pay(self):
+        with self._lock:
+            delay, self.owed = self.owed, 0.
+        if delay > 0:
+            time.sleep(delay)
+
+    def _done(self, cls, started):
+        self.scheduler.release(cls)
+        delay = self.scheduler.host_delay(cls, time.monotonic() - started)
+        with self._lock:
+            self.owed += delay
+
+    def read(self, oid, length, offset=0):
+        self._pay()
+        if offset == 0:
+            self.scheduler.stripe_boundary(self.cls)
+        self.scheduler.acquire(self.cls, length)
+        started = time.monotonic()
+        try:
+            if self.reader is not None:
+                return self.reader.read(oid, length, offset)
+            return self.ioctx.read(oid, length, offset)
+        finally:
+            self._done(self.cls, started)
+
+    def _submit(self, oid, length, offset=0):
+        self._pay()
+        if offset == 0:
+            self.scheduler.stripe_boundary(self.cls)
+        self.scheduler.acquire(self.cls, length)
+        started = time.monotonic()
+        try:
+            future = self.reader.submit(oid, length, offset)
+        except Exception:
+            self.scheduler.release(self.cls)
+            raise
+        future.add_done_callback(lambda f: self._done(self.cls, started))
+        return future
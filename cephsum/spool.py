@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Durable local queue of newly written files, whose checksums are precomputed by background workers,
+# so that the later checksum request (e.g. from FTS) is answered from the metadata.
+#
+#   spool.py enqueue [-p priority] <lfn> [<lfn> ...]   e.g. from xrdcp-tpc.sh after a transfer
+#   spool.py run -w 4 -x storage.xml                   drain the queue with actions.inget
+#   spool.py stats                                     queue depth, lag and throughput
+
+
+import logging,argparse
+import sys, os, time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import lfn2pfn
+import actions
+import scheduler as priority
+
+try:
+    import cephtools
+except ImportError:
+    # librados python bindings not available; only the queue itself can be used
+    cephtools = None
+
+
+class Spool:
+    """Queue of LFNs in a local sqlite database.
+
+    Entries are claimed in order of priority (highest first), then age. An LFN is only queued once while pending;
+    a failed entry is retried after retry_delay seconds, up to max_attempts times.
+    Each thread uses its own database connection.
+    """
+    _schema = """CREATE TABLE IF NOT EXISTS queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    lfn TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    enqueued REAL NOT NULL,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    claimed REAL,
+                    finished REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT);
+                 CREATE INDEX IF NOT EXISTS queue_order ON queue (state, priority DESC, enqueued);
+                 CREATE INDEX IF NOT EXISTS queue_lfn ON queue (lfn);
+              """
+
+    def __init__(self, filename='/var/spool/cephsum/queue.db', max_attempts=3, retry_delay=60):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(self._schema)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, lfn, priority=0):
+        """Add the lfn to the queue; if already pending, keep the higher priority"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT id FROM queue WHERE state = 'pending' AND lfn = ?", (lfn,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO queue (lfn, priority, enqueued) VALUES (?, ?, ?)", (lfn, priority, time.time()))
+            else:
+                conn.execute("UPDATE queue SET priority = max(priority, ?) WHERE id = ?", (priority, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def claim(self):
+        """Return (id, lfn) of the next entry to process, marking it as running; None if nothing available"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("""SELECT id, lfn FROM queue WHERE state = 'pending' AND not_before <= ?
+                                  ORDER BY priority DESC, enqueued LIMIT 1""", (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE queue SET state = 'running', claimed = ?, attempts = attempts + 1 WHERE id = ?",
+                             (now, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return row
+
+    def done(self, entry_id):
+        self._connection().execute("UPDATE queue SET state = 'done', finished = ?, error = NULL WHERE id = ?",
+                                   (time.time(), entry_id))
+
+    def failed(self, entry_id, error):
+        """Return the entry to the queue for a later retry, or mark as failed after max_attempts"""
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            attempts, lfn = conn.execute("SELECT attempts, lfn FROM queue WHERE id = ?", (entry_id,)).fetchone()
+            pending = conn.execute("SELECT 1 FROM queue WHERE state = 'pending' AND lfn = ?", (lfn,)).fetchone()
+            if attempts >= self.max_attempts or pending is not None:
+                # out of attempts, or the lfn was queued again in the meantime
+                conn.execute("UPDATE queue SET state = 'failed', finished = ?, error = ? WHERE id = ?",
+                             (now, str(error), entry_id))
+            else:
+                conn.execute("UPDATE queue SET state = 'pending', not_before = ?, error = ? WHERE id = ?",
+                             (now + self.retry_delay, str(error), entry_id))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def requeue_stale(self, timeout=3600):
+        """Return running entries claimed more than timeout seconds ago (e.g. by a worker that died) to the queue"""
+        cursor = self._connection().execute(
+            """UPDATE queue SET state = 'pending' WHERE state = 'running' AND claimed < ?
+               AND lfn NOT IN (SELECT lfn FROM queue WHERE state = 'pending')""", (time.time() - timeout,))
+        return cursor.rowcount
+
+    def purge(self, age=86400):
+        """Remove done and failed entries finished more than age seconds ago"""
+        cursor = self._connection().execute("DELETE FROM queue WHERE state IN ('done','failed') AND finished < ?",
+                                            (time.time() - age,))
+        return cursor.rowcount
+
+    def stats(self, interval=300):
+        """Dict of the queue depth (per state), lag (age of the oldest pending entry, in seconds),
+        and throughput (entries done per second over the last interval seconds)"""
+        now = time.time()
+        conn = self._connection()
+        values = {state: 0 for state in ['pending', 'running', 'done', 'failed']}
+        for state, count in conn.execute("SELECT state, count(*) FROM queue GROUP BY state"):
+            values[state] = count
+        oldest = conn.execute("SELECT min(enqueued) FROM queue WHERE state = 'pending'").fetchone()[0]
+        values['lag_s'] = 0. if oldest is None else now - oldest
+        recent = conn.execute("SELECT count(*) FROM queue WHERE state = 'done' AND finished >= ?",
+                              (now - interval,)).fetchone()[0]
+        values['throughput_per_s'] = recent / interval
+        return values
+
+
+def process_entry(spool, entry, get_ioctx, mapper, readsize, xattr_name="XrdCks.adler32", scheduler=None):
+    """Checksum one claimed entry with actions.inget; returns True if successful.
+    If scheduler (a scheduler.PriorityScheduler) is given, the reads are scheduled in its transfer class."""
+    entry_id, lfn = entry
+    try:
+        pool, path = mapper.parse(lfn)
+        if scheduler is not None:
+            xrdcks = scheduler.inget(get_ioctx(pool), path, priority.TRANSFER, readsize, xattr_name)
+        else:
+            xrdcks = actions.inget(get_ioctx(pool), path, readsize, xattr_name)
+        if xrdcks is None:
+            raise IOError(f'No checksum possible for {lfn}')
+    except Exception as e:
+        logging.warning(f'Spool entry {entry_id} {lfn} failed: {e}')
+        spool.failed(entry_id, e)
+        return False
+    spool.done(entry_id)
+    return True
+
+
+def run_workers(spool, get_ioctx, mapper, readsize, workers=4, poll_interval=5, report_interval=60, stop_event=None,
+                scheduler=None):
+    """Drain the spool with a pool of worker threads, until stop_event is set (or forever).
+    get_ioctx(pool) returns the ioctx (or backend) for a pool.
+    scheduler (a scheduler.PriorityScheduler) shares the reads with other work in the same process, or of the host."""
+    stop_event = threading.Event() if stop_event is None else stop_event
+
+    def worker():
+        while not stop_event.is_set():
+            entry = spool.claim()
+            if entry is None:
+                stop_event.wait(poll_interval)
+                continue
+            process_entry(spool, entry, get_ioctx, mapper, readsize, scheduler=scheduler)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker) for _ in range(workers)]
+        while not stop_event.wait(report_interval):
+            logging.info(f'Spool: {spool.stats()}')
+        for future in futures:
+            future.result()
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Queue of files for which the checksum is precomputed in the background')
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+    parser.add_argument('-s','--spool',default='/var/spool/cephsum/queue.db', dest='spool_file',
+                        help='Location of the queue database')
+    subparsers = parser.add_subparsers(dest='command')
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='Add lfns to the queue')
+    enqueue_parser.add_argument('-p','--priority',default=0,type=int, help='Higher priority entries are processed first')
+    enqueue_parser.add_argument('lfns', nargs='+')
+
+    run_parser = subparsers.add_parser('run', help='Process the queue with background workers')
+    run_parser.add_argument('-w','--workers',default=4,type=int, help='Number of files processed concurrently')
+    run_parser.add_argument('-r','--readsize',default=64,type=int, help='Readsize in MiB')
+    run_parser.add_argument('-x','--lfn2pfnxml',default=None, dest='lfn2pfn_xmlfile',
+                        help='The storage.xml file usually provided to xrootd for lfn2pfn mapping.')
+    run_parser.add_argument('--report',default=60,type=int, help='Interval in seconds to log the queue statistics')
+    run_parser.add_argument('--jobs-dir',default='', dest='jobs_dir',
+                        help=f'Register the files being processed as transfer work in this directory (e.g. {priority.DEFAULT_JOBS_DIR}), '
+                             'and share the reads of the host by weight with the other classes registered there (cephsum.py and '
+                             'bulk.py --jobs-dir); off by default')
+    run_parser.add_argument('--weights',default='',
+                        help='Weights of the classes of work sharing the reads, as e.g. interactive=8,transfer=4,background=1 (the default)')
+    run_parser.add_argument('--max-reads',default=None,type=int, dest='max_reads',
+                        help='Limit the reads in flight of all workers to this many')
+    run_parser.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file')
+    run_parser.add_argument('--keyring',default='/etc/ceph/ceph.client.xrootd.keyring', dest='keyring_file')
+    run_parser.add_argument('--cephuser',default='client.xrootd', dest='ceph_user')
+
+    subparsers.add_parser('stats', help='Print queue depth, lag and throughput')
+
+    args = parser.parse_args()
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    spool = Spool(args.spool_file)
+    if args.command == 'enqueue':
+        for lfn in args.lfns:
+            spool.enqueue(lfn, args.priority)
+    elif args.command == 'stats':
+        for k, v in spool.stats().items():
+            sys.stdout.write(f'{k}: {v}\n')
+    elif args.command == 'run':
+        try:
+            weights = priority.parse_weights(args.weights)
+        except ValueError as e:
+            run_parser.error(str(e))
+        mapper = lfn2pfn.Lfn2PfnMapper() if args.lfn2pfn_xmlfile is None else lfn2pfn.Lfn2PfnMapper.from_file(args.lfn2pfn_xmlfile)
+        cluster = cephtools.cluster_connect(conffile=args.conf_file, keyring=args.keyring_file, name=args.ceph_user)
+        ioctxs = {}
+        ioctx_lock = threading.Lock()
+        def get_ioctx(pool):
+            with ioctx_lock:
+                if pool not in ioctxs:
+                    ioctxs[pool] = cluster.open_ioctx(pool)
+                return ioctxs[pool]
+        try:
+            spool.requeue_stale()
+            spool.purge()
+            sched = None
+            if args.jobs_dir or args.max_reads is not None:
+                sched = priority.PriorityScheduler(weights, max_reads=args.max_reads,
+                                                   host_jobs=priority.HostJobs(args.jobs_dir) if args.jobs_dir else None)
+            run_workers(spool, get_ioctx, mapper, args.readsize*1024*1024, args.workers, report_interval=args.report,
+                        scheduler=sched)
+        finally:
+            for ioctx in ioctxs.values():
+                ioctx.close()
+            cluster.shutdown()
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Live view of the checksum computations running on this host, from the progress registry (see progress.py):
+# the file, bytes read against the striper size, current stripe, rate and age of each, with stalled reads highlighted.
+#
+#   top.py                   refresh every 2 seconds
+#   top.py --once --stall 60
+
+
+import argparse
+import sys, time
+
+import progress
+
+SORT_KEYS = {'age': lambda s: s['started'] or 0,
+             'rate': lambda s: s['rate_bytes_per_s'] or 0.,
+             'idle': lambda s: s['last_progress'] or 0,
+             'done': lambda s: -s['bytes_done']}
+
+
+def rows(states, now=None, stall=30., sort='idle'):
+    """Table rows of the states, as dicts of display strings plus 'stalled', sorted by sort (see SORT_KEYS).
+    A computation is stalled if it has made no progress for stall seconds."""
+    now = time.time() if now is None else now
+    table = []
+    for state in sorted(states, key=SORT_KEYS[sort]):
+        idle = now - state['last_progress'] if state['last_progress'] is not None else 0.
+        total = state['total_size']
+        done = state['bytes_done']
+        rate = state['rate_bytes_per_s']
+        table.append({'pid': str(state['pid']),
+                      'action': state['action'],
+                      'pool': state['pool'] or '',
+                      'path': state['path'],
+                      'done': f'{done/2**20:.1f}/{total/2**20:.1f}MiB' if total else f'{done/2**20:.1f}MiB',
+                      'pct': f'{100.*done/total:.0f}%' if total else '-',
+                      'stripe': '-' if state['stripe'] is None else str(state['stripe']),
+                      'rate': '-' if rate is None else f'{rate/2**20:.1f}MiB/s',
+                      'age': f'{now - state["started"]:.0f}s' if state['started'] else '-',
+                      'idle': f'{idle:.0f}s',
+                      'stalled': idle >= stall})
+    return table
+
+
+def render(table, out=sys.stdout, highlight=False):
+    columns = ['pid', 'action', 'pool', 'done', 'pct', 'stripe', 'rate', 'age', 'idle', 'path']
+    widths = {c: max([len(c)] + [len(row[c]) for row in table]) for c in columns}
+    out.write('  '.join(c.upper().ljust(widths[c]) for c in columns) + '\n')
+    for row in table:
+        line = '  '.join(row[c].ljust(widths[c]) for c in columns)
+        if row['stalled']:
+            line = f'\033[7m{line}  STALLED\033[0m' if highlight else f'{line}  STALLED'
+        out.write(line + '\n')
+    stalled = sum(1 for row in table if row['stalled'])
+    out.write(f'{len(table)} running, {stalled} stalled\n')
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Live view of the checksum computations running on this host')
+    parser.add_argument('--registry',default=progress.DEFAULT_REGISTRY, help='Progress registry directory')
+    parser.add_argument('-i','--interval',default=2.,type=float, help='Seconds between refreshes')
+    parser.add_argument('--stall',default=30.,type=float, help='Highlight computations without progress for this many seconds')
+    parser.add_argument('-s','--sort',default='idle', choices=sorted(SORT_KEYS), help='Sort order')
+    parser.add_argument('--once',action='store_true', help='Print the view once, and exit')
+
+    args = parser.parse_args()
+    highlight = sys.stdout.isatty()
+    try:
+        while True:
+            table = rows(progress.list_progress(args.registry), stall=args.stall, sort=args.sort)
+            if not args.once and highlight:
+                sys.stdout.write('\033[H\033[2J')
+            render(table, highlight=highlight)
+            sys.stdout.flush()
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Entrypoint for third-party-copy transfers, calculating the checksum on the data in flight.
+#
+# The incoming data (e.g. xrdcp <src> - , started here with --source) is read from the input, written to the destination,
+# and passed through the adler32 engine as it goes. Once the destination is complete, the
+# checksum is stored into the XrdCks xattr so that the following checksum request only needs the metadata.
+# A source that ends early looks the same as a clean end of the stream, so the source is checked (the exit status of
+# the source xrdcp, or the expected --size) before the destination is closed; if incomplete, the destination is aborted.
+
+
+import logging,argparse
+import sys, os, shlex
+import subprocess
+
+import adler32
+import cephtools
+import lfn2pfn
+import actions
+
+
+def tee_stream(src, dst, readsize):
+    """Generator to yield the buffers read from src, after each one is written to dst.
+    """
+    while True:
+        buf = src.read(readsize)
+        if not buf:
+            return
+        dst.write(buf)
+        yield buf
+
+
+def copy_with_checksum(src, dst, readsize=64*1024*1024):
+    """Copy all data from file object src to file object dst, calculating the checksum on the way.
+
+    Returns:
+        tuple of checksum (adler32 value in lowercase hex) and the number of bytes copied
+    """
+    cks_alg = adler32.adler32('adler32')
+    cks_hex = cks_alg.calc_checksum( tee_stream(src, dst, readsize) )
+    dst.flush()
+    return cks_hex, cks_alg.bytes_read
+
+
+def copy_to_xrdcp(src, dest_url, readsize=64*1024*1024, xrdcp='/usr/bin/xrdcp', check_complete=None):
+    """Copy data from src to dest_url with xrdcp reading from stdin, calculating the checksum on the way.
+    check_complete, if given, is called with the number of bytes copied once src is exhausted, before the destination 
+    is closed; it returns None if all the data was received, else the reason. The destination xrdcp is then killed
+    rather than closed (it is started with --posc, so that the partial file is removed), as it is on any error.
+
+    Returns:
+        tuple of checksum, number of bytes copied and the xrdcp return code
+    """
+    cmd = [xrdcp, '--server', '-f', '--posc', '-', dest_url]
+    logging.debug(f'Starting: {cmd}')
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        cks_hex, bytes_read = copy_with_checksum(src, proc.stdin, readsize)
+        problem = None if check_complete is None else check_complete(bytes_read)
+    except BaseException:
+        _abort(proc)
+        raise
+    if problem is not None:
+        logging.error(f'Incomplete source for {dest_url}: {problem}; aborting the destination')
+        _abort(proc)
+        return cks_hex, bytes_read, 1
+    proc.stdin.close()
+    return cks_hex, bytes_read, proc.wait()
+
+
+def _abort(proc):
+    proc.kill()
+    proc.wait()
+    try:
+        proc.stdin.close()
+    except OSError:
+        pass
+
+
+def start_source(src_url, xrdcp='/usr/bin/xrdcp', options=()):
+    """Start xrdcp to stream src_url to its stdout; returns the process, whose stdout is the data"""
+    cmd = [xrdcp, *options, '--server', '-f', src_url, '-']
+    logging.debug(f'Starting: {cmd}')
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+
+def source_checker(source=None, size=None):
+    """Function for copy_to_xrdcp check_complete: the source process (see start_source) must exit with 0, 
+    and the number of bytes copied be size, where given"""
+    def check_complete(bytes_read):
+        if source is not None:
+            returncode = source.wait()
+            if returncode != 0:
+                return f'source xrdcp exited with {returncode} after {bytes_read} bytes'
+        if size is not None and bytes_read != size:
+            return f'{bytes_read} bytes received, expected {size}'
+        return None
+    return check_complete
+
+
+
+if __name__ == "__main__":
+    xattr_name = "XrdCks.adler32"
+
+    parser = argparse.ArgumentParser(description='Copy data for a third-party-copy transfer, and store the adler32 checksum calculated in flight')
+
+    parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
+    parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
+
+    parser.add_argument('-r','--readsize',help='Set the readsize in MiB for each chunk of data read from the input.',
+                        dest='readsize',default=64,type=int)
+
+    parser.add_argument('-x','--lfn2pfnxml',default=None, dest='lfn2pfn_xmlfile',
+                        help='The storage.xml file usually provided to xrootd for lfn2pfn mapping. If not provided a simple method is used to separate the pool and object names')
+
+    parser.add_argument('-i','--input',default='-', dest='input',
+                        help='File to read the data from; default (-) is stdin, e.g. piped from xrdcp <src> -')
+    parser.add_argument('--source',default=None, dest='source_url',
+                        help='Read the data from this url with xrdcp (instead of --input), and abort the destination if the source xrdcp fails')
+    parser.add_argument('--source-opts',default='', dest='source_opts',
+                        help='Additional options for the source xrdcp, as one string')
+    parser.add_argument('--size',default=None, type=int, dest='size',
+                        help='Expected number of bytes; the destination is aborted if a different number is received')
+    parser.add_argument('-o','--output',default=None, dest='output',
+                        help='Write the data to a local file, instead of to --dest')
+    parser.add_argument('--dest',default=None, dest='dest_url',
+                        help='Destination url (e.g. root://$XRDXROOTD_PROXY/<path>), written via xrdcp from stdin')
+    parser.add_argument('--xrdcp',default='/usr/bin/xrdcp', dest='xrdcp',
+                        help='Location of the xrdcp executable')
+    parser.add_argument('--nostore',action='store_true', dest='nostore',
+                        help='Only copy and report the checksum; do not write it into the metadata')
+
+    parser.add_argument('--cephconf',default='/etc/ceph/ceph.conf', dest='conf_file',
+                        help='location of the ceph.conf file, if different from default')
+    parser.add_argument('--keyring',default='/etc/ceph/ceph.client.xrootd.keyring', dest='keyring_file',
+                        help='location of the ceph keyring file, if different from default')
+    parser.add_argument('--cephuser',default='client.xrootd', dest='ceph_user',
+                        help='ceph user name for the client keyring')
+
+    # destination path (lfn), used to store the checksum
+    parser.add_argument('path', nargs=1)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+                    filename=None if args.logfile is None else args.logfile,
+                    format='CEPHSUM-%(asctime)s-%(process)d-%(levelname)s-%(message)s',
+                    )
+
+    if (args.output is None) == (args.dest_url is None):
+        parser.error('Exactly one of --output or --dest is required')
+
+    readsize = args.readsize*1024*1024
+
+    lfn_path = args.path[0]
+    if args.lfn2pfn_xmlfile is None:
+        lfn2pfn_converter = lfn2pfn.Lfn2PfnMapper()
+    else:
+        lfn2pfn_converter = lfn2pfn.Lfn2PfnMapper.from_file(args.lfn2pfn_xmlfile)
+    pool, path = lfn2pfn_converter.parse(lfn_path)
+    logging.debug(f'Converted {lfn_path} to {pool}, {path}')
+
+    source = None
+    if args.source_url is not None:
+        source = start_source(args.source_url, args.xrdcp, shlex.split(args.source_opts))
+        src = source.stdout
+    else:
+        src = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    check_complete = source_checker(source, args.size)
+    try:
+        if args.output is not None:
+            with open(args.output, 'wb') as dst:
+                cks_hex, bytes_read = copy_with_checksum(src, dst, readsize)
+            problem = check_complete(bytes_read)
+            returncode = 0
+            if problem is not None:
+                logging.error(f'Incomplete source for {args.output}: {problem}; removing it')
+                os.unlink(args.output)
+                returncode = 1
+        else:
+            cks_hex, bytes_read, returncode = copy_to_xrdcp(src, args.dest_url, readsize, args.xrdcp, check_complete)
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+        if source is not None and source.poll() is None:
+            source.kill()
+            source.wait()
+
+    if returncode != 0:
+        logging.error(f'Transfer failed for {lfn_path} with exit code {returncode}; no checksum stored')
+        sys.exit(returncode)
+    logging.info(f'Transferred {lfn_path}: bytes:{bytes_read}, checksum:{cks_hex}')
+
+    if not args.nostore:
+        # The transfer itself succeeded; failing to store only means the checksum is calculated later from the file.
+        try:
+            cluster = cephtools.cluster_connect(conffile=args.conf_file,
+                                                keyring=args.keyring_file,
+                                                name=args.ceph_user)
+            try:
+                with cluster.open_ioctx(pool) as ioctx:
+                    actions.store_from_stream(ioctx, path, cks_hex, bytes_read, xattr_name)
+            finally:
+                cluster.shutdown()
+        except Exception as e:
+            logging.warning(f'Could not store checksum for {lfn_path}: {e}', exc_info=True)
+
+    sys.exit(0)
@@ -5,7 +5,11 @@
 #Update the path name to the correct location
 # -d enables debug logging (logging goes to the xrootd log file)
 # -r 64 implies to use 64MiB block size for each read request; see help for more info
-RESULT=$(python3 /etc/xrootd/cephsum/cephsum.py -x /etc/xrootd/storage.xml -d -r 64 --action=inget $1)
+# Set CEPHSUM_PROGRESS_DIR (e.g. /dev/shm/cephsum) in the xrootd environment to publish the progress of reads for top.py
+# Set CEPHSUM_JOBS_DIR (e.g. /dev/shm/cephsum-jobs) to register the requests as interactive work, for the bulk.py and
+# spool.py runs of the host given the same --jobs-dir to yield to
+RESULT=$(python3 /etc/xrootd/cephsum/cephsum.py -x /etc/xrootd/storage.xml -d -r 64 --action=inget \
+    ${CEPHSUM_PROGRESS_DIR:+--progress-dir $CEPHSUM_PROGRESS_DIR} ${CEPHSUM_JOBS_DIR:+--jobs-dir $CEPHSUM_JOBS_DIR} $1)
 ECODE=$(echo $?)
 
 # Additional logging could be added here if needed
@@ -1,4 +1,4 @@
-#!/bin/sh
+#!/bin/bash
 
 #Original code
 #/usr/bin/xrdcp --server -f $1 root://$XRDXROOTD_PROXY/$2
@@ -8,5 +8,20 @@ OTHERARGS="${@:1:$#-2}"
 DSTFILE="${@:$#:1}"
 SRCFILE="${@:$#-1:1}"
 
+# Set CEPHSUM_TPC_INFLIGHT=1 to calculate the checksum on the data while it is transferred,
+# and store it into the metadata; the later checksum request is then answered from the metadata only.
+if [ "${CEPHSUM_TPC_INFLIGHT:-0}" = "1" ]; then
+    # tpc.py runs the source xrdcp itself, so that a failed source aborts the destination before the checksum is stored
+    python3 /etc/xrootd/cephsum/tpc.py -x /etc/xrootd/storage.xml -r 64 --source $SRCFILE --source-opts="$OTHERARGS" \
+        --dest root://$XRDXROOTD_PROXY/$DSTFILE $DSTFILE
+    exit $?
+fi
 
-/usr/bin/xrdcp $OTHERARGS --server -f $SRCFILE root://$XRDXROOTD_PROXY/$DSTFILE 
+/usr/bin/xrdcp $OTHERARGS --server -f $SRCFILE root://$XRDXROOTD_PROXY/$DSTFILE
+ECODE=$?
+
+# Set CEPHSUM_SPOOL=1 to queue the new file, so that its checksum is precomputed by the spool.py workers
+if [ ${ECODE} -eq 0 ] && [ "${CEPHSUM_SPOOL:-0}" = "1" ]; then
+    python3 /etc/xrootd/cephsum/spool.py enqueue -p 10 $DSTFILE
+fi
+exit ${ECODE}
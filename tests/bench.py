@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Microbenchmarks of the pure python hot paths, with a regression check against earlier results.
+#
+#   python3 tests/bench.py run -o baseline.json
+#   python3 tests/bench.py run -o current.json --compare baseline.json --threshold 0.2
+#   python3 tests/bench.py compare baseline.json current.json
+#
+# Each benchmark reports the best (minimum over the repeats) time per call, which is the least sensitive to noise.
+
+import sys, os, time
+import argparse, json, platform
+import random, struct, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cephsum'))
+
+import XrdCks
+import adler32
+import lfn2pfn
+
+
+def make_storage_xml(n_rules=500):
+    """A storage.xml with n_rules direct mappings (as for many VOs and sites), ending with the usual catch-all"""
+    rules = ['<lfn-to-pfn protocol="xrootd" chain="direct" path-match="(.*)" result="$1"/>']
+    for i in range(n_rules):
+        rules.append(f'<lfn-to-pfn protocol="direct" path-match="/+vo{i}/site{i % 7}/+store/(.*)/+data/(.*)" '
+                     f'result="vo{i}:/store/$1/data/$2"/>')
+    rules.append('<lfn-to-pfn protocol="direct" path-match="/+store/(.*)" result="cms:/store/$1"/>')
+    rules.append('<lfn-to-pfn protocol="direct" path-match="/*(.*)" result="$1"/>')
+    return '<storage-mapping>\n' + '\n'.join(rules) + '\n</storage-mapping>\n'
+
+
+def make_lfns(n=200, n_rules=500, seed=1):
+    """LFNs matching early, late, and none of the VO rules (falling through to the catch-all)"""
+    rng = random.Random(seed)
+    lfns = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            vo = rng.randrange(10)
+            lfns.append(f'/vo{vo}/site{vo % 7}/store/mc/run{i}/data/file{i}.root')
+        elif kind == 1:
+            vo = n_rules - 1 - rng.randrange(10)
+            lfns.append(f'/vo{vo}/site{vo % 7}/store/mc/run{i}/data/file{i}.root')
+        else:
+            lfns.append(f'/atlas:rucio/tests/{rng.randrange(256):02x}/{rng.randrange(256):02x}/step{i}.ESD.{i}')
+    return lfns
+
+
+def make_blobs(n=200, seed=1):
+    """XrdCks binary values, two thirds little endian and one third in the older big endian format"""
+    rng = random.Random(seed)
+    blobs = []
+    for i in range(n):
+        cks = XrdCks.XrdCks('adler32', 1600000000 + rng.randrange(10**8), rng.randrange(1000), f'{rng.getrandbits(32):08x}')
+        blob = cks.to_binary()
+        if i % 3 == 2:
+            blob = XrdCks.XrdCks._struct_big.pack(*XrdCks.XrdCks._struct.unpack(blob))
+        blobs.append(blob)
+    return blobs
+
+
+def benchmarks():
+    """Dict of name to (function, calls per run); each function makes one call of the benchmarked code per input"""
+    mapper = lfn2pfn.Lfn2PfnMapper.from_string(make_storage_xml())
+    lfns = make_lfns()
+    blobs = make_blobs()
+    xrdckss = [XrdCks.XrdCks.from_binary(blob) for blob in blobs]
+    ints = [random.Random(1).getrandbits(32) for _ in range(1000)]
+    buffers = [bytes(4096)] * 2000
+    big_buffers = [os.urandom(1024*1024)] * 8
+
+    def parse():
+        for lfn in lfns:
+            mapper.parse(lfn)
+
+    def from_binary():
+        for blob in blobs:
+            XrdCks.XrdCks.from_binary(blob)
+
+    def to_binary():
+        for xrdcks in xrdckss:
+            xrdcks.to_binary()
+
+    def get_cksum_as_hex():
+        for xrdcks in xrdckss:
+            xrdcks.get_cksum_as_hex()
+
+    def inttohex():
+        for value in ints:
+            adler32.adler32.adler32_inttohex(value)
+
+    def calc_checksum_small():
+        adler32.adler32().calc_checksum(buffers)
+
+    def calc_checksum_large():
+        adler32.adler32().calc_checksum(big_buffers)
+
+    return {'Lfn2PfnMapper.parse': (parse, len(lfns)),
+            'XrdCks.from_binary': (from_binary, len(blobs)),
+            'XrdCks.to_binary': (to_binary, len(xrdckss)),
+            'XrdCks.get_cksum_as_hex': (get_cksum_as_hex, len(xrdckss)),
+            'adler32.adler32_inttohex': (inttohex, len(ints)),
+            'adler32.calc_checksum.4KiB_buffers': (calc_checksum_small, len(buffers)),
+            'adler32.calc_checksum.1MiB_buffers': (calc_checksum_large, len(big_buffers)),
+            }
+
+
+def run(names=None, repeat=5, min_time=0.2):
+    """Run the benchmarks (all, or those in names); returns the results dict, as stored in json"""
+    results = {}
+    for name, (func, calls) in benchmarks().items():
+        if names and name not in names:
+            continue
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        number = max(1, int(number * min_time / 0.2))
+        best = min(timer.repeat(repeat=repeat, number=number)) / number
+        results[name] = {'per_call_s': best / calls, 'calls': calls, 'number': number, 'repeat': repeat}
+    return {'created': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results}
+
+
+def compare(baseline, current, threshold=0.2):
+    """Compare two sets of results; returns a list of (name, baseline, current, ratio, regressed)
+    where regressed is True if current is slower than baseline by more than the threshold fraction"""
+    rows = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        before, after = baseline['results'][name]['per_call_s'], result['per_call_s']
+        ratio = after / before if before > 0 else float('inf')
+        rows.append((name, before, after, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def print_comparison(rows, out=sys.stdout):
+    for name, before, after, ratio, regressed in rows:
+        out.write(f'{name:40s} {before*1e6:12.3f}us {after*1e6:12.3f}us {ratio:7.2f}x{"  REGRESSED" if regressed else ""}\n')
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the pure python hot paths')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('-o','--output',default=None, help='Write the results to this json file')
+    run_parser.add_argument('-b','--bench',default=None, action='append', dest='names', help='Only run this benchmark')
+    run_parser.add_argument('--repeat',default=5, type=int)
+    run_parser.add_argument('--compare',default=None, dest='baseline', help='Compare to the results in this json file')
+    run_parser.add_argument('--threshold',default=0.2, type=float, help='Fail if slower than the baseline by this fraction')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold',default=0.2, type=float, help='Fail if slower than the baseline by this fraction')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        current = run(args.names, args.repeat)
+        for name, result in current['results'].items():
+            sys.stdout.write(f'{name:40s} {result["per_call_s"]*1e6:12.3f}us\n')
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(current, f, indent=1)
+        baseline_file = args.baseline
+    elif args.command == 'compare':
+        with open(args.current) as f:
+            current = json.load(f)
+        baseline_file = args.baseline
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        rows = compare(baseline, current, args.threshold)
+        print_comparison(rows)
+        if any(row[4] for row in rows):
+            sys.exit(1)
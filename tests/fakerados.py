@@ -0,0 +1,270 @@
+import sys, os, time
+import errno, threading
+import types, json, zlib
+
+# The cephsum modules import their siblings directly (they are run as scripts from the cephsum directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cephsum'))
+
+# Minimal in-memory replacement for the librados ioctx, used for the tests.
+# If the librados python bindings are not available, a placeholder module with the exceptions is registered.
+try:
+    import rados
+except ImportError:
+    rados = types.ModuleType('rados')
+
+    class Error(Exception):
+        def __init__(self, message='', errno=None):
+            super().__init__(message)
+            self.errno = errno
+
+    class ObjectNotFound(Error):
+        pass
+
+    class NoData(Error):
+        pass
+
+    class ObjectExists(Error):
+        pass
+
+    rados.Error = Error
+    rados.OSError = Error
+    rados.ObjectNotFound = ObjectNotFound
+    rados.NoData = NoData
+    rados.ObjectExists = ObjectExists
+    sys.modules['rados'] = rados
+
+import osdmap # for the placement of objects in PGs
+
+
+class FakeCompletion:
+    """Completion of an aio call; the fake operations complete immediately, the callback may follow later"""
+    def __init__(self, return_value=0):
+        self.return_value = return_value
+        self.callback_done = threading.Event()
+        self.callback_done.set()
+
+    def wait_for_complete(self):
+        pass
+
+    def wait_for_complete_and_cb(self):
+        self.callback_done.wait()
+
+    def is_complete(self):
+        return True
+
+    def get_return_value(self):
+        return self.return_value
+
+
+class FakeLegacyWriteOp:
+    """Records the operations added, as (name, args) tuples, to be applied by operate_write_op; 
+    as in bindings without the xattr compare"""
+    def __init__(self):
+        self.ops = []
+        self.released = False
+
+    def set_xattr(self, xattr_name, xattr_value):
+        self.ops.append(('set_xattr', (xattr_name, xattr_value)))
+
+    def rm_xattr(self, xattr_name):
+        self.ops.append(('rm_xattr', (xattr_name,)))
+
+
+class FakeWriteOp(FakeLegacyWriteOp):
+    """Write operation with the xattr compare"""
+    def cmpxattr(self, xattr_name, op, value):
+        self.ops.append(('cmpxattr', (xattr_name, op, value)))
+
+
+class FakeIoctx:
+    """Holds objects, and their xattrs, in dicts keyed by oid"""
+    def __init__(self):
+        self.objects = {}
+        self.xattrs = {}
+        self.mtimes = {}
+        self.operated = []
+        self.read_delays = {}
+        self.write_op_class = FakeWriteOp
+
+    def add_striped(self, path, data, object_size=64*1024*1024, striper_xattrs=True):
+        """Store data as path.%016x stripes, with the libradosstriper xattrs on chunk0"""
+        counter = 0
+        for offset in range(0, max(len(data), 1), object_size):
+            self.write_full(path + f'.{counter:016x}', data[offset:offset+object_size])
+            counter += 1
+        if striper_xattrs:
+            oid = path + f'.{0:016x}'
+            self.set_xattr(oid, 'striper.layout.object_size', str(object_size).encode())
+            self.set_xattr(oid, 'striper.size', str(len(data)).encode())
+
+    def write_full(self, oid, data):
+        self.objects[oid] = bytes(data)
+        self.xattrs.setdefault(oid, {})
+        self.mtimes[oid] = time.time()
+
+    def remove_object(self, oid):
+        if oid not in self.objects:
+            raise rados.ObjectNotFound(f'{oid}')
+        del self.objects[oid]
+        del self.xattrs[oid]
+        del self.mtimes[oid]
+        return True
+
+    def aio_write(self, oid, data, offset=0, oncomplete=None, onsafe=None):
+        current = bytearray(self.objects.get(oid, b''))
+        if len(current) < offset:
+            current += bytes(offset - len(current))
+        current[offset:offset+len(data)] = data
+        self.write_full(oid, current)
+        completion = FakeCompletion()
+        if oncomplete is not None:
+            oncomplete(completion)
+        return completion
+
+    def _aio(self, oncomplete, func, *args):
+        """Run func, then call oncomplete(completion, *results) from another thread, after aio_delay seconds"""
+        try:
+            result = func(*args)
+            ret = 0
+        except rados.ObjectNotFound:
+            result, ret = None, -errno.ENOENT
+        except rados.NoData:
+            result, ret = None, -errno.ENODATA
+        except rados.Error as e:
+            result, ret = None, -e.errno
+        if not isinstance(result, tuple):
+            result = (result,)
+        completion = FakeCompletion(ret)
+        if oncomplete is not None:
+            completion.callback_done.clear()
+            def callback():
+                oncomplete(completion, *result)
+                completion.callback_done.set()
+            timer = threading.Timer(getattr(self, 'aio_delay', 0), callback)
+            timer.start()
+        return completion
+
+    def aio_stat(self, oid, oncomplete):
+        return self._aio(oncomplete, self.stat, oid)
+
+    def aio_read(self, oid, length, offset, oncomplete):
+        if oid not in self.read_delays:
+            return self._aio(oncomplete, self.read, oid, length, offset)
+        # the injected latency delays the completion, not the caller: the read is made from another thread
+        completion = FakeCompletion()
+        completion.callback_done.clear()
+        def background():
+            try:
+                data = self.read(oid, length, offset)
+            except rados.ObjectNotFound:
+                data, completion.return_value = None, -errno.ENOENT
+            if oncomplete is not None:
+                oncomplete(completion, data)
+            completion.callback_done.set()
+        threading.Thread(target=background, daemon=True).start()
+        return completion
+
+    def aio_getxattr(self, oid, xattr_name, oncomplete):
+        return self._aio(oncomplete, self.get_xattr, oid, xattr_name)
+
+    def aio_setxattr(self, oid, xattr_name, xattr_value, oncomplete=None):
+        return self._aio(oncomplete, lambda: self.set_xattr(oid, xattr_name, xattr_value) and ())
+
+    def create_write_op(self):
+        return self.write_op_class()
+
+    def release_write_op(self, write_op):
+        write_op.released = True
+
+    def operate_write_op(self, write_op, oid, mtime=0, flags=0):
+        """Apply all recorded operations, or none if any fails"""
+        if oid not in self.objects:
+            raise rados.ObjectNotFound(f'{oid}')
+        self.operated.append((oid, list(write_op.ops)))
+        xattrs = dict(self.xattrs[oid])
+        for name, args in write_op.ops:
+            if name == 'cmpxattr':
+                # only the equal comparison (op 1) is used
+                if args[1] != 1 or xattrs.get(args[0], b'') != args[2]:
+                    raise rados.OSError(f'{oid} {args[0]}', errno=errno.ECANCELED)
+            elif name == 'set_xattr':
+                xattrs[args[0]] = bytes(args[1])
+            elif name == 'rm_xattr':
+                if args[0] not in xattrs:
+                    raise rados.NoData(f'{oid} {args[0]}')
+                del xattrs[args[0]]
+        self.xattrs[oid] = xattrs
+
+    def operate_aio_write_op(self, write_op, oid, oncomplete=None, onsafe=None, mtime=0, flags=0):
+        return self._aio(oncomplete, lambda: self.operate_write_op(write_op, oid) or ())
+
+    def list_objects(self):
+        return iter([types.SimpleNamespace(key=oid) for oid in sorted(self.objects)])
+
+    def stat(self, oid):
+        if oid not in self.objects:
+            raise rados.ObjectNotFound(f'{oid}')
+        return len(self.objects[oid]), time.localtime(self.mtimes[oid])
+
+    def replica(self):
+        """Another ioctx on the same objects, with its own injected read latencies"""
+        other = FakeIoctx()
+        other.objects, other.xattrs, other.mtimes = self.objects, self.xattrs, self.mtimes
+        return other
+
+    def read(self, oid, length=8192, offset=0):
+        if oid in self.read_delays:
+            time.sleep(self.read_delays[oid])
+        if oid not in self.objects:
+            raise rados.ObjectNotFound(f'{oid}')
+        return self.objects[oid][offset:offset+length]
+
+    def get_xattr(self, oid, xattr_name):
+        if oid not in self.objects:
+            raise rados.ObjectNotFound(f'{oid}')
+        if xattr_name not in self.xattrs[oid]:
+            raise rados.NoData(f'{oid} {xattr_name}')
+        return self.xattrs[oid][xattr_name]
+
+    def set_xattr(self, oid, xattr_name, xattr_value):
+        if oid not in self.objects:
+            raise rados.ObjectNotFound(f'{oid}')
+        self.xattrs[oid][xattr_name] = bytes(xattr_value)
+        return True
+
+    def rm_xattr(self, oid, xattr_name):
+        if oid not in self.objects:
+            raise rados.ObjectNotFound(f'{oid}')
+        if xattr_name not in self.xattrs[oid]:
+            raise rados.NoData(f'{oid} {xattr_name}')
+        del self.xattrs[oid][xattr_name]
+        return True
+
+
+class FakeCluster:
+    """Answers the 'osd map' mon command, placing each object in a PG (with the rjenkins hash, as ceph does), 
+    and each PG on (up to) 3 of num_osds OSDs, and 'osd pool get' for pg_num"""
+    def __init__(self, num_osds=4, pg_num=16):
+        self.num_osds = num_osds
+        self.pg_num = pg_num
+        self.mon_commands = 0
+
+    def primary(self, oid):
+        return osdmap.pg_of(oid, self.pg_num) % self.num_osds
+
+    def pool_lookup(self, pool):
+        return 3
+
+    def mon_command(self, cmd, inbuf, timeout=0, target=None):
+        self.mon_commands += 1
+        cmd = json.loads(cmd)
+        if cmd['prefix'] == 'osd pool get' and cmd['var'] == 'pg_num':
+            return 0, json.dumps({'pool': cmd['pool'], 'pg_num': self.pg_num}).encode(), ''
+        if cmd['prefix'] != 'osd map':
+            return -errno.EINVAL, b'', 'unknown command'
+        osd = self.primary(cmd['object'])
+        acting = [(osd + i) % self.num_osds for i in range(min(3, self.num_osds))]
+        out = {'pool': cmd['pool'], 'objname': cmd['object'], 'acting': acting, 'acting_primary': osd,
+               'raw_pgid': f'{self.pool_lookup(cmd["pool"])}.{osdmap.object_hash(cmd["object"]):08x}',
+               'pgid': f'{self.pool_lookup(cmd["pool"])}.{osdmap.pg_of(cmd["object"], self.pg_num):x}'}
+        return 0, json.dumps(out).encode(), ''
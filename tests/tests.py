@@ -5,6 +5,13 @@ import datetime
 from cephsum import adler32, XrdCks
 from cephsum import lfn2pfn
 
+import hashlib, io, json, os, sys, tempfile, zlib
+import fakerados
+import bench
+import top
+import actions, adaptive, asyncactions, backends, bulk, cephtools, importcks, osdmap, pagecrc, plan, poolindex, progress, repairs, replay, scheduler, spool, tpc
+import asyncio, concurrent.futures, functools, threading, time
+
 class TestAdler32(unittest.TestCase):
     def test_inttohex(self):
         """
@@ -141,6 +148,1433 @@ class TestLfn2Pfn(unittest.TestCase):
         self.assertEqual(pfn,'/path1/middle/file2')
 
 
+class TestTpc(unittest.TestCase):
+    _path = 'test/rucio/tests/tpc.file'
+
+    def test_copy_with_checksum(self):
+        data = os.urandom(3*1024*1024 + 17)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src_name = os.path.join(tmpdir, 'src')
+            dst_name = os.path.join(tmpdir, 'dst')
+            with open(src_name, 'wb') as f:
+                f.write(data)
+            with open(src_name, 'rb') as src, open(dst_name, 'wb') as dst:
+                cks_hex, bytes_read = tpc.copy_with_checksum(src, dst, readsize=1024*1024)
+            with open(dst_name, 'rb') as f:
+                self.assertEqual(data, f.read())
+
+        self.assertEqual(len(data), bytes_read)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(data)), cks_hex)
+
+    def fake_xrdcp(self, tmpdir):
+        # writes its stdin to the file of the last argument, or its first argument to stdout if the last is -
+        xrdcp = os.path.join(tmpdir, 'xrdcp')
+        with open(xrdcp, 'w') as f:
+            f.write(f'#!{sys.executable}\n'
+                    'import shutil, sys\n'
+                    'if sys.argv[-1] == "-":\n'
+                    '    with open(sys.argv[-2], "rb") as f: shutil.copyfileobj(f, sys.stdout.buffer)\n'
+                    '    sys.exit(int(sys.argv[-2].endswith("truncated")))\n'
+                    'with open(sys.argv[-1], "wb") as f: shutil.copyfileobj(sys.stdin.buffer, f)\n')
+        os.chmod(xrdcp, 0o755)
+        return xrdcp
+
+    def test_copy_to_xrdcp(self):
+        data = os.urandom(5000)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xrdcp = self.fake_xrdcp(tmpdir)
+            for name, check in [('complete', True), ('truncated', False)]:
+                src_name, dst_name = os.path.join(tmpdir, name), os.path.join(tmpdir, name + '.dst')
+                with open(src_name, 'wb') as f:
+                    f.write(data)
+                source = tpc.start_source(src_name, xrdcp)
+                cks_hex, bytes_read, returncode = tpc.copy_to_xrdcp(source.stdout, dst_name, 1024, xrdcp,
+                                                                    tpc.source_checker(source))
+                source.stdout.close()
+                self.assertEqual(len(data), bytes_read)
+                self.assertEqual(0 if check else 1, returncode)
+                if check:
+                    with open(dst_name, 'rb') as f:
+                        self.assertEqual(data, f.read())
+            # with piped input, the expected size
+            self.assertEqual('4999 bytes received, expected 5000', tpc.source_checker(size=5000)(4999))
+            self.assertIsNone(tpc.source_checker(size=5000)(5000))
+
+    def test_store_from_stream(self):
+        data = os.urandom(5000)
+        dst = io.BytesIO()
+        cks_hex, bytes_read = tpc.copy_with_checksum(io.BytesIO(data), dst, readsize=1024)
+
+        ioctx = fakerados.FakeIoctx()
+        ioctx.add_striped(self._path, dst.getvalue(), object_size=2048)
+        xrdcks = actions.store_from_stream(ioctx, self._path, cks_hex, bytes_read)
+        self.assertEqual('transfer', xrdcks.source_type)
+
+        stored = XrdCks.XrdCks.from_binary(ioctx.xattrs[self._path + '.0000000000000000']['XrdCks.adler32'])
+        self.assertEqual('little', stored.read_format)
+        self.assertEqual(cks_hex, stored.get_cksum_as_hex())
+
+    def test_store_from_stream_size_mismatch(self):
+        ioctx = fakerados.FakeIoctx()
+        ioctx.add_striped(self._path, b'1234', object_size=2048)
+        with self.assertRaises(IOError):
+            actions.store_from_stream(ioctx, self._path, '01f800cb', 5)
+        self.assertNotIn('XrdCks.adler32', ioctx.xattrs[self._path + '.0000000000000000'])
+
+
+class TestStripedWriter(unittest.TestCase):
+    _path = 'test/rucio/tests/written.file'
+
+    def test_write(self):
+        data = os.urandom(10000)
+        ioctx = fakerados.FakeIoctx()
+        with cephtools.StripedWriter(ioctx, self._path, object_size=4096, writesize=1000,
+                                     max_inflight_bytes=2000, digests=['md5']) as writer:
+            for offset in range(0, len(data), 777):
+                writer.write(data[offset:offset+777])
+
+        self.assertEqual(data[:4096], ioctx.objects[self._path + '.0000000000000000'])
+        self.assertEqual(data[8192:], ioctx.objects[self._path + '.0000000000000002'])
+        self.assertNotIn(self._path + '.0000000000000003', ioctx.objects)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(data)), writer.xrdcks.get_cksum_as_hex())
+        self.assertEqual(hashlib.md5(data).hexdigest(), writer.hexdigests()['md5'])
+
+        # the written file is read back as any other striped file
+        xrdcks = cephtools.cks_from_metadata(ioctx, self._path, 'XrdCks.adler32')
+        self.assertEqual(writer.xrdcks.get_cksum_as_hex(), xrdcks.get_cksum_as_hex())
+        self.assertEqual(len(data), xrdcks.total_size_bytes)
+        self.assertEqual(xrdcks.get_cksum_as_hex(), cephtools.cks_from_file(ioctx, self._path, 1024).get_cksum_as_hex())
+
+    def test_abort(self):
+        ioctx = fakerados.FakeIoctx()
+        with self.assertRaises(RuntimeError):
+            with cephtools.StripedWriter(ioctx, self._path, object_size=4096) as writer:
+                writer.write(b'1234')
+                raise RuntimeError("failed transfer")
+        self.assertIsNone(cephtools.retrieve_xattr(ioctx, self._path, 'striper.size'))
+        self.assertIsNone(cephtools.retrieve_xattr(ioctx, self._path, 'XrdCks.adler32'))
+
+        # the stripes already written are removed, so that the transfer can be retried
+        with self.assertRaises(RuntimeError):
+            with cephtools.StripedWriter(ioctx, self._path, object_size=4096, writesize=1000) as writer:
+                writer.write(os.urandom(10000))
+                raise RuntimeError("failed transfer")
+        self.assertEqual({}, ioctx.objects)
+        with cephtools.StripedWriter(ioctx, self._path, object_size=4096) as writer:
+            writer.write(b'1234')
+        self.assertEqual('01f800cb', writer.xrdcks.get_cksum_as_hex())
+
+    def test_existing(self):
+        ioctx = fakerados.FakeIoctx()
+        ioctx.add_striped(self._path, b'x' * 10000, object_size=4096)
+        with self.assertRaises(ValueError):
+            cephtools.StripedWriter(ioctx, self._path, object_size=4096)
+        with cephtools.StripedWriter(ioctx, self._path, object_size=4096, overwrite=True) as writer:
+            writer.write(b'1234')
+        self.assertEqual(['test/rucio/tests/written.file.0000000000000000'], list(ioctx.objects))
+        self.assertEqual('01f800cb', writer.xrdcks.get_cksum_as_hex())
+
+
+class TestPosixBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data = os.urandom(3*1024*1024 + 5)
+        with open(os.path.join(self.tmpdir.name, 'file.root'), 'wb') as f:
+            f.write(self.data)
+        self.backend = backends.PosixBackend(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_cks_from_file(self):
+        xrdcks = actions.get_from_file(self.backend, '/file.root', 1024*1024)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(self.data)), xrdcks.get_cksum_as_hex())
+        self.assertEqual(len(self.data), xrdcks.total_size_bytes)
+
+    def test_empty_file(self):
+        open(os.path.join(self.tmpdir.name, 'empty'), 'wb').close()
+        xrdcks = actions.get_from_file(self.backend, 'empty', 1024*1024)
+        self.assertEqual('00000001', xrdcks.get_cksum_as_hex())
+
+    def test_inget(self):
+        try:
+            os.setxattr(os.path.join(self.tmpdir.name, 'file.root'), 'user.test', b'1')
+        except OSError:
+            self.skipTest('user xattrs not supported in the temporary directory')
+        xrdcks = actions.inget(self.backend, 'file.root', 1024*1024)
+        self.assertEqual('file', xrdcks.source_type)
+
+        stored = os.getxattr(os.path.join(self.tmpdir.name, 'file.root'), 'user.XrdCks.adler32')
+        self.assertEqual(xrdcks.to_binary(), stored)
+        xrdcks = actions.inget(self.backend, 'file.root', 1024*1024)
+        self.assertEqual('metadata', xrdcks.source_type)
+        with self.assertRaises(ValueError):
+            self.backend.set_xattr('file.root', 'XrdCks.adler32', stored)
+
+
+class TestWriteXattr(unittest.TestCase):
+    _path = 'test/rucio/tests/xattr.file'
+    _oid = _path + '.0000000000000000'
+
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.ioctx.add_striped(self._path, b'1234', object_size=4096)
+
+    def test_set_if_absent(self):
+        cephtools.write_xattr(self.ioctx, self._path, 'XrdCks.adler32', b'value1')
+        self.assertEqual([(self._oid, [('cmpxattr', ('XrdCks.adler32', cephtools.CMPXATTR_OP_EQ, b'')),
+                                       ('set_xattr', ('XrdCks.adler32', b'value1'))])],
+                         self.ioctx.operated)
+        self.assertEqual(b'value1', self.ioctx.xattrs[self._oid]['XrdCks.adler32'])
+
+        with self.assertRaises(ValueError):
+            cephtools.write_xattr(self.ioctx, self._path, 'XrdCks.adler32', b'value2')
+        self.assertEqual(2, len(self.ioctx.operated))
+        self.assertEqual(b'value1', self.ioctx.xattrs[self._oid]['XrdCks.adler32'])
+
+    def test_force(self):
+        cephtools.write_xattr(self.ioctx, self._path, 'XrdCks.adler32', b'value1')
+        cephtools.write_xattr(self.ioctx, self._path, 'XrdCks.adler32', b'value2', force=True)
+        self.assertEqual((self._oid, [('set_xattr', ('XrdCks.adler32', b'value2'))]), self.ioctx.operated[-1])
+        self.assertEqual(b'value2', self.ioctx.xattrs[self._oid]['XrdCks.adler32'])
+
+    def test_rewrite_little_endian(self):
+        xrdcks = XrdCks.XrdCks('adler32', 1623062359, 10, '88b8f4a2')
+        big = XrdCks.XrdCks._struct_big.pack(b'adler32', 1623062359, 10, 0, b'\x00', b'\x04', xrdcks.cks_value)
+        self.ioctx.xattrs[self._oid]['XrdCks.adler32'] = big
+
+        xrdcks = actions.inget(self.ioctx, self._path, 1024)
+        self.assertEqual('big', xrdcks.read_format)
+        self.assertEqual([(self._oid, [('set_xattr', ('XrdCks.adler32', xrdcks.to_binary()))])], self.ioctx.operated)
+        self.assertEqual('little', XrdCks.XrdCks.from_binary(self.ioctx.xattrs[self._oid]['XrdCks.adler32']).read_format)
+
+    def test_async(self):
+        async def run():
+            aioctx = asyncactions.AsyncIoctx(self.ioctx)
+            await asyncactions.cks_write_metadata(aioctx, self._path, 'XrdCks.adler32', b'value1')
+            with self.assertRaises(ValueError):
+                await asyncactions.cks_write_metadata(aioctx, self._path, 'XrdCks.adler32', b'value2')
+            await asyncactions.cks_write_metadata(aioctx, self._path, 'XrdCks.adler32', b'value3', force_overwrite=True)
+        asyncio.run(run())
+        self.assertEqual(3, len(self.ioctx.operated))
+        self.assertEqual(b'value3', self.ioctx.xattrs[self._oid]['XrdCks.adler32'])
+
+    def test_async_without_cmpxattr(self):
+        self.ioctx.write_op_class = fakerados.FakeLegacyWriteOp
+        async def run():
+            aioctx = asyncactions.AsyncIoctx(self.ioctx)
+            await asyncactions.cks_write_metadata(aioctx, self._path, 'XrdCks.adler32', b'value1')
+            with self.assertRaises(ValueError):
+                await asyncactions.cks_write_metadata(aioctx, self._path, 'XrdCks.adler32', b'value2')
+            await asyncactions.cks_write_metadata(aioctx, self._path, 'XrdCks.adler32', b'value3', force_overwrite=True)
+        asyncio.run(run())
+        # checked and set with separate calls; only the forced write is a write op
+        self.assertEqual([(self._oid, [('set_xattr', ('XrdCks.adler32', b'value3'))])], self.ioctx.operated)
+        self.assertEqual(b'value3', self.ioctx.xattrs[self._oid]['XrdCks.adler32'])
+
+
+class TestRepairs(unittest.TestCase):
+    _path = 'test/rucio/tests/repair.file'
+    _oid = _path + '.0000000000000000'
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journal = repairs.RepairJournal(os.path.join(self.tmpdir.name, 'repairs.db'), max_attempts=2, retry_delay=0)
+        self.ioctx = fakerados.FakeIoctx()
+        self.ioctx.add_striped(self._path, b'1234', object_size=4096)
+        xrdcks = XrdCks.XrdCks('adler32', 1623062359, 10, '88b8f4a2')
+        self.big = XrdCks.XrdCks._struct_big.pack(b'adler32', 1623062359, 10, 0, b'\x00', b'\x04', xrdcks.cks_value)
+        self.ioctx.xattrs[self._oid]['XrdCks.adler32'] = self.big
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def inget(self):
+        return actions.inget(self.ioctx, self._path, 1024, defer=functools.partial(self.journal.record, 'dteam'))
+
+    def test_deferred(self):
+        xrdcks = self.inget()
+        self.assertEqual('88b8f4a2', xrdcks.get_cksum_as_hex())
+        self.assertEqual([], self.ioctx.operated)
+        self.inget()
+        self.assertEqual(1, self.journal.stats()['pending'])
+
+        counts = repairs.apply_pending(self.journal, lambda pool: self.ioctx)
+        self.assertEqual({'applied': 1, 'superseded': 0, 'failed': 0}, counts)
+        self.assertEqual(xrdcks.to_binary(), self.ioctx.xattrs[self._oid]['XrdCks.adler32'])
+        self.assertEqual(0, self.journal.stats()['pending'])
+
+    def test_superseded(self):
+        self.inget()
+        self.ioctx.xattrs[self._oid]['XrdCks.adler32'] = b'newer'
+        self.ioctx.add_striped('test/rucio/tests/other.file', b'1234', object_size=4096)
+        self.journal.record('dteam', 'test/rucio/tests/other.file', 'XrdCks.adler32', b'value')
+        self.journal.record('dteam', 'test/rucio/tests/gone.file', 'XrdCks.adler32', b'value')
+        counts = repairs.apply_pending(self.journal, lambda pool: self.ioctx)
+        self.assertEqual({'applied': 1, 'superseded': 2, 'failed': 0}, counts)
+        self.assertEqual(b'newer', self.ioctx.xattrs[self._oid]['XrdCks.adler32'])
+        self.assertEqual(b'value', self.ioctx.xattrs['test/rucio/tests/other.file.0000000000000000']['XrdCks.adler32'])
+
+    def test_expected_as_read(self):
+        self.inget()
+        # the big endian value, as read for the answer
+        self.assertEqual(self.big, self.journal.pending()[0][4])
+
+    def test_without_cmpxattr(self):
+        self.ioctx.write_op_class = fakerados.FakeLegacyWriteOp
+        self.test_superseded()
+        self.assertEqual(1, len(self.ioctx.operated))
+        self.assertEqual(0, self.journal.stats()['pending'])
+
+    def test_failed(self):
+        self.inget()
+        def get_ioctx(pool):
+            raise IOError('no pool')
+        self.assertEqual(1, repairs.apply_pending(self.journal, get_ioctx)['failed'])
+        self.assertEqual(1, self.journal.stats()['retried'])
+        self.assertEqual(1, repairs.apply_pending(self.journal, get_ioctx)['failed'])
+        self.assertEqual(0, self.journal.stats()['pending'])
+
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.data = {}
+        for i in range(6):
+            self.data[f'test/import/file{i}'] = os.urandom(3000 + i)
+            self.ioctx.add_striped(f'test/import/file{i}', self.data[f'test/import/file{i}'], object_size=1024)
+
+    def line(self, path, size=None, cks=None, mtime=1623062359):
+        size = len(self.data[path]) if size is None else size
+        cks = f'{zlib.adler32(self.data[path]):08x}' if cks is None else cks
+        return f'dteam:{path} {size} {cks} {mtime}'
+
+    def test_parse(self):
+        self.assertEqual(('dteam:f', 10, '0000abcd', 5), importcks.parse_catalogue_line('dteam:f,10, 0xABCD\t5.5\n'))
+        self.assertIsNone(importcks.parse_catalogue_line('# lfn size adler32 mtime'))
+        for line in ['dteam:f 10 abcd', 'dteam:f 10 123456789 5', 'dteam:f 10 xyz 5']:
+            with self.assertRaises(ValueError):
+                importcks.parse_catalogue_line(line)
+
+    def test_import(self):
+        paths = sorted(self.data)
+        existing = XrdCks.XrdCks('adler32', 1623062359, 0, f'{zlib.adler32(self.data[paths[1]]):08x}')
+        self.ioctx.xattrs[paths[1] + '.0000000000000000']['XrdCks.adler32'] = existing.to_binary()
+        self.ioctx.xattrs[paths[2] + '.0000000000000000']['XrdCks.adler32'] = existing.to_binary()
+        lines = [self.line(paths[0]), self.line(paths[1]), self.line(paths[2]), self.line(paths[3], size=5),
+                 'dteam:test/import/gone 10 abcd 5', 'not a catalogue line', self.line(paths[4]), self.line(paths[5])]
+        counts = importcks.run_import(lambda pool: self.ioctx, lines, lfn2pfn.Lfn2PfnMapper(), batch_size=3,
+                                      verify_fraction=1.)
+        self.assertEqual({'imported': 3, 'existing': 1, 'conflict': 1, 'size_mismatch': 1, 'missing': 1, 'failed': 0,
+                          'malformed': 1, 'verified': 3, 'verify_failed': 0}, counts)
+        xrdcks = actions.get_from_metatdata(self.ioctx, paths[0])
+        self.assertEqual(f'{zlib.adler32(self.data[paths[0]]):08x}', xrdcks.get_cksum_as_hex())
+        self.assertEqual(1623062359, int(xrdcks.fm_time.timestamp()))
+        self.assertNotIn('XrdCks.adler32', self.ioctx.xattrs[paths[3] + '.0000000000000000'])
+
+    def test_verify_wrong(self):
+        path = sorted(self.data)[0]
+        counts = importcks.run_import(lambda pool: self.ioctx, [self.line(path, cks='00000001')], lfn2pfn.Lfn2PfnMapper(),
+                                      verify_fraction=1.)
+        self.assertEqual((1, 1), (counts['imported'], counts['verify_failed']))
+
+
+class TestHedgedReader(unittest.TestCase):
+    _path = 'test/rucio/tests/hedged.file'
+
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.data = os.urandom(20000)
+        self.ioctx.add_striped(self._path, self.data, object_size=4096)
+        self.replica = self.ioctx.replica()
+
+    def test_hedge_slow_stripe(self):
+        self.ioctx.read_delays[self._path + '.0000000000000002'] = 0.5
+        reader = cephtools.HedgedReader(self.ioctx, self.replica, initial_delay=0.02)
+        start = time.monotonic()
+        xrdcks = cephtools.cks_from_file(self.ioctx, self._path, 1024, reader=reader)
+        self.assertLess(time.monotonic() - start, 0.4)
+        reader.close()
+
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(self.data)), xrdcks.get_cksum_as_hex())
+        self.assertEqual(4, reader.hedges)
+        self.assertEqual(4, reader.hedge_wins)
+
+    def test_adaptive_delay(self):
+        reader = cephtools.HedgedReader(self.ioctx, self.replica, initial_delay=1.0, min_delay=0.01, min_samples=5)
+        self.assertEqual(1.0, reader.hedge_delay())
+        cephtools.cks_from_file(self.ioctx, self._path, 1024, reader=reader)
+        reader.close()
+        self.assertEqual(0.01, reader.hedge_delay())
+        self.assertEqual(0, reader.hedges)
+
+    def test_deadline(self):
+        self.ioctx.read_delays[self._path + '.0000000000000001'] = 0.5
+        self.replica.read_delays[self._path + '.0000000000000001'] = 0.5
+        reader = cephtools.HedgedReader(self.ioctx, self.replica, initial_delay=0.02, deadline=0.1)
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            cephtools.cks_from_file(self.ioctx, self._path, 4096, reader=reader)
+        self.assertLess(time.monotonic() - start, 0.4)
+        reader.close()
+
+    def test_deadline_without_hedge(self):
+        self.ioctx.read_delays[self._path + '.0000000000000000'] = 0.5
+        reader = cephtools.HedgedReader(self.ioctx, deadline=0.1)
+        with self.assertRaises(TimeoutError):
+            actions.get_from_file(backends.RadosBackend(self.ioctx, reader=reader), self._path, 4096)
+        reader.close()
+        self.assertEqual(0, reader.hedges)
+
+    def test_no_threads_left(self):
+        # the process can exit at the deadline: the slow read holds no thread of the reader
+        self.ioctx.read_delays[self._path + '.0000000000000000'] = 2
+        before = {thread for thread in threading.enumerate() if not thread.daemon}
+        reader = cephtools.HedgedReader(self.ioctx, self.replica, initial_delay=0.02, deadline=0.1)
+        self.replica.read_delays[self._path + '.0000000000000000'] = 2
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            reader.read(self._path + '.0000000000000000', 4096)
+        self.assertLess(time.monotonic() - start, 0.5)
+        reader.close()
+        self.assertEqual(1, reader.hedges)
+        self.assertEqual(set(), {thread for thread in threading.enumerate() if not thread.daemon} - before)
+
+
+class TestStructure(unittest.TestCase):
+    _path = 'test/rucio/tests/structure.file'
+
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.ioctx.add_striped(self._path, os.urandom(10000), object_size=4096)
+
+    def test_intact(self):
+        self.assertEqual([], cephtools.check_structure(self.ioctx, self._path))
+        self.ioctx.add_striped('test/empty', b'', object_size=4096)
+        self.assertEqual([], actions.check_structure(self.ioctx, 'test/empty'))
+
+    def test_missing_stripe(self):
+        self.ioctx.remove_object(self._path + '.0000000000000001')
+        problems = cephtools.check_structure(self.ioctx, self._path)
+        self.assertIn(f'Missing stripe {self._path}.0000000000000001', problems)
+        self.assertIn('Stripe sizes sum to 5904, striper.size is 10000', problems)
+
+    def test_truncated(self):
+        self.ioctx.write_full(self._path + '.0000000000000002', b'12')
+        self.assertEqual([f'Stripe {self._path}.0000000000000002 has size 2, expected 1808',
+                          'Stripe sizes sum to 8194, striper.size is 10000'],
+                         cephtools.check_structure(self.ioctx, self._path))
+
+    def test_orphan(self):
+        self.ioctx.write_full(self._path + '.0000000000000003', b'12')
+        self.assertIn(f'Orphan stripe {self._path}.0000000000000003 beyond striper.size 10000',
+                      cephtools.check_structure(self.ioctx, self._path))
+
+    def test_preflight(self):
+        self.ioctx.remove_object(self._path + '.0000000000000002')
+        self.ioctx.read_delays[self._path + '.0000000000000000'] = 5
+        with self.assertRaises(IOError):
+            cephtools.cks_from_file(self.ioctx, self._path, 1024)
+
+
+    def test_preflight_reuses_striper_xattrs(self):
+        names = []
+        get_xattr = self.ioctx.get_xattr
+        def counting_get_xattr(oid, xattr_name):
+            names.append(xattr_name)
+            return get_xattr(oid, xattr_name)
+        self.ioctx.get_xattr = counting_get_xattr
+        cephtools.cks_from_file(self.ioctx, self._path, 4096)
+        self.assertEqual(['striper.layout.object_size', 'striper.size'], names)
+
+
+class TestSparse(unittest.TestCase):
+    _path = 'test/rucio/tests/sparse.file'
+
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        # stripe 1 was never written, and only the first 100 bytes of stripe 3
+        data = bytearray(os.urandom(5*4096 + 1000))
+        data[4096:2*4096] = bytes(4096)
+        data[3*4096+100:4*4096] = bytes(4096-100)
+        self.data = bytes(data)
+        self.ioctx.add_striped(self._path, self.data, object_size=4096)
+        self.ioctx.remove_object(self._path + '.0000000000000001')
+        self.ioctx.write_full(self._path + '.0000000000000003', self.data[3*4096:3*4096+100])
+
+    def test_zeros(self):
+        for value in [1, zlib.adler32(os.urandom(1000)), 0xfff0fff0]:
+            for length in [0, 1, 5552, 65521, 1000000]:
+                self.assertEqual(zlib.adler32(bytes(length), value), adler32.adler32.adler32_zeros(value, length))
+        cks = adler32.adler32()
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(b'abc' + bytes(10**6))),
+                         cks.calc_checksum([b'abc', adler32.ZeroRun(10**6)]))
+        self.assertEqual(10**6 + 3, cks.bytes_read)
+
+    def test_holes(self):
+        self.assertEqual([], cephtools.check_structure(self.ioctx, self._path, allow_holes=True))
+        self.assertEqual(3, len(cephtools.check_structure(self.ioctx, self._path)))
+        with self.assertRaises(IOError):
+            cephtools.cks_from_file(self.ioctx, self._path, 1024)
+
+        xrdcks = cephtools.cks_from_file(self.ioctx, self._path, 1024, sparse=True)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(self.data)), xrdcks.get_cksum_as_hex())
+        self.assertEqual(len(self.data), xrdcks.total_size_bytes)
+        xrdcks = actions.inget(backends.RadosBackend(self.ioctx, sparse=True), self._path, 4096)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(self.data)), xrdcks.get_cksum_as_hex())
+
+    def test_oversized(self):
+        self.ioctx.write_full(self._path + '.0000000000000004', bytes(5000))
+        self.assertEqual([f'Stripe {self._path}.0000000000000004 has size 5000, expected 4096'],
+                         cephtools.check_structure(self.ioctx, self._path, allow_holes=True))
+
+
+class TestDiscoverStripes(unittest.TestCase):
+    _path = 'test/rucio/tests/unstriped.file'
+
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.rounds = 0
+        stat_oids = cephtools.stat_oids
+        def counting(ioctx, oids):
+            self.rounds += 1
+            return stat_oids(ioctx, oids)
+        cephtools.stat_oids = counting
+        self.addCleanup(setattr, cephtools, 'stat_oids', stat_oids)
+
+    def test_layouts(self):
+        for num_stripes in [1, 2, 3, 8, 9, 100, 257, 1000]:
+            ioctx = fakerados.FakeIoctx()
+            data = os.urandom(16 * (num_stripes - 1) + 5)
+            ioctx.add_striped(self._path, data, object_size=16, striper_xattrs=False)
+            self.rounds = 0
+            # the object size of a single stripe file is only known to be at least its size
+            object_size = 16 if num_stripes > 1 else 5
+            self.assertEqual((object_size, len(data), num_stripes, 5), cephtools.discover_stripes(ioctx, self._path))
+            self.assertLessEqual(self.rounds, 5)
+        self.assertEqual((None, None, None, None), cephtools.discover_stripes(self.ioctx, self._path))
+
+    def test_checksum(self):
+        data = os.urandom(10000)
+        self.ioctx.add_striped(self._path, data, object_size=1024, striper_xattrs=False)
+        self.assertEqual((None, None, None, None), cephtools.get_striper_xattrs(self.ioctx, self._path))
+        xrdcks = cephtools.cks_from_file(self.ioctx, self._path, 512)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(data)), xrdcks.get_cksum_as_hex())
+        self.assertEqual(len(data), xrdcks.total_size_bytes)
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = spool.Spool(os.path.join(self.tmpdir.name, 'queue.db'), max_attempts=2, retry_delay=0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_order(self):
+        self.spool.enqueue('dteam:file1')
+        self.spool.enqueue('dteam:file2', priority=5)
+        self.spool.enqueue('dteam:file3')
+        self.spool.enqueue('dteam:file3', priority=10)
+        self.assertEqual(3, self.spool.stats()['pending'])
+        self.assertEqual(['dteam:file3', 'dteam:file2', 'dteam:file1'], [self.spool.claim()[1] for _ in range(3)])
+        self.assertIsNone(self.spool.claim())
+        self.assertEqual(3, self.spool.stats()['running'])
+
+    def test_retry(self):
+        self.spool.enqueue('dteam:file1')
+        entry = self.spool.claim()
+        self.spool.failed(entry[0], IOError('failed read'))
+        self.assertEqual(entry, self.spool.claim())
+        self.spool.failed(entry[0], IOError('failed read'))
+        self.assertIsNone(self.spool.claim())
+        self.assertEqual(1, self.spool.stats()['failed'])
+
+    def test_run_workers(self):
+        ioctx = fakerados.FakeIoctx()
+        for i in range(10):
+            ioctx.add_striped(f'test/spool/file{i}', os.urandom(5000), object_size=4096)
+            self.spool.enqueue(f'dteam:test/spool/file{i}')
+        self.spool.enqueue('dteam:test/spool/missing')
+
+        stop_event = threading.Event()
+        def stop_when_empty():
+            while self.spool.stats()['pending'] > 0 or self.spool.stats()['running'] > 0:
+                time.sleep(0.01)
+            stop_event.set()
+        threading.Thread(target=stop_when_empty).start()
+        spool.run_workers(self.spool, lambda pool: ioctx, lfn2pfn.Lfn2PfnMapper(), 1024, workers=3,
+                          poll_interval=0.01, report_interval=0.01, stop_event=stop_event)
+
+        stats = self.spool.stats()
+        self.assertEqual((10, 1), (stats['done'], stats['failed']))
+        self.assertEqual(0, stats['lag_s'])
+        for i in range(10):
+            self.assertIsNotNone(cephtools.cks_from_metadata(ioctx, f'test/spool/file{i}', 'XrdCks.adler32'))
+
+
+class TestVerify(unittest.TestCase):
+    _path = 'test/rucio/tests/verify.file'
+    _oid = _path + '.0000000000000000'
+
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.data = os.urandom(10000)
+        self.ioctx.add_striped(self._path, self.data, object_size=4096)
+        self.cks_hex = f'{zlib.adler32(self.data):08x}'
+        self.store(self.cks_hex)
+
+    def store(self, cks_hex):
+        self.ioctx.xattrs[self._oid]['XrdCks.adler32'] = XrdCks.XrdCks('adler32', 1623062359, 0, cks_hex).to_binary()
+
+    def test_match(self):
+        sync_metadata = []
+        for name in ['stat', 'get_xattr']:
+            method = getattr(self.ioctx, name)
+            setattr(self.ioctx, name, lambda *args, method=method, name=name: sync_metadata.append(name) or method(*args))
+        stored, from_file = cephtools.cks_verify(self.ioctx, self._path, 1024)
+        self.assertEqual((self.cks_hex, self.cks_hex), (stored.get_cksum_as_hex(), from_file.get_cksum_as_hex()))
+        self.assertEqual((10000, 10000), (stored.total_size_bytes, from_file.total_size_bytes))
+        # the fake aio calls use stat and get_xattr: a stat and 3 xattrs before the data, the stats of the 3 stripes and 
+        # 2 orphan probes for the structure check (no xattrs), a stat and 2 xattrs after; nothing else
+        self.assertEqual(2 + 5 + 3 + 2, len(sync_metadata))
+        self.assertIsNotNone(actions.verify(self.ioctx, self._path, 1024))
+
+        self.store('00000001')
+        self.assertIsNone(actions.verify(self.ioctx, self._path, 1024))
+
+    def test_not_stored(self):
+        del self.ioctx.xattrs[self._oid]['XrdCks.adler32']
+        self.assertEqual((None, None), cephtools.cks_verify(self.ioctx, self._path, 1024))
+        stored, from_file = cephtools.cks_verify(self.ioctx, self._path, 1024, force_fileread=True)
+        self.assertEqual((None, self.cks_hex), (stored, from_file.get_cksum_as_hex()))
+        self.assertIsNone(actions.verify(self.ioctx, self._path, 1024, force_fileread=True))
+        self.assertEqual((None, None), cephtools.cks_verify(self.ioctx, 'test/missing', 1024))
+        # with a reader that can not read ahead, no data is read at all
+        reads = []
+        class Reader:
+            def read(reader, oid, length, offset=0):
+                reads.append(oid)
+                return self.ioctx.read(oid, length, offset)
+        self.assertEqual((None, None), cephtools.cks_verify(self.ioctx, self._path, 1024, reader=Reader()))
+        self.assertEqual([], reads)
+
+    def test_progress_overlap(self):
+        # as set up by cephsum.py with --progress-dir: the first block is read while the metadata is fetched
+        events = []
+        aio_read, aio_stat = self.ioctx.aio_read, self.ioctx.aio_stat
+        def recording_read(oid, length, offset, oncomplete):
+            events.append(('read', oid, offset))
+            return aio_read(oid, length, offset, oncomplete)
+        def recording_stat(oid, oncomplete):
+            completion = aio_stat(oid, oncomplete)
+            wait = completion.wait_for_complete_and_cb
+            completion.wait_for_complete_and_cb = lambda: events.append(('wait', oid)) or wait()
+            return completion
+        self.ioctx.aio_read, self.ioctx.aio_stat = recording_read, recording_stat
+        with tempfile.TemporaryDirectory() as tmpdir:
+            record = progress.Progress('verify', 'dteam', self._path, registry=tmpdir)
+            reader = progress.ProgressReader(record, self.ioctx)
+            stored, from_file = cephtools.cks_verify(self.ioctx, self._path, 1024, reader=reader)
+            record.close()
+        self.assertEqual(self.cks_hex, from_file.get_cksum_as_hex())
+        self.assertEqual([('read', self._oid, 0), ('wait', self._oid)], events[:2])
+        self.assertEqual((10000, 10000), (record.bytes_done, record.total_size))
+
+    def test_no_file_checksum(self):
+        class Backend(backends.Backend):
+            def cks_from_metadata(backend, path, xattr_name):
+                return XrdCks.XrdCks('adler32', 1623062359, 0, self.cks_hex)
+            def cks_from_file(backend, path, readsize):
+                return None
+        self.assertIsNone(actions.verify(Backend(), self._path, 1024))
+
+    def test_modified(self):
+        for change in [lambda: self.store('00000002'), lambda: self.ioctx.mtimes.__setitem__(self._oid, time.time() + 10)]:
+            class Reader:
+                def read(reader, oid, length, offset=0):
+                    if oid.endswith('1'):
+                        change()
+                    return self.ioctx.read(oid, length, offset)
+            with self.assertRaises(IOError):
+                cephtools.cks_verify(self.ioctx, self._path, 1024, reader=Reader())
+            self.setUp()
+
+    def test_readers(self):
+        self.ioctx.remove_object(self._path + '.0000000000000001')
+        # found by the structure check, before the data is read
+        reads = []
+        class Reader:
+            def read(reader, oid, length, offset=0):
+                reads.append(oid)
+                return self.ioctx.read(oid, length, offset)
+        with self.assertRaises(IOError):
+            actions.verify(backends.RadosBackend(self.ioctx, reader=Reader()), self._path, 1024)
+        self.assertEqual([], reads)
+        with self.assertRaises(fakerados.rados.ObjectNotFound):
+            cephtools.cks_verify(self.ioctx, self._path, 1024, preflight=False)
+        data = self.data[:4096] + bytes(4096) + self.data[8192:]
+        self.store(f'{zlib.adler32(data):08x}')
+        for readsize in [1024, 8192]:
+            self.assertIsNotNone(actions.verify(backends.RadosBackend(self.ioctx, sparse=True), self._path, readsize))
+        self.ioctx.write_full(self._path + '.0000000000000001', bytes(4096))
+        scheduler = osdmap.OsdScheduler(self.ioctx, osdmap.OsdMap(fakerados.FakeCluster(), 'dteam'))
+        for readsize in [1024, 8192]:
+            self.assertIsNotNone(actions.verify(backends.RadosBackend(self.ioctx, reader=scheduler), self._path, readsize))
+
+
+class TestAsyncActions(unittest.TestCase):
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.data = os.urandom(10000)
+        self.paths = [f'test/async/file{i}' for i in range(20)]
+        for path in self.paths:
+            self.ioctx.add_striped(path, self.data, object_size=4096)
+
+    def test_inget(self):
+        async def run():
+            aioctx = asyncactions.AsyncIoctx(self.ioctx, max_metadata=4, max_streams=3)
+            return await asyncio.gather(*[asyncactions.inget(aioctx, path, readsize=1000) for path in self.paths])
+        results = asyncio.run(run())
+
+        a32_hex = adler32.adler32.adler32_inttohex(zlib.adler32(self.data))
+        self.assertEqual([a32_hex]*len(self.paths), [x.get_cksum_as_hex() for x in results])
+        self.assertEqual({'file'}, {x.source_type for x in results})
+        xrdcks = cephtools.cks_from_metadata(self.ioctx, self.paths[0], 'XrdCks.adler32')
+        self.assertEqual(a32_hex, xrdcks.get_cksum_as_hex())
+
+        async def run_metadata():
+            aioctx = asyncactions.AsyncIoctx(self.ioctx)
+            return await asyncio.gather(*[asyncactions.get_from_metadata(aioctx, path) for path in self.paths])
+        results = asyncio.run(run_metadata())
+        self.assertEqual({'metadata'}, {x.source_type for x in results})
+        self.assertEqual({len(self.data)}, {x.total_size_bytes for x in results})
+
+    def test_missing(self):
+        async def run():
+            aioctx = asyncactions.AsyncIoctx(self.ioctx)
+            return (await asyncactions.get_from_metadata(aioctx, 'test/async/missing'),
+                    await asyncactions.cks_from_file(aioctx, 'test/async/missing'))
+        self.assertEqual((None, None), asyncio.run(run()))
+
+    def test_no_striper_xattrs(self):
+        data = os.urandom(4096 * 37 + 5)
+        self.ioctx.add_striped('test/async/nostriper', data, object_size=4096, striper_xattrs=False)
+        reads = []
+        read = self.ioctx.read
+        def counting_read(oid, length=8192, offset=0):
+            reads.append((oid, length, offset))
+            return read(oid, length, offset)
+        self.ioctx.read = counting_read
+        async def run():
+            aioctx = asyncactions.AsyncIoctx(self.ioctx)
+            return (await asyncactions.discover_stripes(aioctx, 'test/async/nostriper'),
+                    await asyncactions.cks_from_file(aioctx, 'test/async/nostriper', readsize=4096))
+        layout, xrdcks = asyncio.run(run())
+        self.assertEqual((4096, len(data), 38, 5), layout)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(data)), xrdcks.get_cksum_as_hex())
+        self.assertEqual(len(data), xrdcks.total_size_bytes)
+        # each stripe is read once, no reads past the end of a stripe
+        self.assertEqual(38, len(reads))
+
+    def test_cancel(self):
+        self.ioctx.aio_delay = 0.5
+        async def run():
+            aioctx = asyncactions.AsyncIoctx(self.ioctx)
+            task = asyncio.ensure_future(asyncactions.cks_from_file(aioctx, self.paths[0]))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await task
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run())
+
+
+class TestBench(unittest.TestCase):
+    def test_inputs(self):
+        mapper = lfn2pfn.Lfn2PfnMapper.from_string(bench.make_storage_xml(50))
+        self.assertEqual(52, len(mapper.mappings))
+        self.assertEqual(('vo3', '/store/mc/run0/data/file0.root'), mapper.parse('/vo3/site3/store/mc/run0/data/file0.root'))
+        formats = [XrdCks.XrdCks.from_binary(blob).read_format for blob in bench.make_blobs(6)]
+        self.assertEqual(['little', 'little', 'big']*2, formats)
+
+    def test_compare(self):
+        baseline = {'results': {'a': {'per_call_s': 1.0}, 'b': {'per_call_s': 1.0}, 'c': {'per_call_s': 1.0}}}
+        current = {'results': {'a': {'per_call_s': 1.1}, 'b': {'per_call_s': 1.5}, 'd': {'per_call_s': 1.0}}}
+        rows = bench.compare(baseline, current, threshold=0.2)
+        self.assertEqual([('a', False), ('b', True)], [(row[0], row[4]) for row in rows])
+
+    def test_run(self):
+        results = bench.run(['XrdCks.to_binary'], repeat=1, min_time=0.01)['results']
+        self.assertEqual(['XrdCks.to_binary'], list(results))
+        self.assertGreater(results['XrdCks.to_binary']['per_call_s'], 0)
+
+
+class TestReplay(unittest.TestCase):
+    _log = """CEPHSUM-2022-04-25 10:00:00,500-100-INFO-Result:Done, pool:dteam, path:dteam:test/a, checksum:00000001, time_s:0.5,  filesize_bytes:10000, source:file, exit_code:0, srccks:N/A
+CEPHSUM-2022-04-25 10:00:00,400-101-DEBUG-Some other line
+CEPHSUM-2022-04-25 10:00:00,300-102-INFO-Result:Done, pool:dteam, path:dteam:test/b, checksum:00000001, time_s:0.1,  filesize_bytes:0, source:metadata, exit_code:0, srccks:N/A
+CEPHSUM-2022-04-25 10:00:00,600-103-WARNING-Result:failed, pool:dteam, path:dteam:test/missing
+CEPHSUM-2022-04-25 10:00:01,000-104-INFO-Result:Done, pool:dteam, path:dteam:test/a, checksum:00000001, time_s:0.05,  filesize_bytes:10000, source:metadata, exit_code:0, srccks:N/A
+"""
+
+    def test_parse(self):
+        requests = replay.parse_logs(self._log.splitlines())
+        self.assertEqual(['dteam:test/a', 'dteam:test/b', 'dteam:test/missing', 'dteam:test/a'], [r.lfn for r in requests])
+        self.assertAlmostEqual(0.2, requests[1].arrival - requests[0].arrival, places=3)
+        self.assertEqual((10000, 'file', 0.5), (requests[0].size, requests[0].source, requests[0].duration))
+        self.assertEqual((None, 'failed'), (requests[2].size, requests[2].result))
+
+    def test_replay(self):
+        requests = replay.parse_logs(self._log.splitlines())
+        backend = replay.SyntheticBackend(object_size=4096, read_latency=0.01)
+        replay.populate(backend, requests, lfn2pfn.Lfn2PfnMapper())
+        self.assertIsNone(backend.get_xattr('test/a', 'XrdCks.adler32'))
+        self.assertIsNotNone(backend.get_xattr('test/b', 'XrdCks.adler32'))
+
+        records = replay.replay(requests, lambda r: actions.inget(backend, r.lfn.split(':')[1], 1024),
+                                speed=10, max_concurrency=1)
+        self.assertEqual([True, True, False, True], [r['ok'] for r in records])
+        # the first request reads 10 buffers at 10ms, the second queues behind it
+        self.assertGreater(records[1]['queue_s'], 0.05)
+        self.assertGreater(records[0]['service_s'], 0.1)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(bytes(10000))),
+                         XrdCks.XrdCks.from_binary(backend.get_xattr('test/a', 'XrdCks.adler32')).get_cksum_as_hex())
+
+        summary = replay.report(records)
+        self.assertEqual((4, 1), (summary['requests'], summary['failed']))
+        self.assertLessEqual(summary['latency_p50_s'], summary['latency_p100_s'])
+        self.assertGreater(summary['bytes_per_s'], 0)
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.sizes = [0, 1000, 5000, 5000, 20000]
+        for i, size in enumerate(self.sizes):
+            self.ioctx.add_striped(f'test/plan/file{i}', os.urandom(size), object_size=4096)
+        # files 0 and 1 already have a checksum
+        for i in range(2):
+            actions.inget(self.ioctx, f'test/plan/file{i}', 1024)
+        self.paths = sorted(plan.list_base_paths(self.ioctx))
+
+    def test_list(self):
+        self.assertEqual([f'test/plan/file{i}' for i in range(5)], self.paths)
+        self.assertEqual([], list(plan.list_base_paths(self.ioctx, 0.)))
+
+    def test_inget(self):
+        p = plan.make_plan(self.ioctx, 'dteam', self.paths, 'inget', throughput=1000., workers=2)
+        self.assertEqual(5, p['summary']['objects'])
+        self.assertEqual(3, p['summary']['objects_to_process'])
+        self.assertEqual(sum(self.sizes), p['summary']['bytes_total'])
+        self.assertEqual(30000, p['summary']['bytes_to_read'])
+        self.assertEqual({'0': 1, '1024': 1, '8192': 2, '32768': 1}, p['histogram'])
+        self.assertAlmostEqual(30000 / 2000. / 3600., p['summary']['projected_hours'])
+        self.assertEqual(self.paths[2:], p['paths'])
+
+    def test_batches(self):
+        batches = []
+        retrieve_xattrs = cephtools.retrieve_xattrs
+        def counting_retrieve_xattrs(ioctx, paths, xattr_names):
+            batches.append(len(paths))
+            return retrieve_xattrs(ioctx, paths, xattr_names)
+        plan.cephtools.retrieve_xattrs = counting_retrieve_xattrs
+        try:
+            p = plan.make_plan(self.ioctx, 'dteam', iter(self.paths), 'inget', batch_size=2)
+        finally:
+            plan.cephtools.retrieve_xattrs = retrieve_xattrs
+        self.assertEqual([2, 2, 1], batches)
+        self.assertEqual(self.paths[2:], p['paths'])
+        self.assertEqual(30000, p['summary']['bytes_to_read'])
+
+    def test_measure_throughput(self):
+        reads = []
+        read = self.ioctx.read
+        def counting_read(oid, length=8192, offset=0):
+            data = read(oid, length, offset)
+            reads.append(len(data))
+            return data
+        self.ioctx.read = counting_read
+        self.assertIsNotNone(plan.measure_throughput(self.ioctx, self.paths[2:], readsize=1024, reads_per_file=2))
+        self.assertEqual(6 * 1024, sum(reads))
+        self.assertIsNone(plan.measure_throughput(self.ioctx, ['test/plan/missing'], readsize=1024))
+
+    def test_verify_sample(self):
+        p = plan.make_plan(self.ioctx, 'dteam', self.paths[:2], 'verify', sample_fraction=0.5)
+        self.assertEqual(4, p['summary']['objects'])
+        self.assertEqual(2000, p['summary']['bytes_to_read'])
+        self.assertIsNone(p['summary']['projected_hours'])
+
+    def test_bulk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'plan.json')
+            plan.write_plan(plan.make_plan(self.ioctx, 'dteam', self.paths + ['test/plan/missing'], 'inget'), filename)
+            results = bulk.run_plan(self.ioctx, plan.read_plan(filename), readsize=1024, workers=2)
+        self.assertEqual((3, 1), (results['done'], results['failed']))
+        self.assertEqual(['test/plan/missing'], results['failed_paths'])
+        self.assertEqual(30000, results['bytes_read'])
+        p = plan.make_plan(self.ioctx, 'dteam', self.paths, 'inget')
+        self.assertEqual(0, p['summary']['objects_to_process'])
+
+
+class TestPoolIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.index = poolindex.PoolIndex(os.path.join(self.tmpdir.name, 'index.db'))
+        self.ioctx = fakerados.FakeIoctx()
+        for i in range(20):
+            self.ioctx.add_striped(f'test/index/file{i}', os.urandom(5000), object_size=4096)
+        self.shards = poolindex.pool_shards(fakerados.FakeCluster(pg_num=16), 'dteam')
+        self.listed = []
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def list_shard(self, shard):
+        self.listed.append(shard)
+        if shard == 'fail':
+            raise IOError('listing failed')
+        for obj in self.ioctx.list_objects():
+            if f'3.{zlib.crc32(obj.key.split(".")[0].encode()) % 16:x}' == shard:
+                yield obj.key
+
+    def test_shards(self):
+        self.assertEqual(['3.0', '3.1', '3.f'], [self.shards[0], self.shards[1], self.shards[-1]])
+
+    def test_refresh(self):
+        self.assertEqual((16, []), self.index.refresh(self.list_shard, self.shards, workers=4))
+        self.assertEqual(sorted(f'test/index/file{i}' for i in range(20)), list(self.index.paths()))
+        self.assertEqual({'paths': 20, 'shards': 16}, {k: v for k, v in self.index.stats().items() if k in ('paths', 'shards')})
+
+        # nothing is re-listed, unless older than max_age
+        self.listed = []
+        self.ioctx.remove_object('test/index/file3.0000000000000000')
+        self.ioctx.add_striped('test/index/new', b'1234')
+        self.assertEqual((0, []), self.index.refresh(self.list_shard, self.shards))
+        self.assertEqual([], self.listed)
+        self.assertEqual((16, []), self.index.refresh(self.list_shard, self.shards, max_age=0))
+        paths = list(self.index.paths())
+        self.assertIn('test/index/new', paths)
+        self.assertNotIn('test/index/file3', paths)
+        self.assertEqual(20, len(paths))
+
+    def test_failed_shard(self):
+        self.assertEqual((16, ['fail']), self.index.refresh(self.list_shard, self.shards + ['fail']))
+        self.assertEqual(['fail'], self.index.stale_shards(self.shards + ['fail']))
+        # shards no longer in the pool are dropped
+        self.index.refresh(self.list_shard, self.shards[:8])
+        self.assertEqual(8, self.index.stats()['shards'])
+        self.assertLess(len(list(self.index.paths())), 20)
+
+
+class TestOsdScheduler(unittest.TestCase):
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.ioctx.aio_delay = 0.01
+        self.cluster = fakerados.FakeCluster(num_osds=4)
+        self.osdmap = osdmap.OsdMap(self.cluster, 'dteam')
+        self.data = os.urandom(50000)
+        self._path = 'test/osdmap/file'
+        self.ioctx.add_striped(self._path, self.data, object_size=4096)
+
+    def test_primary_cached(self):
+        oid = self._path + cephtools.chunk0
+        self.assertEqual(self.cluster.primary(oid), self.osdmap.primary(oid))
+        self.osdmap.primary(oid)
+        # the pg_num of the pool, and the acting set of the PG of oid
+        self.assertEqual(2, self.cluster.mon_commands)
+        self.osdmap.invalidate(oid)
+        self.osdmap.primary(oid)
+        self.assertEqual(3, self.cluster.mon_commands)
+
+    def test_cached_per_pg(self):
+        oids = [f'test/osdmap/pg{i}' + cephtools.chunk0 for i in range(200)]
+        self.assertEqual([self.cluster.primary(oid) for oid in oids], [self.osdmap.primary(oid) for oid in oids])
+        pgs = {osdmap.pg_of(oid, 16) for oid in oids}
+        self.assertEqual(1 + len(pgs), self.cluster.mon_commands)
+        self.assertLessEqual(len(pgs), 16)
+
+    def test_placement_mismatch(self):
+        # e.g. a pool with another object hash; the acting sets are then cached per object
+        mon_command = self.cluster.mon_command
+        def other_hash(cmd, inbuf, timeout=0, target=None):
+            ret, outbuf, outs = mon_command(cmd, inbuf)
+            result = json.loads(outbuf)
+            if 'raw_pgid' in result:
+                result['raw_pgid'] = '3.0'
+            return ret, json.dumps(result).encode(), outs
+        self.cluster.mon_command = other_hash
+        oids = [f'test/osdmap/pg{i}' + cephtools.chunk0 for i in range(20)]
+        self.assertEqual([self.cluster.primary(oid) for oid in oids], [self.osdmap.primary(oid) for oid in oids])
+        self.assertFalse(self.osdmap.local_placement)
+        self.assertEqual(1 + len(oids), self.cluster.mon_commands)
+
+    def test_pg_split(self):
+        oids = [f'test/osdmap/pg{i}' + cephtools.chunk0 for i in range(200)]
+        self.osdmap.primary(oids[0])
+        self.cluster.pg_num = 32
+        self.assertEqual([self.cluster.primary(oid) for oid in oids], [self.osdmap.primary(oid) for oid in oids])
+        self.assertEqual(32, self.osdmap.pg_num())
+
+    def test_parallel_read(self):
+        scheduler = osdmap.OsdScheduler(self.ioctx, self.osdmap, max_per_osd=2, max_inflight=6)
+        xrdcks = cephtools.cks_from_file(self.ioctx, self._path, 1000, reader=scheduler)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(self.data)), xrdcks.get_cksum_as_hex())
+        self.assertEqual(len(self.data), xrdcks.total_size_bytes)
+        self.assertEqual(4, len(scheduler.peak_inflight))
+        self.assertEqual(2, max(scheduler.peak_inflight.values()))
+        self.assertEqual(0, scheduler.total_inflight)
+
+    def test_spread(self):
+        # the stripes on a busy OSD wait, while those on the idle OSDs are started
+        self.ioctx.aio_delay = 0.05
+        started = []
+        aio_read = self.ioctx.aio_read
+        def record_read(oid, length, offset, oncomplete):
+            started.append(self.cluster.primary(oid))
+            return aio_read(oid, length, offset, oncomplete)
+        self.ioctx.aio_read = record_read
+
+        scheduler = osdmap.OsdScheduler(self.ioctx, self.osdmap, max_per_osd=1, max_inflight=4)
+        oids = [self._path + f'.{i:016x}' for i in range(13)]
+        futures = [scheduler.submit(oid, 4096) for oid in oids]
+        self.assertEqual(self.data, b''.join(future.result() for future in futures))
+        self.assertEqual([0, 1, 2, 3], sorted(started[:4]))
+        self.assertEqual(len(oids), len(started))
+
+    def test_replicas(self):
+        oid = self._path + cephtools.chunk0
+        primary = self.cluster.primary(oid)
+        self.assertEqual(tuple((primary + i) % 4 for i in range(3)), self.osdmap.acting(oid))
+
+        # each read counts as a third on each of the 3 OSDs, so 3 reads of one object can be in flight
+        scheduler = osdmap.OsdScheduler(self.ioctx, self.osdmap, max_per_osd=1, replicas=True)
+        futures = [scheduler.submit(oid, 1000, offset) for offset in range(0, 4096, 1000)]
+        self.assertEqual(3, scheduler.total_inflight)
+        self.assertEqual(self.data[:4096], b''.join(future.result() for future in futures))
+        self.assertEqual({1.0}, set(scheduler.peak_inflight.values()))
+        self.assertEqual({0.0}, set(scheduler.inflight.values()))
+
+    def test_read_policies(self):
+        self.assertEqual({}, cephtools.parse_read_policies(None))
+        policies = cephtools.parse_read_policies('balance')
+        self.assertEqual('balance', cephtools.read_policy_for(policies, 'dteam'))
+        policies = cephtools.parse_read_policies('dteam=balance, atlas=localize')
+        self.assertEqual(['balance', 'localize', 'default'], [cephtools.read_policy_for(policies, pool) for pool in ['dteam', 'atlas', 'cms']])
+        with self.assertRaises(ValueError):
+            cephtools.parse_read_policies('dteam=fastest')
+
+    def test_ab_compare(self):
+        paths = [f'test/osdmap/ab{i}' for i in range(8)]
+        for path in paths:
+            self.ioctx.add_striped(path, os.urandom(3000), object_size=4096)
+        replica = self.ioctx.replica()
+        for path in paths:
+            self.ioctx.read_delays[path + cephtools.chunk0] = 0.02
+        arms = bulk.ab_compare(self.ioctx, {'default': None, 'balance': replica}, paths, readsize=1024, workers=2,
+                               files_per_round=2, rounds=2)
+        self.assertEqual({'default', 'balance'}, set(arms))
+        self.assertEqual((4, 0, 12000), (arms['balance']['files'], arms['balance']['failed'], arms['balance']['bytes']))
+        self.assertGreater(arms['balance']['throughput_bytes_per_s'], arms['default']['throughput_bytes_per_s'])
+        self.assertGreaterEqual(arms['default']['latency_p50_s'], 0.06)
+        # nothing is written
+        self.assertIsNone(cephtools.cks_from_metadata(self.ioctx, paths[0], 'XrdCks.adler32'))
+
+    def test_close_early(self):
+        # the reads still queued when the reading stops are cancelled, and never sent
+        started = []
+        aio_read = self.ioctx.aio_read
+        def record_read(oid, length, offset, oncomplete):
+            started.append((oid, offset))
+            return aio_read(oid, length, offset, oncomplete)
+        self.ioctx.aio_read = record_read
+        scheduler = osdmap.OsdScheduler(self.ioctx, self.osdmap, max_per_osd=1, max_inflight=2)
+        buffers = cephtools.read_file_scheduled(scheduler, self._path, 4096, len(self.data), readsize=1024)
+        self.assertEqual(self.data[:1024], next(buffers))
+        buffers.close()
+        time.sleep(0.1)
+        self.assertLessEqual(len(started), 4)
+        self.assertEqual(0, scheduler.total_inflight)
+        self.assertEqual([], [request for queue in scheduler.queues.values() for request in queue])
+
+    def test_missing(self):
+        scheduler = osdmap.OsdScheduler(self.ioctx, self.osdmap)
+        with self.assertRaises(fakerados.rados.ObjectNotFound):
+            scheduler.read('test/osdmap/missing.0000000000000000', 1000)
+        self.assertEqual(0, scheduler.total_inflight)
+
+
+class TestAdaptive(unittest.TestCase):
+    def test_aimd(self):
+        controller = adaptive.AimdController(floor=2, ceiling=6, initial=4, window=4)
+        for _ in range(4 * 5):
+            controller.record(0.01, 1024*1024)
+        self.assertEqual(6, controller.setpoint)
+        controller.record(0.01, 1024*1024, error=True)
+        for _ in range(3):
+            controller.record(0.01, 1024*1024)
+        self.assertEqual(4, controller.setpoint)
+        # latency well above the lowest seen
+        for _ in range(4 * 3):
+            controller.record(0.1, 1024*1024)
+        self.assertEqual(2, controller.setpoint)
+        self.assertEqual((5, 4), (controller.increases, controller.decreases))
+
+    def test_target(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            export_file = os.path.join(tmpdir, 'setpoint.json')
+            controller = adaptive.AimdController(floor=1, ceiling=8, initial=8, target_latency=0.05, window=2,
+                                                 export_file=export_file)
+            # the initial setpoint is published before any change
+            with open(export_file) as f:
+                self.assertEqual(8, json.load(f)['setpoint'])
+            for _ in range(2):
+                controller.record(0.01, 64*1024) # small reads count as 1 MiB
+            self.assertEqual(8, controller.setpoint)
+            for _ in range(2):
+                controller.record(0.2, 2*1024*1024)
+            self.assertEqual(5, controller.setpoint)
+            with open(export_file) as f:
+                self.assertEqual(5, json.load(f)['setpoint'])
+        with self.assertRaises(ValueError):
+            adaptive.AimdController(floor=4, ceiling=2)
+
+    def test_run_paths(self):
+        ioctx = fakerados.FakeIoctx()
+        paths = [f'test/adaptive/file{i}' for i in range(8)]
+        for path in paths:
+            ioctx.add_striped(path, os.urandom(5000), object_size=1024)
+        ioctx.remove_object(paths[0] + '.0000000000000002')
+        controller = adaptive.AimdController(floor=1, ceiling=3, initial=1, window=4)
+        peak = []
+        class Reader(adaptive.ObservedReader):
+            def read(self, oid, length, offset=0):
+                peak.append(controller.inflight)
+                return super().read(oid, length, offset)
+        backend = backends.RadosBackend(ioctx, reader=Reader(controller, ioctx))
+        results = bulk.run_paths(backend, paths, 'inget', 1024, controller=controller)
+        self.assertEqual((7, 1), (results['done'], results['failed']))
+        self.assertEqual(3, controller.setpoint)
+        self.assertLessEqual(max(peak), 3)
+
+    def test_scheduled(self):
+        ioctx = fakerados.FakeIoctx()
+        ioctx.aio_delay = 0.01
+        data = os.urandom(20000)
+        ioctx.add_striped('test/adaptive/scheduled', data, object_size=4096)
+        osd_scheduler = osdmap.OsdScheduler(ioctx, osdmap.OsdMap(fakerados.FakeCluster(num_osds=4), 'dteam'),
+                                            max_per_osd=2)
+        controller = adaptive.AimdController(floor=1, ceiling=4, initial=2, window=100)
+        reader = adaptive.ObservedReader(controller, ioctx, osd_scheduler, reads_per_file=3)
+        xrdcks = cephtools.cks_from_file(ioctx, 'test/adaptive/scheduled', 1024, reader=reader)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(data)), xrdcks.get_cksum_as_hex())
+        # reads submitted ahead, through the scheduler, and observed
+        self.assertGreater(max(osd_scheduler.peak_inflight.values()), 1)
+        self.assertEqual(6, osd_scheduler.max_inflight)
+        # the last callbacks may still be running
+        deadline = time.monotonic() + 1
+        while len(controller._latencies) < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(20, len(controller._latencies))
+
+
+
+class TestProgress(unittest.TestCase):
+    _path = 'test/rucio/tests/progress.file'
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ioctx = fakerados.FakeIoctx()
+        self.data = os.urandom(10000)
+        self.ioctx.add_striped(self._path, self.data, object_size=4096)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_read(self, make_reader):
+        record = progress.Progress('inget', 'dteam', self._path, registry=self.tmpdir.name, interval=0)
+        seen = []
+        class Ioctx(fakerados.FakeIoctx):
+            def read(ioctx, oid, length=8192, offset=0):
+                seen.extend(progress.list_progress(self.tmpdir.name))
+                return self.ioctx.read(oid, length, offset)
+        reader = progress.ProgressReader(record, self.ioctx, make_reader(Ioctx()))
+        xrdcks = cephtools.cks_from_file(self.ioctx, self._path, 1024, reader)
+        self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(self.data)), xrdcks.get_cksum_as_hex())
+        self.assertEqual((10000, 10000, 2), (record.bytes_done, record.total_size, record.stripe))
+        self.assertTrue(seen)
+        self.assertEqual(('inget', self._path, 10000, os.getpid()),
+                         (seen[0]['action'], seen[0]['path'], seen[0]['total_size'], seen[0]['pid']))
+        self.assertEqual(1, len(progress.list_progress(self.tmpdir.name)))
+        record.close()
+        self.assertEqual([], progress.list_progress(self.tmpdir.name))
+
+    def test_reader(self):
+        self.check_read(lambda ioctx: cephtools.HedgedReader(ioctx))
+
+    def test_scheduled(self):
+        def make_reader(ioctx):
+            ioctx.aio_read = lambda oid, length, offset, oncomplete: self.ioctx._aio(oncomplete, ioctx.read, oid, length, offset)
+            return osdmap.OsdScheduler(ioctx, osdmap.OsdMap(fakerados.FakeCluster(), 'dteam'))
+        self.check_read(make_reader)
+
+    def test_cancelled(self):
+        record = progress.Progress('inget', 'dteam', self._path, registry=self.tmpdir.name, interval=0)
+        class Reader:
+            def submit(reader, oid, length, offset=0):
+                return concurrent.futures.Future()
+        future = progress.ProgressReader(record, self.ioctx, Reader()).submit(self._path + cephtools.chunk0, 1024)
+        # an error in the callback would only be logged
+        with self.assertNoLogs('concurrent.futures', level='ERROR'):
+            self.assertTrue(future.cancel())
+        self.assertEqual(0, record.bytes_done)
+        record.close()
+
+    def test_top(self):
+        now = time.time()
+        states = [{'pid': 1, 'action': 'inget', 'pool': 'dteam', 'path': 'a', 'bytes_done': 2**20, 'total_size': 2**22,
+                   'stripe': 0, 'reading': True, 'started': now - 100, 'last_progress': now - 60, 'updated': now - 60,
+                   'rate_bytes_per_s': 2**20/40},
+                  {'pid': 2, 'action': 'verify', 'pool': 'dteam', 'path': 'b', 'bytes_done': 0, 'total_size': None,
+                   'stripe': None, 'reading': True, 'started': now - 1, 'last_progress': now - 1, 'updated': now,
+                   'rate_bytes_per_s': None}]
+        table = top.rows(states, now, stall=30)
+        self.assertEqual([('1', '25%', True), ('2', '-', False)], [(r['pid'], r['pct'], r['stalled']) for r in table])
+        out = io.StringIO()
+        top.render(table, out)
+        self.assertIn('STALLED', out.getvalue().splitlines()[1])
+        self.assertIn('2 running, 1 stalled', out.getvalue())
+
+        # a file left by a process no longer running
+        with open(os.path.join(self.tmpdir.name, '999999999-0.json'), 'w') as f:
+            json.dump(dict(states[0], pid=999999999), f)
+        self.assertEqual([], progress.list_progress(self.tmpdir.name))
+        self.assertEqual([], os.listdir(self.tmpdir.name))
+
+
+class TestPageCrc(unittest.TestCase):
+    _path = 'test/rucio/tests/pagecrc.file'
+
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.data = os.urandom(3 * 8192 + 1000)
+        self.ioctx.add_striped(self._path, self.data, object_size=8192)
+
+    def expected(self, offset, length):
+        first, last = offset // 4096, (offset + length - 1) // 4096
+        return [pagecrc.crc32c(self.data[page*4096:(page+1)*4096]) for page in range(first, last + 1)]
+
+    def test_pure_python_warning(self):
+        accelerated = pagecrc.ACCELERATED
+        try:
+            pagecrc.ACCELERATED = False
+            with self.assertLogs(level='WARNING'):
+                backends.RadosBackend(self.ioctx, page_crcs='xattr')
+            pagecrc.ACCELERATED = True
+            with self.assertNoLogs(level='WARNING'):
+                backends.RadosBackend(self.ioctx, page_crcs='xattr')
+        finally:
+            pagecrc.ACCELERATED = accelerated
+
+    def test_crc32c(self):
+        self.assertEqual(0xE3069283, pagecrc.crc32c(b'123456789'))
+        self.assertEqual(0xE3069283, pagecrc.crc32c(b'6789', pagecrc.crc32c(b'12345')))
+        self.assertEqual(0, pagecrc.crc32c(b''))
+
+    def test_builder(self):
+        # unaligned buffers, and runs of zeros from sparse reads
+        builder = pagecrc.PageCrcBuilder()
+        data = self.data[:5000] + bytes(12000) + self.data[:1500]
+        buffers = [data[:3000], data[3000:5000], cephtools.adler32.ZeroRun(12000), data[17000:]]
+        self.assertEqual(buffers, list(builder.feed(buffers, 8192)))
+        pages = [pagecrc.crc32c(data[i:i+4096]) for i in range(0, len(data), 4096)]
+        self.assertEqual(pages[:2], list(builder.stripes[0]))
+        self.assertEqual(pages[2:4], list(builder.stripes[1]))
+        self.assertEqual(pages[4:], list(builder.stripes[2]))
+        self.assertEqual({0: 8192, 1: 8192, 2: len(data) - 16384}, builder.lengths)
+        self.assertEqual((4096, 8192, pages[2:4]), pagecrc.decode(builder.encoded(1)))
+        with self.assertRaises(ValueError):
+            list(pagecrc.PageCrcBuilder().feed([b'x'], 5000))
+
+    def test_lookup(self):
+        for page_crcs in ['xattr', 'sidecar']:
+            with self.subTest(page_crcs=page_crcs):
+                ioctx = fakerados.FakeIoctx()
+                ioctx.add_striped(self._path, self.data, object_size=8192)
+                backend = backends.RadosBackend(ioctx, page_crcs=page_crcs)
+                with self.assertRaises(KeyError):
+                    pagecrc.page_checksums(ioctx, self._path, 0, 100, 8192, sidecar=page_crcs == 'sidecar')
+                cks = actions.inget(backend, self._path, 8192)
+                self.assertEqual(f'{zlib.adler32(self.data):08x}', cks.get_cksum_as_hex())
+                for offset, length in [(0, 1), (0, len(self.data)), (5000, 10000), (8192, 8192), (len(self.data) - 1, 1)]:
+                    self.assertEqual(self.expected(offset, length),
+                                     pagecrc.page_checksums(ioctx, self._path, offset, length, 8192,
+                                                            sidecar=page_crcs == 'sidecar'))
+                self.assertEqual([], pagecrc.page_checksums(ioctx, self._path, 100, 0, 8192))
+                with self.assertRaises(KeyError):
+                    pagecrc.page_checksums(ioctx, self._path, len(self.data), 4096, 8192,
+                                           sidecar=page_crcs == 'sidecar')
+                self.assertEqual(page_crcs == 'sidecar', self._path + '.0000000000000000.pgcrc32c' in ioctx.objects)
+
+    def test_sparse(self):
+        # a missing stripe has no object to hold the xattr; in a sidecar, its checksums are those of zero pages
+        zero = pagecrc.crc32c(bytes(4096))
+        for page_crcs in ['xattr', 'sidecar']:
+            with self.subTest(page_crcs=page_crcs):
+                ioctx = fakerados.FakeIoctx()
+                ioctx.add_striped(self._path, self.data, object_size=8192)
+                ioctx.remove_object(self._path + '.0000000000000001')
+                backend = backends.RadosBackend(ioctx, sparse=True, page_crcs=page_crcs)
+                actions.inget(backend, self._path, 8192)
+                self.assertNotIn(self._path + '.0000000000000001', ioctx.objects)
+                self.assertEqual(self.expected(16384, 9000),
+                                 pagecrc.page_checksums(ioctx, self._path, 16384, 9000, 8192, sidecar=page_crcs == 'sidecar'))
+                if page_crcs == 'xattr':
+                    with self.assertRaises(KeyError):
+                        pagecrc.page_checksums(ioctx, self._path, 8192, 8192, 8192)
+                else:
+                    self.assertEqual([zero, zero], pagecrc.page_checksums(ioctx, self._path, 8192, 8192, 8192, sidecar=True))
+
+    def test_unaligned(self):
+        # stripes of a file written without the striper metadata need not be whole pages; the file checksum stands
+        ioctx = fakerados.FakeIoctx()
+        data = os.urandom(10000)
+        ioctx.add_striped(self._path, data, object_size=3000, striper_xattrs=False)
+        with self.assertLogs(level='WARNING'):
+            cks = actions.inget(backends.RadosBackend(ioctx, page_crcs='xattr'), self._path, 1024)
+        self.assertEqual(f'{zlib.adler32(data):08x}', cks.get_cksum_as_hex())
+        self.assertNotIn(pagecrc.PAGE_XATTR, ioctx.xattrs[self._path + '.0000000000000000'])
+
+    def test_feed_failure(self):
+        builder = pagecrc.PageCrcBuilder()
+        buffers = builder.feed([b'abc', b'def'], 4096)
+        self.assertEqual(b'abc', next(buffers))
+        builder._add = lambda buf, offset, object_size: 1 / 0
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual([b'def'], list(buffers))
+        self.assertEqual({}, builder.stripes)
+
+
+class TestPriorityScheduler(unittest.TestCase):
+    def setUp(self):
+        self.ioctx = fakerados.FakeIoctx()
+        self.data = os.urandom(10000)
+        self._path = 'test/scheduler/file'
+        self.ioctx.add_striped(self._path, self.data, object_size=4096)
+        self.scheduler = scheduler.PriorityScheduler(max_reads=1)
+
+    def test_weighted(self):
+        granted = []
+        def read(cls):
+            self.scheduler.acquire(cls, 1000)
+            granted.append(cls)
+            self.scheduler.release(cls)
+
+        # hold the only slot while the requests queue up
+        self.scheduler.acquire(scheduler.TRANSFER, 1000)
+        threads = [threading.Thread(target=read, args=(cls,)) 
+                   for cls in [scheduler.BACKGROUND]*8 + [scheduler.INTERACTIVE]*8]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        self.scheduler.release(scheduler.TRANSFER)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, granted[:9].count(scheduler.BACKGROUND))
+        self.assertEqual({scheduler.INTERACTIVE: 8000, scheduler.TRANSFER: 1000, scheduler.BACKGROUND: 8000},
+                         self.scheduler.bytes_granted)
+
+    def test_preempt(self):
+        results = []
+        with self.scheduler.job(scheduler.INTERACTIVE):
+            background = threading.Thread(target=lambda: results.append(
+                self.scheduler.inget(self.ioctx, self._path, scheduler.BACKGROUND, 1024)))
+            background.start()
+            background.join(0.1)
+            self.assertTrue(background.is_alive())
+            self.assertEqual(1, self.scheduler.yields)
+            # interactive work is not held up
+            xrdcks = self.scheduler.verify(self.ioctx, self._path, scheduler.INTERACTIVE, 1024)
+            self.assertIsNone(xrdcks)
+        background.join()
+        a32_hex = adler32.adler32.adler32_inttohex(zlib.adler32(self.data))
+        self.assertEqual(a32_hex, results[0].get_cksum_as_hex())
+        self.assertEqual(a32_hex, self.scheduler.verify(self.ioctx, self._path, scheduler.INTERACTIVE, 1024).get_cksum_as_hex())
+        # granted as requested: 10 reads of 1024 bytes, the last one short
+        self.assertEqual(10*1024, self.scheduler.bytes_granted[scheduler.BACKGROUND])
+
+    def test_host_jobs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jobs = scheduler.HostJobs(tmpdir)
+            # a process that has exited, and a running one
+            open(os.path.join(tmpdir, f'{scheduler.INTERACTIVE}.{2**22 + 1}.0'), 'w').close()
+            open(os.path.join(tmpdir, f'{scheduler.INTERACTIVE}.{os.getppid()}.0'), 'w').close()
+            self.assertEqual(1, jobs.running([scheduler.INTERACTIVE]))
+            self.assertEqual([f'{scheduler.INTERACTIVE}.{os.getppid()}.0'], os.listdir(tmpdir))
+            with jobs.job(scheduler.INTERACTIVE):
+                self.assertEqual(2, jobs.running([scheduler.INTERACTIVE]))
+                self.assertEqual(1, jobs.running([scheduler.INTERACTIVE], exclude_pid=os.getpid()))
+                self.assertEqual(0, jobs.running([scheduler.TRANSFER]))
+            self.assertEqual(1, jobs.running([scheduler.INTERACTIVE]))
+
+    def test_preempt_other_process(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sched = scheduler.PriorityScheduler(max_reads=None, host_jobs=scheduler.HostJobs(tmpdir), poll_interval=0.02)
+            # an interactive request in another process of the host
+            marker = os.path.join(tmpdir, f'{scheduler.INTERACTIVE}.{os.getppid()}.0')
+            open(marker, 'w').close()
+            results = []
+            backend = backends.RadosBackend(self.ioctx)
+            background = threading.Thread(target=lambda: results.append(
+                sched.inget(backend, self._path, scheduler.BACKGROUND, 1024)))
+            background.start()
+            background.join(0.1)
+            self.assertTrue(background.is_alive())
+            self.assertEqual(1, sched.yields)
+            os.unlink(marker)
+            background.join()
+            self.assertEqual(adler32.adler32.adler32_inttohex(zlib.adler32(self.data)), results[0].get_cksum_as_hex())
+            # the jobs of this process are registered for the others
+            with sched.job(scheduler.INTERACTIVE), sched.job(scheduler.TRANSFER):
+                self.assertEqual({scheduler.INTERACTIVE: 1, scheduler.TRANSFER: 1}, sched.host_jobs.counts())
+            self.assertEqual([], os.listdir(tmpdir))
+
+    def test_host_share(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sched = scheduler.PriorityScheduler(max_reads=None, host_jobs=scheduler.HostJobs(tmpdir), poll_interval=0)
+            self.assertEqual(0, sched.host_delay(scheduler.BACKGROUND, 1.))
+            # transfer and background work in another process of the host
+            open(os.path.join(tmpdir, f'{scheduler.TRANSFER}.{os.getppid()}.0'), 'w').close()
+            open(os.path.join(tmpdir, f'{scheduler.BACKGROUND}.{os.getppid()}.1'), 'w').close()
+            self.assertEqual(4, sched.host_delay(scheduler.BACKGROUND, 1.))
+            self.assertEqual(0.25, sched.host_delay(scheduler.TRANSFER, 1.))
+            # background work yields to interactive work anyway
+            self.assertEqual(0.5, sched.host_delay(scheduler.INTERACTIVE, 1.))
+
+            # each read is followed by a wait of 4 times its time, made before the next read
+            read = self.ioctx.read
+            def slow_read(oid, length, offset=0):
+                time.sleep(0.02)
+                return read(oid, length, offset)
+            self.ioctx.read = slow_read
+            reader = scheduler.ClassReader(sched, self.ioctx, scheduler.BACKGROUND)
+            oid = self._path + '.0000000000000000'
+            start = time.monotonic()
+            reader.read(oid, 1024)
+            self.assertGreaterEqual(reader.owed, 0.08)
+            self.assertLess(time.monotonic() - start, 0.08)
+            reader.read(oid, 1024, 1024)
+            self.assertGreaterEqual(time.monotonic() - start, 0.12)
+
+    def test_parse_weights(self):
+        self.assertEqual(scheduler.DEFAULT_WEIGHTS, scheduler.parse_weights(''))
+        self.assertEqual({scheduler.INTERACTIVE: 8, scheduler.TRANSFER: 2, scheduler.BACKGROUND: 0.5},
+                         scheduler.parse_weights('transfer=2, background=0.5'))
+        for text in ['scrub=1', 'transfer=fast', 'background=0']:
+            with self.assertRaises(ValueError):
+                scheduler.parse_weights(text)
+
+
 if __name__ == '__main__':
     unittest.main()
 